@@ -0,0 +1,87 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+# Version of the pair search and cumulant code: changing it invalidates the cached artifacts
+CACHE_VERSION = 'par-1'
+
+# Size limit of the cache, in bytes (GEO_CUMULANT_CACHE_BYTES overrides it)
+CACHE_MAX_BYTES = int(os.environ.get('GEO_CUMULANT_CACHE_BYTES', 2 * 1024**3))
+
+def par_cache_dir():
+    """
+    Cache directory at the root of the repository, created if needed.
+    """
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    cache_dir = os.path.join(os.path.dirname(script_dir), 'cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    return cache_dir
+
+def par_pairs_cache_key(coords, params):
+    """
+    Key of the pairs of a dataset: hash of the (N, 3) coordinates, of the search
+    parameters and of the code version. The grades are not part of the key, so the pairs
+    are reused when only the grades change.
+    """
+    digest = hashlib.sha256()
+    digest.update(CACHE_VERSION.encode())
+    digest.update(json.dumps([list(map(float, values)) for values in params]).encode())
+    digest.update(np.ascontiguousarray(coords, dtype=np.float64).tobytes())
+
+    return 'pairs-' + digest.hexdigest()
+
+def par_cumulants_cache_key(pairs_sha256, data_sha256):
+    """
+    Key of the cumulants of a pair file and a data file, from their SHA-256 hashes and
+    the code version.
+    """
+    digest = hashlib.sha256()
+    digest.update(CACHE_VERSION.encode())
+    digest.update(pairs_sha256.encode())
+    digest.update(data_sha256.encode())
+
+    return 'cumulants-' + digest.hexdigest()
+
+def par_cache_lookup(key, cache_dir=None):
+    """
+    Path of the cached artifact of key, or None. A hit marks the artifact as the most
+    recently used.
+    """
+    cache_dir = cache_dir or par_cache_dir()
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(key):
+            path = os.path.join(cache_dir, file_name)
+            os.utime(path)
+            return path
+
+    return None
+
+def par_cache_store(file_path, key, suffix='', cache_dir=None, max_bytes=None):
+    """
+    Copy an artifact into the cache under key (with suffix appended to the file name),
+    then evict the least recently used artifacts above max_bytes. Returns the path of
+    the cached artifact.
+    """
+    cache_dir = cache_dir or par_cache_dir()
+    path = os.path.join(cache_dir, key + suffix)
+    shutil.copyfile(file_path, path)
+    par_cache_evict(cache_dir, CACHE_MAX_BYTES if max_bytes is None else max_bytes)
+
+    return path
+
+def par_cache_evict(cache_dir, max_bytes):
+    """
+    Remove the least recently used artifacts until the cache holds at most max_bytes.
+    """
+    entries = [os.path.join(cache_dir, file_name) for file_name in os.listdir(cache_dir)]
+    entries = sorted((os.stat(path).st_mtime, os.path.getsize(path), path) for path in entries if os.path.isfile(path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
@@ -1,6 +1,7 @@
 import cudf
 import cupy as cp
 import itertools
+from par_pair_index import par_load_pair_index, par_pair_index_to_pairs
 
 def center_grades(data_file):
     # Load the data
@@ -19,6 +20,23 @@ def associate_grade(df_data, pairs_file):
     # Add the point_id column as the first column
     df_data.insert(0, 'point_id', range(1, len(df_data) + 1))
 
+    # Pair index (memory-mapped .pairs file, or already loaded): the values are read at the point rows
+    if isinstance(pairs_file, dict) or str(pairs_file).endswith('.pairs'):
+        index = pairs_file if isinstance(pairs_file, dict) else par_load_pair_index(pairs_file)
+        pairs = cp.asarray(par_pair_index_to_pairs(index))
+        grade = df_data['GRADE'].values
+
+        df_pairs = cudf.DataFrame({
+            'point_id': pairs[:, 0],
+            'dim_id': pairs[:, 1],
+            'n': pairs[:, 2],
+            'paired_point_id': pairs[:, 3],
+        })
+        df_pairs['point_id_value'] = grade[pairs[:, 0] - 1]
+        df_pairs['paired_point_id_value'] = grade[pairs[:, 3] - 1]
+
+        return df_pairs
+
     # Load the JSON pairs data into a DataFrame
     df_pairs = cudf.read_json(pairs_file)
 
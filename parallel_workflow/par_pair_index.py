@@ -0,0 +1,282 @@
+import hashlib
+import json
+import numpy as np
+
+# Binary pair file, same format as the sequential workflow: magic bytes, version, and the names of the search parameters of the header
+PAIR_FILE_MAGIC = b'GEOPAIRS'
+PAIR_FILE_VERSION = 1
+PAIR_FILE_PARAMS = ('dim', 'nlag', 'lag', 'lag_tol', 'azm', 'azm_tol', 'bandwh', 'dip', 'dip_tol', 'bandwv')
+
+def par_pair_index_slot(ndir, max_nlag, point_id, dim_id, n):
+    """
+    Slot of (point_id, dim_id, n) in the offsets of a pair index, the points being
+    numbered from 1.
+    """
+    return ((point_id - 1) * ndir + dim_id) * (max_nlag + 1) + n
+
+def par_pair_index_from_counts(pair_counts, paired_point_id):
+    """
+    Build the CSR pair index from the (num_points, ndir, max_nlag + 1) pair counts of the
+    kernels and the paired point ids they wrote contiguously in slot order. Returns a
+    dictionary with the offsets, the int32 paired point ids and the dimensions of the index.
+    """
+    index = par_new_pair_index(*pair_counts.shape)
+    par_append_pair_chunk(index, pair_counts, paired_point_id)
+
+    return par_finish_pair_index(index)
+
+def par_new_pair_index(num_points, ndir, num_lags):
+    """
+    Empty CSR pair index of num_points points, to be filled chunk by chunk of points with
+    par_append_pair_chunk, then completed by par_finish_pair_index.
+    """
+    return {
+        'offsets': np.zeros(num_points * ndir * num_lags + 1, dtype=np.int64),
+        'paired_point_id': [],
+        'num_points': num_points,
+        'ndir': ndir,
+        'max_nlag': num_lags - 1,
+        'next_slot': 0,
+    }
+
+def par_append_pair_chunk(index, pair_counts, paired_point_id):
+    """
+    Append the (chunk_points, ndir, max_nlag + 1) pair counts of the next chunk of points
+    and its paired point ids, in slot order, to a pair index being built. The offsets of
+    the chunk are written in place after the ones of the previous chunks.
+    """
+    counts = np.asarray(pair_counts, dtype=np.int64).ravel()
+    start = index['next_slot']
+    offsets = index['offsets'][start + 1:start + 1 + counts.shape[0]]
+    np.cumsum(counts, out=offsets)
+    offsets += index['offsets'][start]
+
+    index['paired_point_id'].append(np.asarray(paired_point_id, dtype=np.int32))
+    index['next_slot'] += counts.shape[0]
+
+def par_finish_pair_index(index):
+    """
+    Complete a pair index built by par_append_pair_chunk: the paired point ids of the
+    chunks are joined into one array.
+    """
+    num_slots = index['offsets'].shape[0] - 1
+    if index['next_slot'] != num_slots:
+        raise ValueError(f"The pair index is incomplete: {index['next_slot']} of {num_slots} slots filled.")
+
+    index['paired_point_id'] = np.concatenate([np.zeros(0, dtype=np.int32)] + index.pop('paired_point_id'))
+    del index['next_slot']
+
+    return index
+
+def par_pair_index_neighbours(index, point_id, dim_id, n):
+    """
+    Paired point ids of point_id in direction dim_id at lag n, read in O(1) from the index.
+    """
+    slot = par_pair_index_slot(index['ndir'], index['max_nlag'], point_id, dim_id, n)
+
+    return index['paired_point_id'][index['offsets'][slot]:index['offsets'][slot + 1]]
+
+def par_pairs_from_counts(pair_counts, paired_point_id, first_point_id=1):
+    """
+    Pair table of a chunk of points: expand its (chunk_points, ndir, max_nlag + 1) pair
+    counts and the paired point ids written in slot order by the kernels into an (M, 4)
+    array of [point_id, dim_id, n, paired_point_id] rows, the first point of the chunk
+    being first_point_id. Only the non-empty slots are unravelled, then repeated by
+    their number of pairs.
+    """
+    pair_counts = np.asarray(pair_counts)
+    counts = pair_counts.ravel()
+    slot = np.flatnonzero(counts)
+    slot_counts = counts[slot]
+    point_row, dim_id, n = np.unravel_index(slot, pair_counts.shape)
+
+    pairs = np.empty((int(slot_counts.sum()), 4), dtype=np.int64)
+    pairs[:, 0] = np.repeat(point_row + first_point_id, slot_counts)
+    pairs[:, 1] = np.repeat(dim_id, slot_counts)
+    pairs[:, 2] = np.repeat(n, slot_counts)
+    pairs[:, 3] = paired_point_id
+
+    return pairs
+
+def par_pair_index_to_pairs(index):
+    """
+    Expand the pair index into an (M, 4) array of [point_id, dim_id, n, paired_point_id] rows.
+    """
+    pair_counts = np.diff(index['offsets']).reshape(index['num_points'], index['ndir'], index['max_nlag'] + 1)
+
+    return par_pairs_from_counts(pair_counts, index['paired_point_id'])
+
+def par_file_sha256(file_name, chunk_size=1 << 20):
+    """
+    SHA-256 hash of a file, read by chunks of chunk_size bytes.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def par_pair_file_header(num_points, ndir, max_nlag, params=None, input_file=None):
+    """
+    Header of a .pairs file (dimensions of the index, search parameters and SHA-256 hash
+    of the input file), with the position of the arrays in the file. The number of pairs
+    is filled in when the file is complete.
+    """
+    header = {
+        'version': PAIR_FILE_VERSION,
+        'num_points': int(num_points),
+        'ndir': int(ndir),
+        'max_nlag': int(max_nlag),
+        'num_pairs': 0,
+        'params': None if params is None else dict(zip(PAIR_FILE_PARAMS, params)),
+        'input_sha256': None if input_file is None else par_file_sha256(input_file),
+    }
+
+    # Room for the largest header the file can get (the number of pairs and the hash of an input
+    # file recorded later, see par_set_pair_file_input) and the positions, then the arrays on 64
+    # bytes boundaries
+    num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+    largest_header = dict(header, num_pairs=np.iinfo(np.int64).max, input_sha256='0' * 64)
+    header['header_length'] = len(json.dumps(largest_header).encode()) + 128
+    header['offsets_start'] = -(-(len(PAIR_FILE_MAGIC) + 8 + header['header_length']) // 64) * 64
+    header['pairs_start'] = -(-(header['offsets_start'] + 8 * (num_slots + 1)) // 64) * 64
+
+    return header
+
+def par_write_pair_file_header(file, header):
+    """
+    Write the magic bytes and the header at the start of an open .pairs file.
+    """
+    encoded = json.dumps(header).encode()
+    if len(encoded) > header['header_length']:
+        raise ValueError(f"The header of {len(encoded)} bytes does not fit in the {header['header_length']} bytes reserved in the pair file.")
+
+    file.seek(0)
+    file.write(PAIR_FILE_MAGIC)
+    file.write(np.uint64(header['header_length']).tobytes())
+    file.write(encoded.ljust(header['header_length']))
+
+def par_save_pair_index(index, file_name, params=None, input_file=None):
+    """
+    Save the pair index to a binary .pairs file: the magic bytes, the length of the
+    JSON header, the header (see par_pair_file_header), then the int64 offsets and the
+    int32 paired point ids, each starting on a 64 bytes boundary so that they can be
+    memory-mapped.
+    """
+    header = par_pair_file_header(index['num_points'], index['ndir'], index['max_nlag'], params=params, input_file=input_file)
+    header['num_pairs'] = int(index['paired_point_id'].shape[0])
+
+    with open(file_name, 'wb') as file:
+        par_write_pair_file_header(file, header)
+        file.seek(header['offsets_start'])
+        file.write(np.ascontiguousarray(index['offsets'], dtype=np.int64).tobytes())
+        file.seek(header['pairs_start'])
+        file.write(np.ascontiguousarray(index['paired_point_id'], dtype=np.int32).tobytes())
+
+def par_open_pair_writer(file_name, num_points, ndir, max_nlag, params=None, input_file=None):
+    """
+    Open a .pairs file to be written chunk of points by chunk of points with
+    par_write_pair_chunk and completed by par_close_pair_writer. The offsets and the
+    paired point ids of each chunk are written as soon as they are received, so the
+    memory used does not depend on the number of pairs. Returns the state of the writer.
+    """
+    header = par_pair_file_header(num_points, ndir, max_nlag, params=params, input_file=input_file)
+    file = open(file_name, 'wb')
+
+    # Offset of the first slot
+    file.seek(header['offsets_start'])
+    file.write(np.zeros(1, dtype=np.int64).tobytes())
+
+    return {
+        'file': file,
+        'header': header,
+        'next_slot': 0,
+        'num_pairs': 0,
+    }
+
+def par_write_pair_chunk(writer, pair_counts, paired_point_id):
+    """
+    Append the (chunk_points, ndir, max_nlag + 1) pair counts of the next chunk of points
+    and its paired point ids, in slot order as written by the kernels, to a pair writer.
+    """
+    file, header = writer['file'], writer['header']
+    counts = np.asarray(pair_counts, dtype=np.int64).ravel()
+
+    # Offsets of the slots of the chunk, after the pairs already written
+    offsets = writer['num_pairs'] + np.cumsum(counts)
+    file.seek(header['offsets_start'] + 8 * (writer['next_slot'] + 1))
+    file.write(offsets.tobytes())
+
+    file.seek(header['pairs_start'] + 4 * writer['num_pairs'])
+    file.write(np.ascontiguousarray(paired_point_id, dtype=np.int32).tobytes())
+
+    writer['next_slot'] += counts.shape[0]
+    writer['num_pairs'] += int(counts.sum())
+
+def par_close_pair_writer(writer):
+    """
+    Write the header of a pair writer once all the chunks are written and close the
+    file. Returns the number of pairs written.
+    """
+    file, header = writer['file'], writer['header']
+    try:
+        num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+        if writer['next_slot'] != num_slots:
+            raise ValueError(f"The pair file is incomplete: {writer['next_slot']} of {num_slots} slots written.")
+
+        header['num_pairs'] = writer['num_pairs']
+        par_write_pair_file_header(file, header)
+    finally:
+        file.close()
+
+    return header['num_pairs']
+
+def par_read_pair_file_header(file_name):
+    """
+    Read the JSON header of a .pairs file.
+    """
+    with open(file_name, 'rb') as file:
+        if file.read(len(PAIR_FILE_MAGIC)) != PAIR_FILE_MAGIC:
+            raise ValueError(f"{file_name} is not a pair file.")
+        header_length = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_length))
+
+    if header['version'] != PAIR_FILE_VERSION:
+        raise ValueError(f"Unsupported pair file version: {header['version']}")
+
+    return header
+
+def par_set_pair_file_input(file_name, input_file):
+    """
+    Record input_file as the input of a .pairs file, for pairs reused for another file
+    with the same coordinates.
+    """
+    header = par_read_pair_file_header(file_name)
+    header['input_sha256'] = par_file_sha256(input_file)
+    with open(file_name, 'r+b') as file:
+        par_write_pair_file_header(file, header)
+
+def par_load_pair_index(file_name, mmap=True):
+    """
+    Load a pair index saved by par_save_pair_index or seq_save_pair_index. With mmap the
+    offsets and the paired point ids are memory-mapped from the file instead of being
+    read into memory. The header is returned under 'metadata'.
+    """
+    header = par_read_pair_file_header(file_name)
+    num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+
+    def read_array(dtype, start, count):
+        # An empty array cannot be memory-mapped
+        if mmap and count > 0:
+            return np.memmap(file_name, dtype=dtype, mode='r', offset=start, shape=(count,))
+        return np.fromfile(file_name, dtype=dtype, count=count, offset=start)
+
+    return {
+        'offsets': read_array(np.int64, header['offsets_start'], num_slots + 1),
+        'paired_point_id': read_array(np.int32, header['pairs_start'], header['num_pairs']),
+        'num_points': header['num_points'],
+        'ndir': header['ndir'],
+        'max_nlag': header['max_nlag'],
+        'metadata': header,
+    }
@@ -4,7 +4,11 @@ import pandas as pd
 import cupy as cp
 import time
 import os
-from par_search_pairs import par_search_pairs_gen
+import shutil
+from par_search_pairs import par_search_pairs_gen_chunks, par_new_search_stats, par_format_search_stats
+from par_search_pairs_cpu import par_search_pairs_gen_cpu
+from par_pair_index import par_save_pair_index, par_set_pair_file_input, par_open_pair_writer, par_write_pair_chunk, par_close_pair_writer, par_read_pair_file_header, par_file_sha256
+from par_cache import par_pairs_cache_key, par_cumulants_cache_key, par_cache_lookup, par_cache_store
 from par_cumulants import (center_grades, associate_grade, compute_3rd_order_cumulant, compute_4th_order_cumulant)
 import subprocess
 def load_parameters(ndir, file_name):
@@ -33,8 +37,19 @@ def compute_pairs():
     # Prompt user for the input ndir
     ndir = int(input("Please select the value for ndir: "))
 
+    # Prompt user for the pair search backend
+    backend = input("Please select the pair search backend (1: CUDA GPU, 2: Numba CPU): ").strip()
+    if backend not in ('1', '2'):
+        raise ValueError("Invalid backend selection. Please select 1 or 2.")
+
     # Prompt user to enter the number of chunks
-    num_chunks = int(input("Please enter the number of chunks to split the dataset (e.g., 4): "))
+    if backend == '1':
+        num_chunks = int(input("Please enter the number of chunks to split the dataset (e.g., 4): "))
+
+        # Prompt user for the order of the filter stages
+        stage_mode = input("Please select the filter stage order (1: default, 2: adaptive, 3: default and report the rejections of each stage): ").strip()
+        if stage_mode not in ('1', '2', '3'):
+            raise ValueError("Invalid stage order selection. Please select 1, 2 or 3.")
 
     # Define the path to the search_parameters.json file
     script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -74,26 +89,49 @@ def compute_pairs():
     # Convert the DataFrame to a NumPy array
     data_vector = df.to_numpy()
 
-    # Get the pairs with parallel, using the provided number of chunks
-    start_time_par = time.time()
-    par_pairs = par_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_chunks=num_chunks)
-    end_time_par = time.time()
-    time_par = end_time_par - start_time_par
-    print(f"Parallel function call completed in {time_par} seconds.")
-
-    # Convert pairs to a DataFrame
-    par_pairs_df = pd.DataFrame(par_pairs, columns=["point_id", "dim_id", "n", "paired_point_id"])
-
     # Create the output directory if it doesn't exist
     output_dir = os.path.join(parent_dir, 'output')
     os.makedirs(output_dir, exist_ok=True)
 
     # Construct the output file name
-    output_file_name = f"par_pairs_{os.path.splitext(selected_file_name)[0]}.json"
+    output_file_name = f"par_pairs_{os.path.splitext(selected_file_name)[0]}.pairs"
     output_file_path = os.path.join(output_dir, output_file_name)
+    params = (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    # Reuse the pairs of the same coordinates and search parameters from the cache
+    cache_key = par_pairs_cache_key(data_vector[:, 1:4], params)
+    cached_file_path = par_cache_lookup(cache_key)
+    if cached_file_path is not None:
+        shutil.copyfile(cached_file_path, output_file_path)
+        par_set_pair_file_input(output_file_path, selected_file_path)
+        print("Pairs found in the cache, pair search skipped.")
+        print(f"Output saved to: {output_file_path}")
+        return
+
+    # Get the pairs with parallel, using the provided number of chunks
+    start_time_par = time.time()
+    if backend == '1':
+        # Stream the pairs of each chunk to the output directory
+        stats = par_new_search_stats(dim) if stage_mode == '3' else None
+        writer = par_open_pair_writer(output_file_path, data_vector.shape[0], ndir, max(nlag), params=params, input_file=selected_file_path)
+        for pair_counts, pairs in par_search_pairs_gen_chunks(data_vector, *params, num_chunks=num_chunks, stage_order='adaptive' if stage_mode == '2' else None, stats=stats):
+            par_write_pair_chunk(writer, pair_counts, pairs)
+        par_close_pair_writer(writer)
+
+        # Rejections of each filter stage, per direction
+        if stats is not None:
+            print(par_format_search_stats(stats))
+    else:
+        par_pairs = par_search_pairs_gen_cpu(data_vector, *params)
+
+        # Save the pair index to the output directory, with the search parameters and the hash of the input file
+        par_save_pair_index(par_pairs, output_file_path, params=params, input_file=selected_file_path)
+    end_time_par = time.time()
+    time_par = end_time_par - start_time_par
+    print(f"Parallel function call completed in {time_par} seconds.")
 
-    # Save the output to a JSON file in the output directory
-    par_pairs_df.to_json(output_file_path, orient='records', indent=4)
+    # Keep the pairs in the cache for the next runs
+    par_cache_store(output_file_path, cache_key, suffix='.pairs')
 
     print(f"Output saved to: {output_file_path}")
     
@@ -122,9 +160,8 @@ def compute_cumulants():
     selected_data_file_path = os.path.join(input_dir, selected_data_file_name)
     print(f"Selected data file: {selected_data_file_path}")
 
-    # List all files in the output directory
-    # List all JSON files in the output directory
-    output_files = [f for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f)) and f.endswith('.json')]
+    # List all the pair files (pair index or JSON) in the output directory
+    output_files = [f for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f)) and f.endswith(('.pairs', '.json'))]
     for i, file_name in enumerate(output_files):
         print(f"{i + 1}: {file_name}")
 
@@ -140,6 +177,12 @@ def compute_cumulants():
     selected_pair_file_path = os.path.join(output_dir, selected_pair_file_name)
     print(f"Selected pair file: {selected_pair_file_path}")
 
+    # Warn if the pairs were searched on another input file
+    if selected_pair_file_path.endswith('.pairs'):
+        input_sha256 = par_read_pair_file_header(selected_pair_file_path)['input_sha256']
+        if input_sha256 is not None and input_sha256 != par_file_sha256(selected_data_file_path):
+            print("Warning: the pair file was not computed from the selected data file.")
+
     # Prompt user to enter the number of chunks for the merging operation
     num_chunks = int(input("Please enter the number of chunks for the merging operation(limit memory usage): "))
 
@@ -149,6 +192,17 @@ def compute_cumulants():
     # Measure cumulative time for the entire process
     start_time = time.time()
 
+    # Reuse the cumulants of the same pair file and data file from the cache
+    cache_key = par_cumulants_cache_key(par_file_sha256(selected_pair_file_path), par_file_sha256(selected_data_file_path))
+    cached_file_path = par_cache_lookup(cache_key)
+    if cached_file_path is not None:
+        order = '3rd' if cached_file_path.endswith('_3rd.csv') else '4th'
+        output_cumulant_file_path = os.path.join(output_dir, f"par_cum_{order}_{os.path.splitext(selected_data_file_name)[0]}.csv")
+        shutil.copyfile(cached_file_path, output_cumulant_file_path)
+        print("Cumulants found in the cache, computation skipped.")
+        print(f"Cumulant results saved to: {output_cumulant_file_path}")
+        return
+
     # Center grades
     df_centered = center_grades(selected_data_file_path)
 
@@ -173,6 +227,9 @@ def compute_cumulants():
     output_cumulant_file_path = os.path.join(output_dir, output_cumulant_file_name)
     cumulant_result.to_csv(output_cumulant_file_path, index=False)
 
+    # Keep the cumulants in the cache for the next runs
+    par_cache_store(output_cumulant_file_path, cache_key, suffix='_3rd.csv' if num_dimensions == 2 else '_4th.csv')
+
     # End time for the cumulative process
     end_time = time.time()
     memory_pool.free_all_blocks()
@@ -183,7 +240,10 @@ def compute_cumulants():
 def monitor_gpu():
     print("Launching nvidia-smi to monitor GPU usage:")
     # Run the nvidia-smi command and display the output
-    subprocess.run(['nvidia-smi'])
+    try:
+        subprocess.run(['nvidia-smi'])
+    except FileNotFoundError:
+        print("nvidia-smi not found, no GPU to monitor.")
 
 def main():
     while True:
@@ -1,5 +1,6 @@
 import cupy as cp
 import numpy as np
+from math import floor
 from numba import cuda
 from par_search_pairs_support import (    
     par_calculate_azimuth_3d,
@@ -7,65 +8,181 @@ from par_search_pairs_support import (
     par_distance_along_horizontal_bandwidth,
     par_distance_along_vertical_bandwidth,
     par_point_distance_to_shifted_plane)
+from par_spatial_index import par_search_bounding_boxes, par_build_grid_index
+from par_pair_index import par_new_pair_index, par_append_pair_chunk, par_finish_pair_index
 
-# Constants
-MAX_PAIRS = 1000  # Maximum number of pairs to store for each (point_id, dim_id, n) combination
+# Filter stages of the pair check, in their default order
+SEARCH_STAGES = ('azimuth', 'dip', 'bandwh', 'bandwv', 'max_lag', 'min_lag')
 
-# Main parallelized function
+# Check if potential_pair passes one filter stage (index in SEARCH_STAGES) of direction dim_id at lag n
+@cuda.jit(device=True)
+def par_check_stage(stage, p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+    if stage == 0:
+        # Calculate azimuth and check tolerance
+        cal_azimuth = par_calculate_azimuth_3d(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
+        min_azimuth = (azm[dim_id] - azm_tol[dim_id] + 360) % 360
+        max_azimuth = (azm[dim_id] + azm_tol[dim_id] + 360) % 360
+        return min_azimuth <= cal_azimuth <= max_azimuth if min_azimuth < max_azimuth else cal_azimuth >= min_azimuth or cal_azimuth <= max_azimuth
+
+    if stage == 1:
+        # Calculate dip and check tolerance
+        cal_dip = par_calculate_dip_3d(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
+        return not (cal_dip > dip[dim_id] + dip_tol[dim_id] or cal_dip < dip[dim_id] - dip_tol[dim_id])
+
+    if stage == 2:
+        # Calculate horizontal bandwidth and check
+        cal_hor_length_diff = par_distance_along_horizontal_bandwidth(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
+        return abs(cal_hor_length_diff) <= bandwh[dim_id]
+
+    if stage == 3:
+        # Calculate vertical bandwidth and check
+        cal_ver_diff = par_distance_along_vertical_bandwidth(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
+        return abs(cal_ver_diff) <= bandwv[dim_id]
+
+    if stage == 4:
+        # Check within maximum lag tolerance
+        distance_max_lag_tol = par_point_distance_to_shifted_plane(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) + lag_tol[dim_id], azm[dim_id], dip[dim_id])
+        return distance_max_lag_tol <= 0
+
+    # Check within minimum lag tolerance
+    distance_min_lag_tol = par_point_distance_to_shifted_plane(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) - lag_tol[dim_id], azm[dim_id], dip[dim_id])
+    return distance_min_lag_tol >= 0
+
+# Check if potential_pair is paired with p in direction dim_id at lag n, running the stages in the order
+# of stage_order[dim_id]. Returns the stage rejecting the pair, or -1 when it is accepted.
+@cuda.jit(device=True)
+def par_check_pair(p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order):
+    for k in range(stage_order.shape[1]):
+        stage = stage_order[dim_id, k]
+        if not par_check_stage(stage, p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+            return stage
+
+    return -1
+
+# Order of the filter stages of each direction, as an (ndir, len(SEARCH_STAGES)) array of stage indices.
+# stage_order maps each dim_id to a permutation of SEARCH_STAGES, the default order being used for the others.
+def par_stage_order_array(dim, stage_order=None):
+    stage_order = stage_order or {}
+    return np.array([[SEARCH_STAGES.index(stage) for stage in stage_order.get(dim_id, SEARCH_STAGES)] for dim_id in dim], dtype=np.int32)
+
+# Empty counters of the filter stages of each direction, filled by par_search_pairs_gen_chunks:
+# stats[dim_id][stage] holds the number of (candidate, lag) checks evaluated and rejected by the stage
+def par_new_search_stats(dim):
+    return {dim_id: {stage: {'evaluated': 0, 'rejected': 0} for stage in SEARCH_STAGES} for dim_id in dim}
+
+# Add the rejections of a chunk, an (anchors, ndir, len(SEARCH_STAGES)) array, and the accepted pairs of
+# each direction to the counters. The checks evaluated by a stage are the ones not rejected before it.
+def par_count_stages(stats, dim, stage_order, rejections, pair_counts):
+    rejected = rejections.sum(axis=0)
+    accepted = pair_counts.sum(axis=(0, 2))
+    for dim_id in dim:
+        evaluated = int(accepted[dim_id] + rejected[dim_id].sum())
+        for stage in stage_order[dim_id]:
+            counters = stats[dim_id][SEARCH_STAGES[stage]]
+            counters['evaluated'] += evaluated
+            counters['rejected'] += int(rejected[dim_id, stage])
+            evaluated -= int(rejected[dim_id, stage])
+
+# Report of the filter stage counters of each direction, one line per stage
+def par_format_search_stats(stats):
+    lines = []
+    for dim_id, stages in stats.items():
+        lines.append(f"Direction {dim_id}:")
+        for stage, counters in stages.items():
+            rate = counters['rejected'] / counters['evaluated'] * 100 if counters['evaluated'] else 0.0
+            lines.append(f"  {stage:<8} rejected {counters['rejected']} of {counters['evaluated']} ({rate:.1f}%)")
+
+    return "\n".join(lines)
+
+# Main parallelized function, the anchors being a chunk of the points of data_vector.
+# With fill=False only pair_counts is written, with fill=True the pairs are written from pair_offsets.
+# The first pass also counts the checks rejected by each stage in rejections, unless it is empty.
 @cuda.jit
-def par_search_pairs_gen_kernel(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, pairs, pair_counts):
+def par_search_pairs_gen_kernel(anchors, data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order, rejections, pair_counts, pair_offsets, pairs, fill):
     idx = cuda.grid(1)
-    if idx < data_vector.shape[0]:
-        p = data_vector[idx]
-        point_id = p[0]
+    if idx < anchors.shape[0]:
+        p = anchors[idx]
         for dim_id in range(dim.size):
             for n in range(1, nlag[dim_id] + 1):
+                count = 0
                 for j in range(data_vector.shape[0]):
                     potential_pair = data_vector[j]
-                    potential_pair_id = potential_pair[0]
-                    if point_id == potential_pair_id:
+                    if p[0] == potential_pair[0]:
                         continue
-
-                    # Calculate azimuth and check tolerance
-                    cal_azimuth = par_calculate_azimuth_3d(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
-                    min_azimuth = (azm[dim_id] - azm_tol[dim_id] + 360) % 360
-                    max_azimuth = (azm[dim_id] + azm_tol[dim_id] + 360) % 360
-                    if not (min_azimuth <= cal_azimuth <= max_azimuth if min_azimuth < max_azimuth else cal_azimuth >= min_azimuth or cal_azimuth <= max_azimuth):
+                    stage = par_check_pair(p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order)
+                    if stage >= 0:
+                        if not fill and rejections.shape[0] > 0:
+                            rejections[idx, dim_id, stage] += 1
                         continue
 
-                    # Calculate dip and check tolerance
-                    cal_dip = par_calculate_dip_3d(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
-                    if cal_dip > dip[dim_id] + dip_tol[dim_id] or cal_dip < dip[dim_id] - dip_tol[dim_id]:
-                        continue
+                    # Add pair to the pairs array if within all tolerances
+                    if fill:
+                        pairs[pair_offsets[idx, dim_id, n] + count] = potential_pair[0]
+                    count += 1
 
-                    # Calculate horizontal bandwidth and check
-                    cal_hor_length_diff = par_distance_along_horizontal_bandwidth(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
-                    if abs(cal_hor_length_diff) > bandwh[dim_id]:
-                        continue
+                if not fill:
+                    pair_counts[idx, dim_id, n] = count
 
-                    # Calculate vertical bandwidth and check
-                    cal_ver_diff = par_distance_along_vertical_bandwidth(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
-                    if abs(cal_ver_diff) > bandwv[dim_id]:
-                        continue
+# Parallelized function visiting only the grid cells overlapped by the reachable box of each direction,
+# in two passes like par_search_pairs_gen_kernel
+@cuda.jit
+def par_search_pairs_gen_indexed_kernel(anchors, data_vector, order, cell_start, origin, cell_size, grid_shape, boxes, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order, rejections, pair_counts, pair_offsets, pairs, fill):
+    idx = cuda.grid(1)
+    if idx < anchors.shape[0]:
+        p = anchors[idx]
+        for dim_id in range(dim.size):
+            # Range of cells overlapped by the box, clipped to the grid
+            ix0 = max(int(floor((p[1] + boxes[dim_id, 0, 0] - origin[0]) / cell_size)), 0)
+            iy0 = max(int(floor((p[2] + boxes[dim_id, 0, 1] - origin[1]) / cell_size)), 0)
+            iz0 = max(int(floor((p[3] + boxes[dim_id, 0, 2] - origin[2]) / cell_size)), 0)
+            ix1 = min(int(floor((p[1] + boxes[dim_id, 1, 0] - origin[0]) / cell_size)), grid_shape[0] - 1)
+            iy1 = min(int(floor((p[2] + boxes[dim_id, 1, 1] - origin[1]) / cell_size)), grid_shape[1] - 1)
+            iz1 = min(int(floor((p[3] + boxes[dim_id, 1, 2] - origin[2]) / cell_size)), grid_shape[2] - 1)
+            if ix0 > ix1:
+                continue
 
-                    # Check within maximum lag tolerance
-                    distance_max_lag_tol = par_point_distance_to_shifted_plane(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) + lag_tol[dim_id], azm[dim_id], dip[dim_id])
-                    if distance_max_lag_tol > 0:
-                        continue
+            for n in range(1, nlag[dim_id] + 1):
+                count = 0
+                for iz in range(iz0, iz1 + 1):
+                    for iy in range(iy0, iy1 + 1):
+                        # Each row of cells along X is a contiguous slice of the sorted points
+                        row = grid_shape[0] * (iy + grid_shape[1] * iz)
+                        for k in range(cell_start[row + ix0], cell_start[row + ix1 + 1]):
+                            potential_pair = data_vector[order[k]]
+                            if p[0] == potential_pair[0]:
+                                continue
+                            stage = par_check_pair(p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order)
+                            if stage >= 0:
+                                if not fill and rejections.shape[0] > 0:
+                                    rejections[idx, dim_id, stage] += 1
+                                continue
 
-                    # Check within minimum lag tolerance
-                    distance_min_lag_tol = par_point_distance_to_shifted_plane(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) - lag_tol[dim_id], azm[dim_id], dip[dim_id])
-                    if distance_min_lag_tol < 0:
-                        continue
+                            # Add pair to the pairs array if within all tolerances
+                            if fill:
+                                pairs[pair_offsets[idx, dim_id, n] + count] = potential_pair[0]
+                            count += 1
 
-                    # Add pair to the pairs array if within all tolerances
-                    count = pair_counts[idx, dim_id, n]
-                    if count < MAX_PAIRS:
-                        pairs[idx, dim_id, n, count] = potential_pair_id
-                        pair_counts[idx, dim_id, n] += 1
+                if not fill:
+                    pair_counts[idx, dim_id, n] = count
+
+# Wrapper function to launch the kernel with chunking, yielding the pair counts and the paired point ids
+# of each chunk of points as soon as it is searched.
+# Each chunk runs the kernel twice: count the pairs of each (point, dim_id, n), then write them
+# at their offsets. The filter stages of each direction run in stage_order (see par_stage_order_array);
+# with stage_order='adaptive' the order is planned from the rejections of sample_size anchors spread
+# over the points, the most rejecting stage first (the time of each stage is not measurable inside
+# a GPU thread). With stats (see par_new_search_stats), the rejections of each stage are counted.
+def par_search_pairs_gen_chunks(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_chunks, use_index=True, stage_order=None, stats=None, sample_size=256):
+    # Build the spatial index once for the dataset, on the host
+    if use_index:
+        boxes = par_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+        index = par_build_grid_index(data_vector[:, 1:4], boxes)
+
+    ndir = len(dim)
+    max_nlag = max(nlag)
+    dim_ids = list(dim)
+    stage_order_host = par_stage_order_array(dim_ids, None if stage_order == 'adaptive' else stage_order)
 
-# Wrapper function to launch the kernel with chunking
-def par_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_chunks):
     dim = np.array(dim, dtype=np.int32)
     nlag = np.array(nlag, dtype=np.int32)
     lag = np.array(lag, dtype=np.float64)
@@ -89,10 +206,43 @@ def par_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, ban
     dip_tol = cuda.to_device(dip_tol)
     bandwv = cuda.to_device(bandwv)
 
+    # All the points are potential pairs of every chunk
+    data_all = cuda.to_device(np.ascontiguousarray(data_vector, dtype=np.float64))
+    if use_index:
+        order = cuda.to_device(index['order'])
+        cell_start = cuda.to_device(index['cell_start'])
+        origin = cuda.to_device(index['origin'])
+        grid_shape = cuda.to_device(index['shape'])
+        boxes = cuda.to_device(boxes)
+
+    # Launch the kernel on the anchors, in the first (count) or the second (fill) pass
+    def launch(anchors, stage_order_device, rejections, pair_counts, pair_offsets, pairs, fill):
+        threadsperblock = 256
+        blockspergrid = (anchors.shape[0] + (threadsperblock - 1)) // threadsperblock
+
+        if use_index:
+            par_search_pairs_gen_indexed_kernel[blockspergrid, threadsperblock](anchors, data_all, order, cell_start, origin, index['cell_size'], grid_shape, boxes, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order_device, rejections, pair_counts, pair_offsets, pairs, fill)
+        else:
+            par_search_pairs_gen_kernel[blockspergrid, threadsperblock](anchors, data_all, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, stage_order_device, rejections, pair_counts, pair_offsets, pairs, fill)
+
+    # Order the filter stages of each direction from the rejections of a sample of anchors
+    if stage_order == 'adaptive' and data_vector.shape[0] > 0:
+        sample_rows = np.unique(np.linspace(0, data_vector.shape[0] - 1, min(sample_size, data_vector.shape[0])).astype(np.int64))
+        sample = cuda.to_device(np.ascontiguousarray(data_vector[sample_rows]))
+        rejections = cuda.to_device(np.zeros((sample.shape[0], ndir, len(SEARCH_STAGES)), dtype=np.int64))
+        pair_counts = cuda.to_device(np.zeros((sample.shape[0], ndir, max_nlag + 1), dtype=np.int32))
+        launch(sample, cuda.to_device(stage_order_host), rejections, pair_counts, cuda.to_device(np.zeros((sample.shape[0], ndir, max_nlag + 1), dtype=np.int64)), cuda.device_array(1, dtype=np.int32), False)
+
+        sample_stats = par_new_search_stats(dim_ids)
+        par_count_stages(sample_stats, dim_ids, stage_order_host, rejections.copy_to_host(), pair_counts.copy_to_host())
+        def rejection_rate(dim_id, stage):
+            counters = sample_stats[dim_id][stage]
+            return counters['rejected'] / counters['evaluated'] if counters['evaluated'] else 0.0
+        stage_order_host = par_stage_order_array(dim_ids, {dim_id: sorted(SEARCH_STAGES, key=lambda stage: -rejection_rate(dim_id, stage)) for dim_id in dim_ids})
+    stage_order_device = cuda.to_device(stage_order_host)
+
     # Split data into chunks
     chunk_size = data_vector.shape[0] // num_chunks
-    pairs_host_total = []
-    pair_counts_host_total = []
 
     for chunk in range(num_chunks):
         start_idx = chunk * chunk_size
@@ -104,32 +254,31 @@ def par_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, ban
         data_chunk = np.ascontiguousarray(data_chunk)
         data_chunk = cuda.to_device(data_chunk)
 
-        pairs = cuda.device_array((data_chunk.shape[0], len(dim), max(nlag) + 1, MAX_PAIRS), dtype=np.int32)
-        pair_counts = cuda.device_array((data_chunk.shape[0], len(dim), max(nlag) + 1), dtype=np.int32)
-        
-        threadsperblock = 256
-        blockspergrid = (data_chunk.shape[0] + (threadsperblock - 1)) // threadsperblock
-        par_search_pairs_gen_kernel[blockspergrid, threadsperblock](data_chunk, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, pairs, pair_counts)
-        
-        # Copy back to host as CuPy arrays instead of NumPy arrays
-        pairs_host = np.asarray(pairs.copy_to_host())
-        pair_counts_host = np.asarray(pair_counts.copy_to_host())
-
-        pairs_host_total.append(pairs_host)
-        pair_counts_host_total.append(pair_counts_host)
-
-    print("trying to concat")
-    # Concatenate the lists to create final results as contiguous arrays using CuPy
-    pairs_host_total = np.concatenate(pairs_host_total, axis=0)
-    pair_counts_host_total = np.concatenate(pair_counts_host_total, axis=0)
-    print("done concat")
-    
-    # Extract non-zero pairs and their indices using NumPy
-    non_zero_pairs = []
-    indices = np.nonzero(pair_counts_host_total)
-    for i, j, k in zip(*indices):
-        count = pair_counts_host_total[i, j, k].item()
-        for c in range(count):
-            non_zero_pairs.append((i + 1, j, k, pairs_host_total[i, j, k, c]))
-    
-    return non_zero_pairs
\ No newline at end of file
+        # Rejections of each stage, only with stats
+        rejections_shape = (data_chunk.shape[0], ndir, len(SEARCH_STAGES)) if stats is not None else (0, ndir, len(SEARCH_STAGES))
+        rejections = cuda.to_device(np.zeros(rejections_shape, dtype=np.int64))
+
+        # First pass: number of pairs of each (point, dim_id, n), from zeroed counts
+        pair_counts = cuda.to_device(np.zeros((data_chunk.shape[0], ndir, max_nlag + 1), dtype=np.int32))
+        pair_offsets_host = np.zeros((data_chunk.shape[0], ndir, max_nlag + 1), dtype=np.int64)
+        launch(data_chunk, stage_order_device, rejections, pair_counts, cuda.to_device(pair_offsets_host), cuda.device_array(1, dtype=np.int32), False)
+        pair_counts_host = pair_counts.copy_to_host()
+        if stats is not None:
+            par_count_stages(stats, dim_ids, stage_order_host, rejections.copy_to_host(), pair_counts_host)
+
+        # Second pass: write the pairs of each (point, dim_id, n) from its offset in the chunk
+        num_pairs = int(pair_counts_host.sum())
+        pair_offsets_host.ravel()[1:] = np.cumsum(pair_counts_host.ravel())[:-1]
+        pairs = cuda.device_array(max(num_pairs, 1), dtype=np.int32)
+        launch(data_chunk, stage_order_device, rejections, pair_counts, cuda.to_device(pair_offsets_host), pairs, True)
+
+        yield pair_counts_host, pairs.copy_to_host()[:num_pairs]
+
+def par_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_chunks, use_index=True, stage_order=None, stats=None):
+    # The chunks are consecutive points, so their pairs follow each other in slot order:
+    # the offsets of each chunk are appended to the pair index as soon as it is searched
+    index = par_new_pair_index(data_vector.shape[0], len(dim), max(nlag) + 1)
+    for pair_counts_host, pairs_host in par_search_pairs_gen_chunks(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_chunks, use_index=use_index, stage_order=stage_order, stats=stats):
+        par_append_pair_chunk(index, pair_counts_host, pairs_host)
+
+    return par_finish_pair_index(index)
@@ -0,0 +1,128 @@
+import numpy as np
+from math import floor
+from numba import njit, prange
+from par_search_pairs_support import (
+    par_calculate_azimuth_3d,
+    par_calculate_dip_3d,
+    par_distance_along_horizontal_bandwidth,
+    par_distance_along_vertical_bandwidth,
+    par_point_distance_to_shifted_plane)
+from par_spatial_index import par_search_bounding_boxes, par_build_grid_index
+from par_pair_index import par_pair_index_from_counts
+
+# CPU versions of the CUDA device functions, compiled from the same Python source
+par_calculate_azimuth_3d_cpu = njit(par_calculate_azimuth_3d.py_func)
+par_calculate_dip_3d_cpu = njit(par_calculate_dip_3d.py_func)
+par_distance_along_horizontal_bandwidth_cpu = njit(par_distance_along_horizontal_bandwidth.py_func)
+par_distance_along_vertical_bandwidth_cpu = njit(par_distance_along_vertical_bandwidth.py_func)
+par_point_distance_to_shifted_plane_cpu = njit(par_point_distance_to_shifted_plane.py_func)
+
+# Check if potential_pair is paired with p in direction dim_id at lag n (same checks as par_check_pair)
+@njit
+def par_check_pair_cpu(p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+    if p[0] == potential_pair[0]:
+        return False
+
+    # Calculate azimuth and check tolerance
+    cal_azimuth = par_calculate_azimuth_3d_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
+    min_azimuth = (azm[dim_id] - azm_tol[dim_id] + 360) % 360
+    max_azimuth = (azm[dim_id] + azm_tol[dim_id] + 360) % 360
+    if not (min_azimuth <= cal_azimuth <= max_azimuth if min_azimuth < max_azimuth else cal_azimuth >= min_azimuth or cal_azimuth <= max_azimuth):
+        return False
+
+    # Calculate dip and check tolerance
+    cal_dip = par_calculate_dip_3d_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3])
+    if cal_dip > dip[dim_id] + dip_tol[dim_id] or cal_dip < dip[dim_id] - dip_tol[dim_id]:
+        return False
+
+    # Calculate horizontal bandwidth and check
+    cal_hor_length_diff = par_distance_along_horizontal_bandwidth_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
+    if abs(cal_hor_length_diff) > bandwh[dim_id]:
+        return False
+
+    # Calculate vertical bandwidth and check
+    cal_ver_diff = par_distance_along_vertical_bandwidth_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], azm[dim_id], dip[dim_id])
+    if abs(cal_ver_diff) > bandwv[dim_id]:
+        return False
+
+    # Check within maximum lag tolerance
+    distance_max_lag_tol = par_point_distance_to_shifted_plane_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) + lag_tol[dim_id], azm[dim_id], dip[dim_id])
+    if distance_max_lag_tol > 0:
+        return False
+
+    # Check within minimum lag tolerance
+    distance_min_lag_tol = par_point_distance_to_shifted_plane_cpu(p[1], p[2], p[3], potential_pair[1], potential_pair[2], potential_pair[3], (n * lag[dim_id]) - lag_tol[dim_id], azm[dim_id], dip[dim_id])
+    if distance_min_lag_tol < 0:
+        return False
+
+    return True
+
+# Parallelized function over the anchor points, mirroring par_search_pairs_gen_indexed_kernel.
+# With fill=False only pair_counts is written, with fill=True the pairs are written from pair_offsets.
+@njit(parallel=True)
+def par_search_pairs_gen_cpu_kernel(data_vector, order, cell_start, origin, cell_size, grid_shape, boxes, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, pair_counts, pair_offsets, pairs, fill):
+    for idx in prange(data_vector.shape[0]):
+        p = data_vector[idx]
+        for dim_id in range(dim.size):
+            # Range of cells overlapped by the box, clipped to the grid
+            ix0 = max(int(floor((p[1] + boxes[dim_id, 0, 0] - origin[0]) / cell_size)), 0)
+            iy0 = max(int(floor((p[2] + boxes[dim_id, 0, 1] - origin[1]) / cell_size)), 0)
+            iz0 = max(int(floor((p[3] + boxes[dim_id, 0, 2] - origin[2]) / cell_size)), 0)
+            ix1 = min(int(floor((p[1] + boxes[dim_id, 1, 0] - origin[0]) / cell_size)), grid_shape[0] - 1)
+            iy1 = min(int(floor((p[2] + boxes[dim_id, 1, 1] - origin[1]) / cell_size)), grid_shape[1] - 1)
+            iz1 = min(int(floor((p[3] + boxes[dim_id, 1, 2] - origin[2]) / cell_size)), grid_shape[2] - 1)
+            if ix0 > ix1:
+                continue
+
+            for n in range(1, nlag[dim_id] + 1):
+                count = 0
+                for iz in range(iz0, iz1 + 1):
+                    for iy in range(iy0, iy1 + 1):
+                        # Each row of cells along X is a contiguous slice of the sorted points
+                        row = grid_shape[0] * (iy + grid_shape[1] * iz)
+                        for k in range(cell_start[row + ix0], cell_start[row + ix1 + 1]):
+                            potential_pair = data_vector[order[k]]
+                            if not par_check_pair_cpu(p, potential_pair, dim_id, n, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+                                continue
+
+                            if fill:
+                                pairs[pair_offsets[idx, dim_id, n] + count] = potential_pair[0]
+                            count += 1
+
+                if not fill:
+                    pair_counts[idx, dim_id, n] = count
+
+# Wrapper function running the CPU kernel in two passes: count the pairs, then write them.
+# Returns the CSR pair index (see par_pair_index_from_counts).
+def par_search_pairs_gen_cpu(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+    data_vector = np.ascontiguousarray(data_vector, dtype=np.float64)
+
+    # Build the spatial index once for the dataset
+    boxes = par_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+    index = par_build_grid_index(data_vector[:, 1:4], boxes)
+
+    dim = np.array(dim, dtype=np.int32)
+    nlag = np.array(nlag, dtype=np.int32)
+    lag = np.array(lag, dtype=np.float64)
+    lag_tol = np.array(lag_tol, dtype=np.float64)
+    azm = np.array(azm, dtype=np.float64)
+    azm_tol = np.array(azm_tol, dtype=np.float64)
+    bandwh = np.array(bandwh, dtype=np.float64)
+    dip = np.array(dip, dtype=np.float64)
+    dip_tol = np.array(dip_tol, dtype=np.float64)
+    bandwv = np.array(bandwv, dtype=np.float64)
+
+    args = (data_vector, index['order'], index['cell_start'], index['origin'], index['cell_size'], index['shape'], boxes, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    # First pass: number of pairs of each (point, dim_id, n)
+    pair_counts = np.zeros((data_vector.shape[0], len(dim), max(nlag) + 1), dtype=np.int64)
+    pair_offsets = np.zeros_like(pair_counts)
+    par_search_pairs_gen_cpu_kernel(*args, pair_counts, pair_offsets, np.zeros(0, dtype=np.int32), False)
+
+    # Second pass: write the pairs of each (point, dim_id, n) from its offset
+    pair_offsets.ravel()[1:] = np.cumsum(pair_counts.ravel())[:-1]
+    pairs = np.zeros(pair_counts.sum(), dtype=np.int32)
+    par_search_pairs_gen_cpu_kernel(*args, pair_counts, pair_offsets, pairs, True)
+
+    # The pairs are written in slot order, which is the CSR pair index
+    return par_pair_index_from_counts(pair_counts, pairs)
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Maximum number of grid cells per point, limits the memory used by the cell table
+MAX_CELLS_PER_POINT = 8
+
+def par_direction_vector(azimuth, dip):
+    """
+    Calculate the unit direction vector defined by azimuth and dip (in degrees), on the host.
+    """
+    azimuth_rad = np.radians(azimuth)
+    dip_rad = np.radians(dip)
+
+    return np.array([np.cos(dip_rad) * np.cos(azimuth_rad), np.cos(dip_rad) * np.sin(azimuth_rad), np.sin(dip_rad)])
+
+def par_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv):
+    """
+    Calculate, for each direction, the axis-aligned box (relative to the anchor point)
+    that contains every point which can be paired in that direction.
+    Returns an array of shape (ndir, 2, 3) holding the lower and upper corners.
+    """
+    boxes = np.zeros((len(dim), 2, 3))
+    for dim_id in dim:
+        direction_vector = par_direction_vector(azm[dim_id], dip[dim_id])
+
+        # The projection onto the direction lies between the first and the last lag window
+        lag_ends = np.array([lag[dim_id], nlag[dim_id] * lag[dim_id]])
+        min_projection = lag_ends.min() - lag_tol[dim_id]
+        max_projection = lag_ends.max() + lag_tol[dim_id]
+
+        # The bandwidths bound the distance perpendicular to the direction
+        radius = np.sqrt(bandwh[dim_id]**2 + bandwv[dim_id]**2)
+
+        # Small margin so the floating point rounding of the exact checks is never pruned
+        margin = radius + 1e-6 * (abs(min_projection) + abs(max_projection) + radius + 1.0)
+
+        ends = np.array([min_projection * direction_vector, max_projection * direction_vector])
+        boxes[dim_id, 0] = ends.min(axis=0) - margin
+        boxes[dim_id, 1] = ends.max(axis=0) + margin
+
+    return boxes
+
+def par_build_grid_index(coords, boxes):
+    """
+    Bucket the points into a regular grid of cells. The cell size follows the smallest
+    extent of the search boxes, and is enlarged when needed to keep at most
+    MAX_CELLS_PER_POINT cells per point.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    origin = coords.min(axis=0)
+    extent = coords.max(axis=0) - origin
+
+    # Half the thinnest side of the search boxes
+    box_sides = (boxes[:, 1] - boxes[:, 0]).ravel()
+    cell_size = max(box_sides[box_sides > 0].min() / 2, 1e-9)
+
+    max_cells = MAX_CELLS_PER_POINT * coords.shape[0]
+    while np.prod(np.floor(extent / cell_size) + 1) > max_cells:
+        cell_size *= 2
+
+    # Linear cell id with X varying fastest, so that a row of cells along X is contiguous
+    shape = (np.floor(extent / cell_size) + 1).astype(np.int64)
+    cell = np.minimum(np.floor((coords - origin) / cell_size).astype(np.int64), shape - 1)
+    cell_id = cell[:, 0] + shape[0] * (cell[:, 1] + shape[1] * cell[:, 2])
+
+    # Sort the points by cell, keeping the row order inside each cell
+    order = np.argsort(cell_id, kind='stable')
+    cell_start = np.zeros(np.prod(shape) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cell_id, minlength=np.prod(shape)), out=cell_start[1:])
+
+    return {
+        'origin': origin,
+        'cell_size': cell_size,
+        'shape': shape,
+        'order': order,
+        'cell_start': cell_start,
+    }
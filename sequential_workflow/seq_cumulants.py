@@ -1,6 +1,10 @@
 import pandas as pd
 import itertools
+import functools
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from seq_pair_index import seq_load_pair_index, seq_pair_index_to_pairs
 
 def center_grades(data_file):
     # Load the data
@@ -19,6 +23,18 @@ def associate_grade(df_data, pairs_file):
     # Add the point_id column as the first column
     df_data.insert(0, 'point_id', range(1, len(df_data) + 1))
 
+    # Pair index (memory-mapped .pairs file, or already loaded): the values are read at the point rows
+    if isinstance(pairs_file, dict) or str(pairs_file).endswith('.pairs'):
+        index = pairs_file if isinstance(pairs_file, dict) else seq_load_pair_index(pairs_file)
+        pairs = seq_pair_index_to_pairs(index)
+        grade = df_data['GRADE'].to_numpy()
+
+        df_pairs = pd.DataFrame(pairs, columns=["point_id", "dim_id", "n", "paired_point_id"])
+        df_pairs['point_id_value'] = grade[pairs[:, 0] - 1]
+        df_pairs['paired_point_id_value'] = grade[pairs[:, 3] - 1]
+
+        return df_pairs
+
     # Load the JSON pairs data into a DataFrame
     df_pairs = pd.read_json(pairs_file)
 
@@ -35,51 +51,116 @@ def associate_grade(df_data, pairs_file):
     return df_pairs
 
 
-def compute_3rd_order_cumulant(df_pairs, num_chunks=4):
-    def process_chunk(chunk, df_pairs):
-        # Merge for direction 0
-        result = chunk.merge(
-            df_pairs[df_pairs['dim_id'] == 0], 
-            left_on='dir_0_nlag', 
-            right_on='n', 
-            how='left'
-        )
-        result = result.rename(columns={
-            'point_id': 'point_id_dir_0',
-            'paired_point_id': 'paired_point_id_dir_0',
-            'paired_point_id_value': 'paired_point_id_value_dir_0'
-        })
-
-        # Merge for direction 1
-        result = result.merge(
-            df_pairs[df_pairs['dim_id'] == 1], 
-            left_on='dir_1_nlag', 
-            right_on='n', 
-            how='left',
-            suffixes=('', '_dir_1')
-        )
-        result = result.rename(columns={
-            'point_id': 'point_id_dir_1',
-            'paired_point_id': 'paired_point_id_dir_1',
-            'paired_point_id_value': 'paired_point_id_value_dir_1'
-        })
-
-        # Filter rows where all point_id_dir_0 and point_id_dir_1 match
-        result = result.dropna(subset=['point_id_dir_0', 'point_id_dir_1'])
-        result = result[result['point_id_dir_0'] == result['point_id_dir_1']]
-
-        # Select final columns
-        final_columns = ['dir_0_nlag', 'dir_1_nlag', 'point_id_value'] + [
-            'paired_point_id_dir_0', 'paired_point_id_value_dir_0',
-            'paired_point_id_dir_1', 'paired_point_id_value_dir_1'
-        ]
-        result = result[final_columns]
-
-        # Add new column 'E' as the product of point_id_value and the paired_point_id_values
-        result['E'] = result['point_id_value'] * result['paired_point_id_value_dir_0'] * result['paired_point_id_value_dir_1']
-
-        return result
-
+# State of each worker process, set once by init_cumulant_worker
+worker_state = {}
+
+
+def share_pairs(df_pairs):
+    # Place of each column of the pair table in shared memory, aligned on 8 bytes
+    layout, size = [], 0
+    for column in df_pairs.columns:
+        values = df_pairs[column].to_numpy()
+        layout.append((column, values.dtype.str, size))
+        size += -(-values.nbytes // 8) * 8
+
+    # Copy the pair table once into shared memory
+    shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    for column, dtype, offset in layout:
+        np.ndarray(len(df_pairs), dtype=dtype, buffer=shm.buf, offset=offset)[:] = df_pairs[column].to_numpy()
+
+    return shm, layout
+
+
+def init_cumulant_worker(shm_name, layout, num_rows):
+    # Attach the worker process to the shared pair table, read-only
+    shm = shared_memory.SharedMemory(name=shm_name)
+    columns = {}
+    for column, dtype, offset in layout:
+        values = np.ndarray(num_rows, dtype=dtype, buffer=shm.buf, offset=offset)
+        values.flags.writeable = False
+        columns[column] = values
+
+    worker_state['shm'] = shm
+    worker_state['df_pairs'] = pd.DataFrame(columns, copy=False)
+
+
+def process_chunk_worker(process, chunk):
+    # Process a chunk in a worker process, with the shared pair table
+    return process(chunk, worker_state['df_pairs'])
+
+
+def map_chunks(process, chunks, df_pairs, num_workers=None):
+    # Process the chunks one after another, or with a pool of num_workers processes sharing the pair
+    # table through shared memory instead of pickling it with each chunk. The results are yielded in
+    # the order of the chunks, so they are reduced in the same order whatever the number of workers
+    if num_workers is None:
+        for chunk in chunks:
+            yield process(chunk, df_pairs)
+        return
+
+    shm, layout = share_pairs(df_pairs)
+    try:
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=init_cumulant_worker, initargs=(shm.name, layout, len(df_pairs))) as executor:
+            # map returns the results in the order of the chunks
+            yield from executor.map(process_chunk_worker, itertools.repeat(process), chunks)
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def process_3rd_order_chunk(chunk, df_pairs):
+    # Merge for direction 0
+    result = chunk.merge(
+        df_pairs[df_pairs['dim_id'] == 0], 
+        left_on='dir_0_nlag', 
+        right_on='n', 
+        how='left'
+    )
+    result = result.rename(columns={
+        'point_id': 'point_id_dir_0',
+        'paired_point_id': 'paired_point_id_dir_0',
+        'paired_point_id_value': 'paired_point_id_value_dir_0'
+    })
+
+    # Merge for direction 1
+    result = result.merge(
+        df_pairs[df_pairs['dim_id'] == 1], 
+        left_on='dir_1_nlag', 
+        right_on='n', 
+        how='left',
+        suffixes=('', '_dir_1')
+    )
+    result = result.rename(columns={
+        'point_id': 'point_id_dir_1',
+        'paired_point_id': 'paired_point_id_dir_1',
+        'paired_point_id_value': 'paired_point_id_value_dir_1'
+    })
+
+    # Filter rows where all point_id_dir_0 and point_id_dir_1 match
+    result = result.dropna(subset=['point_id_dir_0', 'point_id_dir_1'])
+    result = result[result['point_id_dir_0'] == result['point_id_dir_1']]
+
+    # Select final columns
+    final_columns = ['dir_0_nlag', 'dir_1_nlag', 'point_id_value'] + [
+        'paired_point_id_dir_0', 'paired_point_id_value_dir_0',
+        'paired_point_id_dir_1', 'paired_point_id_value_dir_1'
+    ]
+    result = result[final_columns]
+
+    # Add new column 'E' as the product of point_id_value and the paired_point_id_values
+    result['E'] = result['point_id_value'] * result['paired_point_id_value_dir_0'] * result['paired_point_id_value_dir_1']
+
+    return result
+
+
+def reduce_3rd_order_chunk(chunk, df_pairs):
+    # Average E over the triplets of each (n0, n1) of the chunk, each (n0, n1) being in a single chunk
+    chunk_result = process_3rd_order_chunk(chunk, df_pairs)
+
+    return chunk_result.groupby(['dir_0_nlag', 'dir_1_nlag'])['E'].mean().reset_index()
+
+
+def compute_3rd_order_cumulant(df_pairs, num_chunks=4, num_workers=None):
     # Determine the maximum values of n for each dim_id (0 and 1)
     max_n_dim_0 = df_pairs[df_pairs['dim_id'] == 0]['n'].max()
     max_n_dim_1 = df_pairs[df_pairs['dim_id'] == 1]['n'].max()
@@ -96,80 +177,208 @@ def compute_3rd_order_cumulant(df_pairs, num_chunks=4):
     # Create DataFrame with the generated combinations
     df_generated = pd.DataFrame(combinations, columns=columns)
 
-    # Split the df_generated into chunks
-    chunks = np.array_split(df_generated, num_chunks)
+    # Split the df_generated into chunks of rows
+    chunks = [df_generated.iloc[rows] for rows in np.array_split(np.arange(len(df_generated)), num_chunks)]
 
-    # Process each chunk sequentially and store the results
+    # Process each chunk, sequentially or with a pool of processes, and store its averages
     results = []
     total_chunks = len(chunks)  # Get the total number of chunks
 
-    for i, chunk in enumerate(chunks):
+    for i, chunk_result in enumerate(map_chunks(reduce_3rd_order_chunk, chunks, df_pairs, num_workers)):
         # Calculate and print the percentage of completion
         percent_complete = (i + 1) / total_chunks * 100
         print(f"Processing chunk {i + 1}/{total_chunks} ({percent_complete:.2f}% complete)")
 
-        # Process the chunk and store the result
-        chunk_result = process_chunk(chunk, df_pairs)
         results.append(chunk_result)
 
-
-    # Concatenate all results
-    concatenated_result = pd.concat(results)
-
-    # Group by dir_0_nlag and dir_1_nlag columns and average E
-    final_result = concatenated_result.groupby(columns)['E'].mean().reset_index()
+    # Concatenate the averages of the chunks, in the order of the lags
+    final_result = pd.concat(results, ignore_index=True)
     final_result = final_result.rename(columns={'E': 'k_3'})
 
     return final_result
 
 
-def compute_4th_order_cumulant(df_pairs, num_chunks):
-    def process_chunk(chunk, df_pairs):
-        # Merge for direction 0
-        merged_dir_0 = chunk.merge(
-            df_pairs[df_pairs['dim_id'] == 0], 
-            left_on='dir_0_nlag', 
-            right_on='n', 
-            how='left'
-        ).rename(columns={
-            'point_id': 'point_id_dir_0',
-            'paired_point_id': 'paired_point_id_dir_0',
-            'paired_point_id_value': 'paired_point_id_value_dir_0'
-        })
-
-        # Merge for direction 1
-        merged_dir_1 = merged_dir_0.merge(
-            df_pairs[df_pairs['dim_id'] == 1], 
-            left_on='dir_1_nlag', 
-            right_on='n', 
-            how='left',
-            suffixes=('', '_dir_1')
-        ).rename(columns={
-            'point_id': 'point_id_dir_1',
-            'paired_point_id': 'paired_point_id_dir_1',
-            'paired_point_id_value': 'paired_point_id_value_dir_1'
-        })
-
-        # Merge for direction 2
-        merged_result = merged_dir_1.merge(
-            df_pairs[df_pairs['dim_id'] == 2], 
-            left_on='dir_2_nlag', 
-            right_on='n', 
-            how='left',
-            suffixes=('', '_dir_2')
-        ).rename(columns={
-            'point_id': 'point_id_dir_2',
-            'paired_point_id': 'paired_point_id_dir_2',
-            'paired_point_id_value': 'paired_point_id_value_dir_2'
-        })
-
-        # Filter rows where all point_id_dir_0, point_id_dir_1, and point_id_dir_2 match
-        merged_result = merged_result.dropna(subset=['point_id_dir_0', 'point_id_dir_1', 'point_id_dir_2'])
-        merged_result = merged_result[(merged_result['point_id_dir_0'] == merged_result['point_id_dir_1']) & 
-                                      (merged_result['point_id_dir_1'] == merged_result['point_id_dir_2'])]
-
-        return merged_result
+def lag_matrices(df_pairs, dim_id, num_points, num_lags):
+    # Pairs of the direction
+    pairs = df_pairs[df_pairs['dim_id'] == dim_id]
+
+    # Slot of each pair in a (num_points, num_lags) point x lag matrix
+    slot = (pairs['point_id'].to_numpy(dtype=np.int64) - 1) * num_lags + pairs['n'].to_numpy(dtype=np.int64)
+
+    # Sum of the paired grades and number of pairs of each point at each lag
+    sums = np.bincount(slot, weights=pairs['paired_point_id_value'].to_numpy(dtype=np.float64), minlength=num_points * num_lags).reshape(num_points, num_lags)
+    counts = np.bincount(slot, minlength=num_points * num_lags).reshape(num_points, num_lags).astype(np.float64)
+
+    return sums, counts
+
+
+def point_grades(df_pairs, num_points):
+    # Grade of each point having pairs, read from its pairs
+    grade = np.zeros(num_points)
+    grade[df_pairs['point_id'].to_numpy(dtype=np.int64) - 1] = df_pairs['point_id_value'].to_numpy(dtype=np.float64)
+
+    return grade
+
+
+def second_order_moments(df_pairs):
+    # Lookup table of the second-order moments of every lag vector, computed once from the pairs.
+    # The values of a quadruplet are numbered 0: Z(u), 1: Z(u+h1), 2: Z(u+h2), 3: Z(u+h3), with h1, h2
+    # and h3 the lags of directions 0, 1 and 2:
+    #   '01', '02', '03': mean of Z(u)⋅Z(u+h) over the pairs of the direction at each lag n
+    #   '12', '13', '23': mean of Z(u+h)⋅Z(u+h') over the pairs of a same point in the two directions,
+    #                     at each lag vector (n, n')
+    num_points = int(df_pairs['point_id'].max()) if len(df_pairs) else 0
+    num_lags = int(df_pairs['n'].max()) + 1 if len(df_pairs) else 1
+
+    grade = point_grades(df_pairs, num_points)
+    matrices = [lag_matrices(df_pairs, dim_id, num_points, num_lags) for dim_id in range(3)]
+
+    table = {}
+    for first in range(4):
+        for second in range(first + 1, 4):
+            sums, counts = matrices[second - 1]
+            if first == 0:
+                # Pairs of a point and its pairs in one direction
+                product_sums, product_counts = grade @ sums, counts.sum(axis=0)
+            else:
+                # Pairs of a point in two directions
+                first_sums, first_counts = matrices[first - 1]
+                product_sums, product_counts = first_sums.T @ sums, first_counts.T @ counts
+            name = f"{first}{second}"
+            table[name] = np.divide(product_sums, product_counts, out=np.zeros_like(product_sums), where=product_counts > 0)
+            table[f"count_{name}"] = product_counts
+
+    return table
+
+
+def save_second_order_moments(table, file_name):
+    # Save the lookup table to a .npz file
+    np.savez(file_name, **table)
+
+
+def load_second_order_moments(file_name):
+    # Load a lookup table saved by save_second_order_moments
+    with np.load(file_name) as data:
+        return {name: data[name] for name in data.files}
+
+
+def lag_correction_terms(moments, dir_0_nlag, dir_1_nlag, dir_2_nlag):
+    # E_1 + E_2 + E_3 of each (n0, n1, n2), read from the second-order moments of its lag vectors
+    # E[Z(u),Z(u + h1)] ⋅ E[Z(u + h2),Z(u + h3)]
+    e_1 = moments['01'][dir_0_nlag] * moments['23'][dir_1_nlag, dir_2_nlag]
 
+    # E[Z(u),Z(u + h2)] ⋅ E[Z(u + h1),Z(u + h3)]
+    e_2 = moments['02'][dir_1_nlag] * moments['13'][dir_0_nlag, dir_2_nlag]
+
+    # E[Z(u),Z(u + h3)] ⋅ E[Z(u+ h1),Z(u + h2)]
+    e_3 = moments['03'][dir_2_nlag] * moments['12'][dir_0_nlag, dir_1_nlag]
+
+    return e_1 + e_2 + e_3
+
+
+def compute_3rd_order_cumulant_matrix(df_pairs):
+    # k3(n0, n1) is the mean of z(u)*z(u+h0)*z(u+h1) over the triplets of a point u, a pair of u in
+    # direction 0 at lag n0 and a pair of u in direction 1 at lag n1, i.e.
+    #   sum_u z(u)*S0[u, n0]*S1[u, n1] / sum_u C0[u, n0]*C1[u, n1]
+    # with S_d and C_d the sums of the paired grades and the numbers of pairs of each point at each
+    # lag of direction d. Both maps are matrix products, so the triplets are never materialized.
+    num_points = int(df_pairs['point_id'].max()) if len(df_pairs) else 0
+    num_lags = int(df_pairs['n'].max()) + 1 if len(df_pairs) else 1
+
+    grade = point_grades(df_pairs, num_points)
+    sums_0, counts_0 = lag_matrices(df_pairs, 0, num_points, num_lags)
+    sums_1, counts_1 = lag_matrices(df_pairs, 1, num_points, num_lags)
+
+    # Sums and numbers of the triplets of every (n0, n1)
+    sum_map = sums_0.T @ (grade[:, None] * sums_1)
+    count_map = counts_0.T @ counts_1
+
+    # Average over the (n0, n1) having triplets, in the order of the lags
+    dir_0_nlag, dir_1_nlag = np.nonzero(count_map)
+    final_result = pd.DataFrame({
+        'dir_0_nlag': dir_0_nlag.astype(np.int64),
+        'dir_1_nlag': dir_1_nlag.astype(np.int64),
+        'k_3': sum_map[dir_0_nlag, dir_1_nlag] / count_map[dir_0_nlag, dir_1_nlag],
+    })
+
+    return final_result
+
+
+def process_4th_order_chunk(chunk, df_pairs):
+    # Merge for direction 0
+    merged_dir_0 = chunk.merge(
+        df_pairs[df_pairs['dim_id'] == 0], 
+        left_on='dir_0_nlag', 
+        right_on='n', 
+        how='left'
+    ).rename(columns={
+        'point_id': 'point_id_dir_0',
+        'paired_point_id': 'paired_point_id_dir_0',
+        'paired_point_id_value': 'paired_point_id_value_dir_0'
+    })
+
+    # Merge for direction 1
+    merged_dir_1 = merged_dir_0.merge(
+        df_pairs[df_pairs['dim_id'] == 1], 
+        left_on='dir_1_nlag', 
+        right_on='n', 
+        how='left',
+        suffixes=('', '_dir_1')
+    ).rename(columns={
+        'point_id': 'point_id_dir_1',
+        'paired_point_id': 'paired_point_id_dir_1',
+        'paired_point_id_value': 'paired_point_id_value_dir_1'
+    })
+
+    # Merge for direction 2
+    merged_result = merged_dir_1.merge(
+        df_pairs[df_pairs['dim_id'] == 2], 
+        left_on='dir_2_nlag', 
+        right_on='n', 
+        how='left',
+        suffixes=('', '_dir_2')
+    ).rename(columns={
+        'point_id': 'point_id_dir_2',
+        'paired_point_id': 'paired_point_id_dir_2',
+        'paired_point_id_value': 'paired_point_id_value_dir_2'
+    })
+
+    # Filter rows where all point_id_dir_0, point_id_dir_1, and point_id_dir_2 match
+    merged_result = merged_result.dropna(subset=['point_id_dir_0', 'point_id_dir_1', 'point_id_dir_2'])
+    merged_result = merged_result[(merged_result['point_id_dir_0'] == merged_result['point_id_dir_1']) & 
+                                  (merged_result['point_id_dir_1'] == merged_result['point_id_dir_2'])]
+
+    return merged_result
+
+
+# Values of a quadruplet and pairs of values of the products of the terms E_1, E_2 and E_3
+QUADRUPLET_VALUE_COLUMNS = ['point_id_value', 'paired_point_id_value_dir_0', 'paired_point_id_value_dir_1', 'paired_point_id_value_dir_2']
+QUADRUPLET_PRODUCTS = {
+    '01': (0, 1), '23': (2, 3),
+    '02': (0, 2), '13': (1, 3),
+    '03': (0, 3), '12': (1, 2),
+}
+
+
+def reduce_4th_order_chunk(chunk, df_pairs, map_shape, correction='global'):
+    # Sums of each (n0, n1, n2) of the quadruplets of the chunk: number of quadruplets, sum of
+    # Z(u)⋅Z(u+h1)⋅Z(u+h2)⋅Z(u+h3) and, with the global correction, sums of the products of two values
+    chunk_result = process_4th_order_chunk(chunk, df_pairs)
+    slot = np.ravel_multi_index(tuple(chunk_result[column].to_numpy(dtype=np.int64) for column in ['dir_0_nlag', 'dir_1_nlag', 'dir_2_nlag']), map_shape)
+    values = [chunk_result[column].to_numpy(dtype=np.float64) for column in QUADRUPLET_VALUE_COLUMNS]
+    size = int(np.prod(map_shape))
+
+    count = np.bincount(slot, minlength=size).reshape(map_shape)
+    sum_e_0 = np.bincount(slot, weights=values[0] * values[1] * values[2] * values[3], minlength=size).reshape(map_shape)
+    sum_products = {}
+    if correction == 'global':
+        for name, (first, second) in QUADRUPLET_PRODUCTS.items():
+            sum_products[name] = np.bincount(slot, weights=values[first] * values[second], minlength=size).reshape(map_shape)
+
+    return count, sum_e_0, sum_products
+
+
+def compute_4th_order_cumulant(df_pairs, num_chunks, correction='global', moments=None, num_workers=None):
     # Determine the maximum values of n for each dim_id
     max_n_dim_0 = df_pairs[df_pairs['dim_id'] == 0]['n'].max()
     max_n_dim_1 = df_pairs[df_pairs['dim_id'] == 1]['n'].max()
@@ -187,51 +396,113 @@ def compute_4th_order_cumulant(df_pairs, num_chunks):
     # Create DataFrame with the generated combinations
     df_generated = pd.DataFrame(combinations, columns=columns)
 
-    # Split the df_generated into chunks
-    chunks = np.array_split(df_generated, num_chunks)
+    # Split the df_generated into chunks of rows
+    chunks = [df_generated.iloc[rows] for rows in np.array_split(np.arange(len(df_generated)), num_chunks)]
+
+    # Running sums of each (n0, n1, n2): number of quadruplets, sum of Z(u)⋅Z(u+h1)⋅Z(u+h2)⋅Z(u+h3)
+    # and sums of the products of two values of the terms E_1, E_2 and E_3
+    map_shape = (nlag_dir[0] + 1, nlag_dir[1] + 1, nlag_dir[2] + 1)
+    count = np.zeros(map_shape)
+    sum_e_0 = np.zeros(map_shape)
+    sum_products = {name: np.zeros(map_shape) for name in QUADRUPLET_PRODUCTS}
 
-    # Process each chunk sequentially and store the results
-    results = []
     total_chunks = len(chunks)  # Get the total number of chunks
 
-    for i, chunk in enumerate(chunks):
+    # Process each chunk, sequentially or with a pool of processes, and add its sums to the running
+    # sums in the order of the chunks
+    process = functools.partial(reduce_4th_order_chunk, map_shape=map_shape, correction=correction)
+    for i, (chunk_count, chunk_sum_e_0, chunk_sum_products) in enumerate(map_chunks(process, chunks, df_pairs, num_workers)):
         # Calculate and print the percentage of completion
         percent_complete = (i + 1) / total_chunks * 100
         print(f"Processing chunk {i + 1}/{total_chunks} ({percent_complete:.2f}% complete)")
 
-        # Process the chunk and store the result
-        chunk_result = process_chunk(chunk, df_pairs)
-        results.append(chunk_result)
-
-    # Concatenate all results
-    concatenated_result = pd.concat(results)
+        count += chunk_count
+        sum_e_0 += chunk_sum_e_0
+        for name, sums in chunk_sum_products.items():
+            sum_products[name] += sums
 
-    # Now compute the following cumulant-related calculations after chunking and concatenation:
+    dir_0_nlag, dir_1_nlag, dir_2_nlag = np.nonzero(count)
+    if correction == 'global':
+        # Means over all the quadruplets of the products of two values
+        total_count = count.sum()
+        mean_products = {name: sums.sum() / total_count for name, sums in sum_products.items()}
 
-    # Compute mu_4 = E[Z(u)⋅Z(u+h1)⋅Z(u+h2)⋅Z(u+h3)]
-    concatenated_result['E_0'] = (concatenated_result['point_id_value'] * 
-                                  concatenated_result['paired_point_id_value_dir_0'] * 
-                                  concatenated_result['paired_point_id_value_dir_1'] * 
-                                  concatenated_result['paired_point_id_value_dir_2'])
+        # Compute E[Z(u),Z(u + h1)] ⋅ E[Z(u + h2),Z(u + h3)]
+        e_1 = mean_products['01'] * mean_products['23']
 
-    # Compute E[Z(u),Z(u + h1)] ⋅ E[Z(u + h2),Z(u + h3)]
-    concatenated_result['E_1'] = (concatenated_result['point_id_value'] * concatenated_result['paired_point_id_value_dir_0']).mean() * \
-                                 (concatenated_result['paired_point_id_value_dir_1'] * concatenated_result['paired_point_id_value_dir_2']).mean()
+        # Compute E[Z(u),Z(u + h2)] ⋅ E[Z(u + h1),Z(u + h3)]
+        e_2 = mean_products['02'] * mean_products['13']
 
-    # Compute E[Z(u),Z(u + h2)] ⋅ E[Z(u + h1),Z(u + h3)]
-    concatenated_result['E_2'] = (concatenated_result['point_id_value'] * concatenated_result['paired_point_id_value_dir_1']).mean() * \
-                                 (concatenated_result['paired_point_id_value_dir_0'] * concatenated_result['paired_point_id_value_dir_2']).mean()
+        # Compute E[Z(u),Z(u + h3)] ⋅ E[Z(u+ h1),Z(u + h2)]
+        e_3 = mean_products['03'] * mean_products['12']
 
-    # Compute E[Z(u),Z(u + h3)] ⋅ E[Z(u+ h1),Z(u + h2)]
-    concatenated_result['E_3'] = (concatenated_result['point_id_value'] * concatenated_result['paired_point_id_value_dir_2']).mean() * \
-                                 (concatenated_result['paired_point_id_value_dir_0'] * concatenated_result['paired_point_id_value_dir_1']).mean()
+        correction_terms = e_1 + e_2 + e_3
+    else:
+        # Second-order moments of the lag vectors of each (n0, n1, n2), from the lookup table
+        correction_terms = lag_correction_terms(moments if moments is not None else second_order_moments(df_pairs), dir_0_nlag, dir_1_nlag, dir_2_nlag)
 
-    # Compute the fourth-order cumulant: 
+    # Compute the fourth-order cumulant of each (n0, n1, n2) having quadruplets:
     # mu_4 - (E_1 + E_2 + E_3)
-    concatenated_result['k_4'] = concatenated_result['E_0'] - (concatenated_result['E_1'] + concatenated_result['E_2'] + concatenated_result['E_3'])
-
-    # Group by dir_0_nlag, dir_1_nlag, and dir_2_nlag columns and average the cumulant
-    final_result = concatenated_result.groupby(columns)['k_4'].mean().reset_index()
+    final_result = pd.DataFrame({
+        'dir_0_nlag': dir_0_nlag.astype(np.int64),
+        'dir_1_nlag': dir_1_nlag.astype(np.int64),
+        'dir_2_nlag': dir_2_nlag.astype(np.int64),
+        'k_4': sum_e_0[dir_0_nlag, dir_1_nlag, dir_2_nlag] / count[dir_0_nlag, dir_1_nlag, dir_2_nlag] - correction_terms,
+    })
 
     # Return the final cumulative result
-    return final_result
\ No newline at end of file
+    return final_result
+
+
+def compute_4th_order_cumulant_matrix(df_pairs, block_size=4096, correction='global', moments=None):
+    # The sum over the quadruplets of a point u and its pairs in directions 0, 1 and 2 at lags
+    # (n0, n1, n2) factorizes per point: sum z(u)*z(u+h1)*z(u+h2)*z(u+h3) = z(u)*S0[u, n0]*S1[u, n1]*S2[u, n2],
+    # with S_d and C_d the sums of the paired grades and the numbers of pairs of each point at each
+    # lag of direction d. The mu_4 and count maps are einsum contractions over blocks of points.
+    num_points = int(df_pairs['point_id'].max()) if len(df_pairs) else 0
+    num_lags = int(df_pairs['n'].max()) + 1 if len(df_pairs) else 1
+
+    grade = point_grades(df_pairs, num_points)
+    sums_0, counts_0 = lag_matrices(df_pairs, 0, num_points, num_lags)
+    sums_1, counts_1 = lag_matrices(df_pairs, 1, num_points, num_lags)
+    sums_2, counts_2 = lag_matrices(df_pairs, 2, num_points, num_lags)
+
+    # Sums of Z(u)⋅Z(u+h1)⋅Z(u+h2)⋅Z(u+h3) and numbers of the quadruplets of every (n0, n1, n2)
+    sum_e_0 = np.zeros((num_lags, num_lags, num_lags))
+    count = np.zeros((num_lags, num_lags, num_lags))
+    for start in range(0, num_points, block_size):
+        block = slice(start, start + block_size)
+        sum_e_0 += np.einsum('u,ua,ub,uc->abc', grade[block], sums_0[block], sums_1[block], sums_2[block], optimize=True)
+        count += np.einsum('ua,ub,uc->abc', counts_0[block], counts_1[block], counts_2[block], optimize=True)
+
+    dir_0_nlag, dir_1_nlag, dir_2_nlag = np.nonzero(count)
+    if correction == 'global':
+        # Means over all the quadruplets of the products of two values, from the sums over all the lags
+        s_0, s_1, s_2 = sums_0.sum(axis=1), sums_1.sum(axis=1), sums_2.sum(axis=1)
+        c_0, c_1, c_2 = counts_0.sum(axis=1), counts_1.sum(axis=1), counts_2.sum(axis=1)
+        total_count = count.sum()
+
+        # Compute E[Z(u),Z(u + h1)] ⋅ E[Z(u + h2),Z(u + h3)]
+        e_1 = np.sum(grade * s_0 * c_1 * c_2) / total_count * np.sum(c_0 * s_1 * s_2) / total_count
+
+        # Compute E[Z(u),Z(u + h2)] ⋅ E[Z(u + h1),Z(u + h3)]
+        e_2 = np.sum(grade * c_0 * s_1 * c_2) / total_count * np.sum(s_0 * c_1 * s_2) / total_count
+
+        # Compute E[Z(u),Z(u + h3)] ⋅ E[Z(u+ h1),Z(u + h2)]
+        e_3 = np.sum(grade * c_0 * c_1 * s_2) / total_count * np.sum(s_0 * s_1 * c_2) / total_count
+
+        correction_terms = e_1 + e_2 + e_3
+    else:
+        # Second-order moments of the lag vectors of each (n0, n1, n2), from the lookup table
+        correction_terms = lag_correction_terms(moments if moments is not None else second_order_moments(df_pairs), dir_0_nlag, dir_1_nlag, dir_2_nlag)
+
+    # Compute the fourth-order cumulant of each (n0, n1, n2) having quadruplets:
+    # mu_4 - (E_1 + E_2 + E_3)
+    final_result = pd.DataFrame({
+        'dir_0_nlag': dir_0_nlag.astype(np.int64),
+        'dir_1_nlag': dir_1_nlag.astype(np.int64),
+        'dir_2_nlag': dir_2_nlag.astype(np.int64),
+        'k_4': sum_e_0[dir_0_nlag, dir_1_nlag, dir_2_nlag] / count[dir_0_nlag, dir_1_nlag, dir_2_nlag] - correction_terms,
+    })
+
+    return final_result
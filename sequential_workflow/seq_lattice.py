@@ -0,0 +1,246 @@
+import numpy as np
+from seq_search_pairs_support import (
+    seq_direction_vector,
+    seq_calculate_azimuth_3d_block,
+    seq_calculate_dip_3d_block,
+    seq_distance_along_horizontal_bandwidth_block,
+    seq_distance_along_vertical_bandwidth_block,
+    seq_point_distance_to_shifted_plane_block,
+    seq_projection_length_block
+)
+from seq_spatial_index import seq_search_bounding_boxes
+from seq_pair_index import seq_build_pair_index
+from seq_search_pairs import seq_lag_range_block, seq_settle_dip_boundaries, seq_angle_window_block, seq_lag_bins_block, seq_sort_pairs, seq_pairs_rows_to_ids
+
+# Maximum number of lattice nodes per point, sparse lattices are searched point by point
+MAX_NODES_PER_POINT = 8
+
+def seq_detect_lattice(coords):
+    """
+    Detect whether the points lie on the nodes of a regular grid, at most one point per
+    node. Returns None if they do not, else a dictionary with the origin, the step and
+    the shape of the grid, the node of each point and the row of the point at each node
+    (-1 for the empty nodes). The lattice is exact when all the coordinates are
+    integers, so the vectors between points are exactly the node offsets times the step.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    origin = coords.min(axis=0)
+    extent = coords.max(axis=0) - origin
+    scale = np.abs(coords).max() + 1.0
+
+    # Step of each axis from the smallest gap between the distinct coordinates
+    step = np.zeros(3)
+    for axis in range(3):
+        values = np.unique(coords[:, axis])
+        if values.shape[0] > 1:
+            smallest_gap = np.diff(values).min()
+            step[axis] = extent[axis] / np.rint(extent[axis] / smallest_gap)
+
+    # The points must fall on the nodes of the grid
+    node = np.rint(np.divide(coords - origin, step, out=np.zeros_like(coords), where=step > 0)).astype(np.int64)
+    deviation = np.abs(coords - (origin + node * step)).max()
+    if deviation > 1e-9 * scale:
+        return None
+
+    shape = node.max(axis=0) + 1
+    if np.prod(shape) > MAX_NODES_PER_POINT * coords.shape[0]:
+        return None
+
+    # At most one point per node
+    node_row = np.full(tuple(shape), -1, dtype=np.int64)
+    node_row[node[:, 0], node[:, 1], node[:, 2]] = np.arange(coords.shape[0])
+    if np.count_nonzero(node_row >= 0) != coords.shape[0]:
+        return None
+
+    exact = bool(np.all(coords == np.rint(coords)) and np.all(step == np.rint(step)) and scale < 2**52)
+
+    return {
+        'origin': origin,
+        'step': step,
+        'shape': shape,
+        'node': node,
+        'node_row': node_row,
+        'deviation': deviation,
+        'exact': exact,
+    }
+
+def seq_lattice_offsets(lattice, box):
+    """
+    Node offsets (K, 3) whose vector lies inside the box, the null offset excluded.
+    """
+    ranges = []
+    for axis in range(3):
+        if lattice['step'][axis] == 0:
+            ranges.append(np.zeros(1, dtype=np.int64))
+            continue
+        low = max(int(np.ceil(box[0, axis] / lattice['step'][axis])), 1 - lattice['shape'][axis])
+        high = min(int(np.floor(box[1, axis] / lattice['step'][axis])), lattice['shape'][axis] - 1)
+        ranges.append(np.arange(low, high + 1, dtype=np.int64))
+
+    offsets = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+
+    return offsets[np.any(offsets != 0, axis=1)]
+
+def seq_lattice_offset_pairs(lattice, offset):
+    """
+    Rows (point_rows, paired_point_rows) of all the pairs of points separated by the
+    node offset, found by shifting the grid of rows instead of searching.
+    """
+    source, target = [], []
+    for axis in range(3):
+        size = lattice['shape'][axis]
+        shift = offset[axis]
+        if abs(shift) >= size:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        source.append(slice(max(-shift, 0), size - max(shift, 0)))
+        target.append(slice(max(shift, 0), size - max(-shift, 0)))
+
+    point_rows = lattice['node_row'][tuple(source)]
+    paired_point_rows = lattice['node_row'][tuple(target)]
+    occupied = (point_rows >= 0) & (paired_point_rows >= 0)
+
+    return point_rows[occupied], paired_point_rows[occupied]
+
+def seq_classify_pairs_direction_block(x1, y1, z1, x2, y2, z2, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vector):
+    """
+    Exact checks of one direction on arrays of pairs (x1, y1, z1) -> (x2, y2, z2), the
+    same as seq_classify_candidates_block. Returns the arrays (position, n) of the
+    accepted bins.
+    """
+    # Access the azimuth and dip tolerence boundaries
+    cal_azimuth = seq_calculate_azimuth_3d_block(x1, y1, z1, x2, y2, z2)
+    cal_dip = seq_calculate_dip_3d_block(x1, y1, z1, x2, y2, z2)
+    cal_dip = seq_settle_dip_boundaries(cal_dip, x1, y1, z1, x2, y2, z2, [0], [dip], [dip_tol])
+    keep = np.flatnonzero(seq_angle_window_block(cal_azimuth, cal_dip, azm, azm_tol, dip, dip_tol))
+
+    # Access the horizontal and vertical bandwidth boundaries
+    distance_banwh = seq_distance_along_horizontal_bandwidth_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+    distance_banwv = seq_distance_along_vertical_bandwidth_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+    keep = keep[(np.abs(distance_banwh) <= bandwh) & (np.abs(distance_banwv) <= bandwv)]
+
+    # Access within the lag tolerance
+    projection = seq_projection_length_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+    position, n = seq_lag_bins_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], projection, nlag, lag, lag_tol, direction_vector)
+
+    return keep[position], n
+
+def seq_search_pairs_lattice(data_vector, lattice, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
+    """
+    Pair search on the points of a lattice (see seq_detect_lattice). Every pair of nodes
+    is a fixed integer offset, so the checks are evaluated once per offset within
+    reach of each direction, and the pairs of an accepted (offset, n) are produced by
+    shifting the grid of rows. The offsets whose checks are too close to a boundary to
+    be decided from the offset alone (ties on the lag windows, or an inexact lattice)
+    are checked again on the actual pairs. Returns the same (M, 4) array of
+    [point_row, dim_id, n, paired_point_row] rows as seq_search_pairs_anchors.
+    """
+    coords = data_vector[:, 1:4]
+    boxes = seq_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+
+    # Largest difference between the vector of a pair and the vector of its offset, and
+    # between the shifted plane distances computed from a node or from the origin
+    scale = np.abs(coords).max() + np.abs(boxes).max() + 1.0
+    eps_vector = 2 * lattice['deviation'] + 1e-12 * scale
+    eps_distance = 4 * eps_vector + 1e-9 * scale
+
+    pairs = [np.zeros((0, 4), dtype=np.int64)]
+    for dim_id in dim:
+        direction_vector = seq_direction_vector(azm[dim_id], dip[dim_id])
+        offsets = seq_lattice_offsets(lattice, boxes[dim_id])
+        x, y, z = (offsets * lattice['step']).T
+
+        # Access the azimuth, dip and bandwidth boundaries of the offsets
+        cal_azimuth = seq_calculate_azimuth_3d_block(0.0, 0.0, 0.0, x, y, z)
+        cal_dip = seq_calculate_dip_3d_block(0.0, 0.0, 0.0, x, y, z)
+        cal_dip = seq_settle_dip_boundaries(cal_dip, 0.0, 0.0, 0.0, x, y, z, [0], [dip[dim_id]], [dip_tol[dim_id]])
+        distance_banwh = seq_distance_along_horizontal_bandwidth_block(0.0, 0.0, 0.0, x, y, z, direction_vector)
+        distance_banwv = seq_distance_along_vertical_bandwidth_block(0.0, 0.0, 0.0, x, y, z, direction_vector)
+        accepted = seq_angle_window_block(cal_azimuth, cal_dip, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id])
+        accepted &= (distance_banwh <= bandwh[dim_id]) & (distance_banwv <= bandwv[dim_id])
+
+        # On an exact lattice the angles and the bandwidths of a pair are those of its
+        # offset, otherwise the offsets close to a boundary are checked on the pairs
+        ambiguous = np.zeros(offsets.shape[0], dtype=bool)
+        if not lattice['exact']:
+            horizontal = np.hypot(x, y)
+            length = np.sqrt(horizontal**2 + z**2)
+            eps_azimuth = np.degrees(np.divide(4 * eps_vector, horizontal, out=np.full_like(horizontal, np.inf), where=horizontal > 0)) + 1e-9
+            eps_dip = np.degrees(4 * eps_vector / length) + 1e-9
+            for bound in ((azm[dim_id] - azm_tol[dim_id] + 360) % 360, (azm[dim_id] + azm_tol[dim_id] + 360) % 360):
+                ambiguous |= np.abs((cal_azimuth - bound + 180) % 360 - 180) <= eps_azimuth
+            for bound in (dip[dim_id] - dip_tol[dim_id], dip[dim_id] + dip_tol[dim_id]):
+                ambiguous |= np.abs(cal_dip - bound) <= eps_dip
+            ambiguous |= np.abs(distance_banwh - bandwh[dim_id]) <= eps_distance
+            ambiguous |= np.abs(distance_banwv - bandwv[dim_id]) <= eps_distance
+
+        # Lags the offsets can fall in, with the distances to both shifted planes
+        reachable = np.flatnonzero(accepted & ~ambiguous)
+        projection = seq_projection_length_block(0.0, 0.0, 0.0, x[reachable], y[reachable], z[reachable], direction_vector)
+        n_min, n_max = seq_lag_range_block(projection, nlag[dim_id], lag[dim_id], lag_tol[dim_id])
+        counts = np.maximum(n_max - n_min + 1, 0)
+        position = np.repeat(np.arange(reachable.shape[0]), counts)
+        n = np.repeat(n_min - (np.cumsum(counts) - counts), counts) + np.arange(position.shape[0])
+        distance_max_lag_tol = seq_point_distance_to_shifted_plane_block(0.0, 0.0, 0.0, x[reachable[position]], y[reachable[position]], z[reachable[position]], (n * lag[dim_id]) + lag_tol[dim_id], direction_vector)
+        distance_min_lag_tol = seq_point_distance_to_shifted_plane_block(0.0, 0.0, 0.0, x[reachable[position]], y[reachable[position]], z[reachable[position]], (n * lag[dim_id]) - lag_tol[dim_id], direction_vector)
+
+        # A bin is decided by its offset unless a distance is a tie up to the rounding
+        inside = (distance_max_lag_tol < -eps_distance) & (distance_min_lag_tol > eps_distance)
+        outside = (distance_max_lag_tol > eps_distance) | (distance_min_lag_tol < -eps_distance)
+        on_boundary = ~inside & ~outside
+
+        # for each offset close to a boundary, full exact checks on the actual pairs
+        for k in np.flatnonzero(ambiguous):
+            point_rows, paired_point_rows = seq_lattice_offset_pairs(lattice, offsets[k])
+            x1, y1, z1 = coords[point_rows].T
+            x2, y2, z2 = coords[paired_point_rows].T
+            found, found_n = seq_classify_pairs_direction_block(x1, y1, z1, x2, y2, z2, nlag[dim_id], lag[dim_id], lag_tol[dim_id], azm[dim_id], azm_tol[dim_id], bandwh[dim_id], dip[dim_id], dip_tol[dim_id], bandwv[dim_id], direction_vector)
+            pairs.append(np.column_stack((point_rows[found], np.full(found.shape[0], dim_id), found_n, paired_point_rows[found])))
+
+        # for each offset in reach, the bins of an offset being contiguous
+        bin_start = np.cumsum(counts) - counts
+        for j in np.unique(position[~outside]):
+            bins = np.arange(bin_start[j], bin_start[j] + counts[j])
+            bins = bins[~outside[bins]]
+            point_rows, paired_point_rows = seq_lattice_offset_pairs(lattice, offsets[reachable[j]])
+            if np.any(on_boundary[bins]):
+                x1, y1, z1 = coords[point_rows].T
+                x2, y2, z2 = coords[paired_point_rows].T
+
+            for b in bins:
+                if inside[b]:
+                    found = np.arange(point_rows.shape[0])
+                else:
+                    # Access within the lag tolerance on the actual pairs
+                    distance_max_lag_tol = seq_point_distance_to_shifted_plane_block(x1, y1, z1, x2, y2, z2, (n[b] * lag[dim_id]) + lag_tol[dim_id], direction_vector)
+                    distance_min_lag_tol = seq_point_distance_to_shifted_plane_block(x1, y1, z1, x2, y2, z2, (n[b] * lag[dim_id]) - lag_tol[dim_id], direction_vector)
+                    found = np.flatnonzero((distance_max_lag_tol <= 0) & (distance_min_lag_tol >= 0))
+
+                #Add points to pairs
+                pairs.append(np.column_stack((point_rows[found], np.full(found.shape[0], dim_id), np.full(found.shape[0], n[b]), paired_point_rows[found])))
+
+    pairs = np.concatenate(pairs).astype(np.int64)
+
+    return seq_sort_pairs(pairs)
+
+def seq_search_pairs_gen_lattice(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, lattice=None, as_index=False):
+    """
+    Regular grid equivalent of seq_search_pairs_gen_vectorized. The lattice is detected
+    from the coordinates unless given (see seq_detect_lattice), and a ValueError is
+    raised if the points do not lie on a regular grid.
+    Returns the same [point_id, dim_id, n, paired_point_id] list, in the same order, or
+    with as_index the CSR pair index of these rows.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+
+    if lattice is None:
+        lattice = seq_detect_lattice(data_vector[:, 1:4])
+    if lattice is None:
+        raise ValueError("The points do not lie on a regular grid.")
+
+    pairs = seq_search_pairs_lattice(data_vector, lattice, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    pairs = seq_pairs_rows_to_ids(data_vector, pairs)
+    if as_index:
+        return seq_build_pair_index(pairs, data_vector.shape[0], len(dim), max(nlag))
+
+    return pairs.tolist()
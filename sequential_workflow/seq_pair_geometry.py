@@ -0,0 +1,145 @@
+import json
+import numpy as np
+from seq_search_pairs_support import (
+    seq_calculate_azimuth_3d_block,
+    seq_calculate_dip_3d_block,
+    seq_distance_along_horizontal_bandwidth_block,
+    seq_distance_along_vertical_bandwidth_block,
+    seq_projection_length_block,
+    seq_direction_vector
+)
+from seq_search_pairs import seq_settle_dip_boundaries, seq_angle_window_block, seq_lag_bins_block, seq_sort_pairs, seq_pairs_rows_to_ids
+from seq_search_pairs_sweep import seq_gather_candidate_pairs
+from seq_spatial_index import seq_search_bounding_boxes
+from seq_pair_index import seq_build_pair_index, PAIR_FILE_PARAMS
+
+def seq_projection_range(nlag, lag, lag_tol):
+    """
+    Range of the projection lengths covered by the lag windows of one direction.
+    """
+    lag_ends = (lag, nlag * lag)
+
+    return min(lag_ends) - lag_tol, max(lag_ends) + lag_tol
+
+def seq_search_pair_geometry(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, block_size=65536, use_index=True):
+    """
+    Search the pairs of data_vector within relaxed tolerances and keep their geometry,
+    to be filtered later with tighter tolerances or another lag binning by
+    seq_refilter_pair_geometry, without searching again. A pair is kept for a direction
+    when its azimuth, dip and bandwidth distances are within the tolerances and its
+    projection within the range of the lag windows, whatever its lag. Returns a
+    dictionary with the [point_row, dim_id, paired_point_row] rows, their projection,
+    azimuth, dip and bandwidth distances, and the search parameters.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+    direction_vectors = [seq_direction_vector(azm[dim_id], dip[dim_id]) for dim_id in dim]
+    boxes = seq_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+
+    found = {'rows': [np.zeros((0, 3), dtype=np.int64)], 'projection': [], 'azimuth': [], 'dip': [], 'distance_h': [], 'distance_v': []}
+    for first_rows, second_rows in seq_gather_candidate_pairs(data_vector, boxes, block_size=block_size, use_index=use_index):
+        first, second = data_vector[first_rows], data_vector[second_rows]
+        x1, y1, z1, x2, y2, z2 = first[:, 1], first[:, 2], first[:, 3], second[:, 1], second[:, 2], second[:, 3]
+
+        # The azimuth and the dip of a pair do not depend on the direction
+        cal_azimuth = seq_calculate_azimuth_3d_block(x1, y1, z1, x2, y2, z2)
+        cal_dip = seq_calculate_dip_3d_block(x1, y1, z1, x2, y2, z2)
+        cal_dip = seq_settle_dip_boundaries(cal_dip, x1, y1, z1, x2, y2, z2, dim, dip, dip_tol)
+
+        for dim_id in dim:
+            direction_vector = direction_vectors[dim_id]
+
+            # Access the azimuth and dip tolerence boundaries
+            keep = np.flatnonzero(seq_angle_window_block(cal_azimuth, cal_dip, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id]))
+
+            # Access the horizontal and vertical bandwidth boundaries
+            distance_banwh = seq_distance_along_horizontal_bandwidth_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+            distance_banwv = seq_distance_along_vertical_bandwidth_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+            accepted = (np.abs(distance_banwh) <= bandwh[dim_id]) & (np.abs(distance_banwv) <= bandwv[dim_id])
+
+            # Within the range of the lag windows, with a margin for the exact shifted plane checks
+            projection = seq_projection_length_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], direction_vector)
+            min_projection, max_projection = seq_projection_range(nlag[dim_id], lag[dim_id], lag_tol[dim_id])
+            margin = 1e-6 * (abs(min_projection) + abs(max_projection) + 1.0)
+            accepted &= (projection >= min_projection - margin) & (projection <= max_projection + margin)
+
+            keep, position = keep[accepted], np.flatnonzero(accepted)
+            found['rows'].append(np.column_stack((first_rows[keep], np.full(keep.shape[0], dim_id), second_rows[keep])))
+            found['projection'].append(projection[position])
+            found['azimuth'].append(cal_azimuth[keep])
+            found['dip'].append(cal_dip[keep])
+            found['distance_h'].append(distance_banwh[position])
+            found['distance_v'].append(distance_banwv[position])
+
+    geometry = {key: np.concatenate(values) for key, values in found.items() if key != 'rows'}
+    geometry['rows'] = np.concatenate(found['rows']).astype(np.int64)
+    geometry['params'] = (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    return geometry
+
+def seq_refilter_pair_geometry(data_vector, geometry, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, as_index=False):
+    """
+    Pairs of data_vector for the given parameters, filtered from the geometry of a
+    relaxed search (see seq_search_pair_geometry) instead of searching again. The
+    directions must be the same, the tolerances and bandwidths at most the relaxed ones
+    and the lag windows within the projection range of the relaxed search. Returns the
+    same [point_id, dim_id, n, paired_point_id] list as seq_search_pairs_gen_vectorized,
+    or with as_index the CSR pair index.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+    relaxed = dict(zip(PAIR_FILE_PARAMS, geometry['params']))
+
+    # The relaxed search must contain every pair of the parameters
+    for dim_id in dim:
+        if dim_id not in relaxed['dim'] or (azm[dim_id], dip[dim_id]) != (relaxed['azm'][dim_id], relaxed['dip'][dim_id]):
+            raise ValueError(f"Direction {dim_id} is not a direction of the relaxed search.")
+        for name, value in (('azm_tol', azm_tol), ('dip_tol', dip_tol), ('bandwh', bandwh), ('bandwv', bandwv)):
+            if value[dim_id] > relaxed[name][dim_id]:
+                raise ValueError(f"{name} of direction {dim_id} is larger than in the relaxed search.")
+        min_projection, max_projection = seq_projection_range(nlag[dim_id], lag[dim_id], lag_tol[dim_id])
+        relaxed_min, relaxed_max = seq_projection_range(relaxed['nlag'][dim_id], relaxed['lag'][dim_id], relaxed['lag_tol'][dim_id])
+        if min_projection < relaxed_min or max_projection > relaxed_max:
+            raise ValueError(f"The lag windows of direction {dim_id} are outside the ones of the relaxed search.")
+
+    rows = geometry['rows']
+    first, second = data_vector[rows[:, 0]], data_vector[rows[:, 2]]
+
+    # The dips on the new tolerance boundaries are evaluated again with the scalar helper
+    cal_dip = seq_settle_dip_boundaries(geometry['dip'].copy(), first[:, 1], first[:, 2], first[:, 3], second[:, 1], second[:, 2], second[:, 3], dim, dip, dip_tol)
+
+    pairs = [np.zeros((0, 4), dtype=np.int64)]
+    for dim_id in dim:
+        direction_vector = seq_direction_vector(azm[dim_id], dip[dim_id])
+
+        # Access the tolerence and bandwidth boundaries with the stored geometry
+        keep = rows[:, 1] == dim_id
+        keep &= seq_angle_window_block(geometry['azimuth'], cal_dip, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id])
+        keep &= (np.abs(geometry['distance_h']) <= bandwh[dim_id]) & (np.abs(geometry['distance_v']) <= bandwv[dim_id])
+        keep = np.flatnonzero(keep)
+
+        # Access within the lag tolerance of the lags the stored projection can fall in
+        position, n = seq_lag_bins_block(first[keep, 1], first[keep, 2], first[keep, 3], second[keep, 1], second[keep, 2], second[keep, 3], geometry['projection'][keep], nlag[dim_id], lag[dim_id], lag_tol[dim_id], direction_vector)
+        pairs.append(np.column_stack((rows[keep[position], 0], np.full(n.shape[0], dim_id), n, rows[keep[position], 2])))
+
+    # Same order as the nested loops of seq_search_pairs_gen
+    pairs = seq_pairs_rows_to_ids(data_vector, seq_sort_pairs(np.concatenate(pairs).astype(np.int64)))
+    if as_index:
+        return seq_build_pair_index(pairs, data_vector.shape[0], len(dim), max(nlag))
+
+    return pairs.tolist()
+
+def seq_save_pair_geometry(geometry, file_name):
+    """
+    Save the geometry of a relaxed search to a .npz file.
+    """
+    np.savez(file_name, rows=geometry['rows'], projection=geometry['projection'], azimuth=geometry['azimuth'], dip=geometry['dip'], distance_h=geometry['distance_h'], distance_v=geometry['distance_v'], params=np.array(json.dumps(dict(zip(PAIR_FILE_PARAMS, geometry['params'])))))
+
+def seq_load_pair_geometry(file_name):
+    """
+    Load the geometry of a relaxed search saved by seq_save_pair_geometry.
+    """
+    with np.load(file_name) as data:
+        geometry = {key: data[key] for key in ('rows', 'projection', 'azimuth', 'dip', 'distance_h', 'distance_v')}
+        params = json.loads(str(data['params']))
+    geometry['params'] = tuple(params[name] for name in PAIR_FILE_PARAMS)
+
+    return geometry
@@ -0,0 +1,415 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Binary pair file: magic bytes, version, and the names of the search parameters of the header
+PAIR_FILE_MAGIC = b'GEOPAIRS'
+PAIR_FILE_VERSION = 1
+PAIR_FILE_PARAMS = ('dim', 'nlag', 'lag', 'lag_tol', 'azm', 'azm_tol', 'bandwh', 'dip', 'dip_tol', 'bandwv')
+
+def seq_pair_index_slot(ndir, max_nlag, point_id, dim_id, n):
+    """
+    Slot of (point_id, dim_id, n) in the offsets of a pair index, the points being
+    numbered from 1.
+    """
+    return ((point_id - 1) * ndir + dim_id) * (max_nlag + 1) + n
+
+def seq_build_pair_index(pairs, num_points, ndir, max_nlag):
+    """
+    Build the CSR pair index of [point_id, dim_id, n, paired_point_id] rows: the paired
+    point ids of each (point_id, dim_id, n) are stored contiguously as int32, in the
+    order of the rows, and start at offsets[slot] (see seq_pair_index_slot). Returns a
+    dictionary with the offsets, the paired point ids and the dimensions of the index.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 4)
+    slot = seq_pair_index_slot(ndir, max_nlag, pairs[:, 0], pairs[:, 1], pairs[:, 2])
+
+    # Number of pairs of each slot, and start of each slot
+    num_slots = num_points * ndir * (max_nlag + 1)
+    offsets = np.zeros(num_slots + 1, dtype=np.int64)
+    np.cumsum(np.bincount(slot, minlength=num_slots), out=offsets[1:])
+
+    # Group the paired point ids by slot, keeping the order of the rows
+    order = np.argsort(slot, kind='stable')
+
+    return {
+        'offsets': offsets,
+        'paired_point_id': pairs[order, 3].astype(np.int32),
+        'num_points': num_points,
+        'ndir': ndir,
+        'max_nlag': max_nlag,
+    }
+
+def seq_merge_pair_index(index, pairs, num_points):
+    """
+    Merge [point_id, dim_id, n, paired_point_id] rows into a pair index extended to
+    num_points points. The rows of each slot are added after the paired point ids
+    already in the index, so rows paired with points appended after the points of the
+    index keep the order of a full search. The merge is linear in the number of pairs.
+    """
+    ndir, max_nlag = index['ndir'], index['max_nlag']
+    added = seq_build_pair_index(pairs, num_points, ndir, max_nlag)
+
+    # Number of pairs of each slot, the slots of the index being the first ones
+    old_counts = np.zeros(added['offsets'].shape[0] - 1, dtype=np.int64)
+    old_counts[:index['offsets'].shape[0] - 1] = np.diff(index['offsets'])
+    added_counts = np.diff(added['offsets'])
+    offsets = np.zeros(old_counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(old_counts + added_counts, out=offsets[1:])
+
+    # Destination of the pairs of the index, then of the added pairs behind them
+    paired_point_id = np.empty(offsets[-1], dtype=np.int32)
+    old_shift = np.repeat(offsets[:-1] - np.concatenate(([0], np.cumsum(old_counts)[:-1])), old_counts)
+    paired_point_id[np.arange(old_shift.shape[0]) + old_shift] = index['paired_point_id']
+    added_shift = np.repeat(offsets[:-1] + old_counts - added['offsets'][:-1], added_counts)
+    paired_point_id[np.arange(added_shift.shape[0]) + added_shift] = added['paired_point_id']
+
+    return {
+        'offsets': offsets,
+        'paired_point_id': paired_point_id,
+        'num_points': num_points,
+        'ndir': ndir,
+        'max_nlag': max_nlag,
+    }
+
+def seq_pair_index_neighbours(index, point_id, dim_id, n):
+    """
+    Paired point ids of point_id in direction dim_id at lag n, read in O(1) from the index.
+    """
+    slot = seq_pair_index_slot(index['ndir'], index['max_nlag'], point_id, dim_id, n)
+
+    return index['paired_point_id'][index['offsets'][slot]:index['offsets'][slot + 1]]
+
+def seq_pair_index_to_pairs(index):
+    """
+    Expand the pair index back into an (M, 4) array of [point_id, dim_id, n, paired_point_id] rows.
+    """
+    counts = np.diff(index['offsets'])
+    slot = np.repeat(np.arange(counts.shape[0]), counts)
+    point_row, dim_id, n = np.unravel_index(slot, (index['num_points'], index['ndir'], index['max_nlag'] + 1))
+
+    return np.column_stack((point_row + 1, dim_id, n, index['paired_point_id'])).astype(np.int64)
+
+def seq_file_sha256(file_name, chunk_size=1 << 20):
+    """
+    SHA-256 hash of a file, read by chunks of chunk_size bytes.
+    """
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+def seq_pair_file_header(num_points, ndir, max_nlag, params=None, input_file=None):
+    """
+    Header of a .pairs file (dimensions of the index, search parameters and SHA-256 hash
+    of the input file), with the position of the arrays in the file. The number of pairs
+    is filled in when the file is complete.
+    """
+    header = {
+        'version': PAIR_FILE_VERSION,
+        'num_points': int(num_points),
+        'ndir': int(ndir),
+        'max_nlag': int(max_nlag),
+        'num_pairs': 0,
+        'params': None if params is None else dict(zip(PAIR_FILE_PARAMS, params)),
+        'input_sha256': None if input_file is None else seq_file_sha256(input_file),
+    }
+
+    # Room for the largest header the file can get (the number of pairs and the hash of an input
+    # file recorded later, see seq_set_pair_file_input) and the positions, then the arrays on 64
+    # bytes boundaries
+    num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+    largest_header = dict(header, num_pairs=np.iinfo(np.int64).max, input_sha256='0' * 64)
+    header['header_length'] = len(json.dumps(largest_header).encode()) + 128
+    header['offsets_start'] = -(-(len(PAIR_FILE_MAGIC) + 8 + header['header_length']) // 64) * 64
+    header['pairs_start'] = -(-(header['offsets_start'] + 8 * (num_slots + 1)) // 64) * 64
+
+    return header
+
+def seq_write_pair_file_header(file, header):
+    """
+    Write the magic bytes and the header at the start of an open .pairs file.
+    """
+    encoded = json.dumps(header).encode()
+    if len(encoded) > header['header_length']:
+        raise ValueError(f"The header of {len(encoded)} bytes does not fit in the {header['header_length']} bytes reserved in the pair file.")
+
+    file.seek(0)
+    file.write(PAIR_FILE_MAGIC)
+    file.write(np.uint64(header['header_length']).tobytes())
+    file.write(encoded.ljust(header['header_length']))
+
+def seq_save_pair_index(index, file_name, params=None, input_file=None):
+    """
+    Save the pair index to a binary .pairs file: the magic bytes, the length of the
+    JSON header, the header (see seq_pair_file_header), then the int64 offsets and the
+    int32 paired point ids, each starting on a 64 bytes boundary so that they can be
+    memory-mapped.
+    """
+    header = seq_pair_file_header(index['num_points'], index['ndir'], index['max_nlag'], params=params, input_file=input_file)
+    header['num_pairs'] = int(index['paired_point_id'].shape[0])
+
+    with open(file_name, 'wb') as file:
+        seq_write_pair_file_header(file, header)
+        file.seek(header['offsets_start'])
+        file.write(np.ascontiguousarray(index['offsets'], dtype=np.int64).tobytes())
+        file.seek(header['pairs_start'])
+        file.write(np.ascontiguousarray(index['paired_point_id'], dtype=np.int32).tobytes())
+
+def seq_open_pair_writer(file_name, num_points, ndir, max_nlag, params=None, input_file=None, chunk_size=1 << 20):
+    """
+    Open a .pairs file to be written batch by batch with seq_write_pairs and completed
+    by seq_close_pair_writer. The paired point ids are appended to the file by chunks of
+    chunk_size, so the memory used only depends on the number of points, not on the
+    number of pairs. Returns the state of the writer.
+    """
+    header = seq_pair_file_header(num_points, ndir, max_nlag, params=params, input_file=input_file)
+    file = open(file_name, 'wb')
+    file.seek(header['pairs_start'])
+
+    return {
+        'file': file,
+        'header': header,
+        'counts': np.zeros(header['num_points'] * header['ndir'] * (header['max_nlag'] + 1), dtype=np.int64),
+        'buffer': np.empty(chunk_size, dtype=np.int32),
+        'buffered': 0,
+        'next_slot': 0,
+    }
+
+def seq_write_pairs(writer, pairs):
+    """
+    Append a batch of [point_id, dim_id, n, paired_point_id] rows to a pair writer. The
+    batches must follow each other in point id order, as the anchor batches of
+    seq_search_pairs_gen_batches.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 4)
+    if pairs.shape[0] == 0:
+        return
+
+    # Group the rows of the batch by slot, keeping their order
+    header = writer['header']
+    slot = seq_pair_index_slot(header['ndir'], header['max_nlag'], pairs[:, 0], pairs[:, 1], pairs[:, 2])
+    order = np.argsort(slot, kind='stable')
+    slot = slot[order]
+    if slot[0] < writer['next_slot']:
+        raise ValueError("The pair batches must be written in point id order.")
+    slots, slot_counts = np.unique(slot, return_counts=True)
+    writer['counts'][slots] += slot_counts
+    writer['next_slot'] = slot[-1]
+
+    # Fill the buffer and write it each time it is full
+    paired_point_id = pairs[order, 3].astype(np.int32)
+    start = 0
+    while start < paired_point_id.shape[0]:
+        size = min(writer['buffer'].shape[0] - writer['buffered'], paired_point_id.shape[0] - start)
+        writer['buffer'][writer['buffered']:writer['buffered'] + size] = paired_point_id[start:start + size]
+        writer['buffered'] += size
+        start += size
+        if writer['buffered'] == writer['buffer'].shape[0]:
+            writer['file'].write(writer['buffer'].tobytes())
+            writer['buffered'] = 0
+
+def seq_close_pair_writer(writer):
+    """
+    Write the last chunk, the offsets and the header of a pair writer and close the
+    file. Returns the number of pairs written.
+    """
+    file, header = writer['file'], writer['header']
+    try:
+        file.write(writer['buffer'][:writer['buffered']].tobytes())
+
+        offsets = np.zeros(writer['counts'].shape[0] + 1, dtype=np.int64)
+        np.cumsum(writer['counts'], out=offsets[1:])
+        header['num_pairs'] = int(offsets[-1])
+
+        file.seek(header['offsets_start'])
+        file.write(offsets.tobytes())
+        seq_write_pair_file_header(file, header)
+    finally:
+        file.close()
+
+    return header['num_pairs']
+
+def seq_open_spilled_pair_writer(file_name, num_points, ndir, max_nlag, work_dir, params=None, input_file=None):
+    """
+    Open a .pairs file to be written with seq_write_spilled_pairs, by batches holding all
+    the pairs of their points but in any point order, and completed by
+    seq_close_spilled_pair_writer. The number of pairs of each slot is counted in the
+    offsets of the file itself, memory-mapped, and the batches are spilled to two files
+    of work_dir, so the memory used depends neither on the number of points nor on the
+    number of pairs. Returns the state of the writer.
+    """
+    header = seq_pair_file_header(num_points, ndir, max_nlag, params=params, input_file=input_file)
+    num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+
+    # The file up to the paired point ids, with zero counts
+    with open(file_name, 'wb') as file:
+        file.truncate(header['pairs_start'])
+
+    slot_path = os.path.join(work_dir, os.path.basename(file_name) + '.slots')
+    pair_path = os.path.join(work_dir, os.path.basename(file_name) + '.paired')
+
+    return {
+        'file_name': file_name,
+        'header': header,
+        'offsets': np.memmap(file_name, dtype=np.int64, mode='r+', offset=header['offsets_start'], shape=(num_slots + 1,)),
+        'slot_file': open(slot_path, 'wb'),
+        'pair_file': open(pair_path, 'wb'),
+        'slot_path': slot_path,
+        'pair_path': pair_path,
+        'batch_sizes': [],
+    }
+
+def seq_write_spilled_pairs(writer, pairs):
+    """
+    Spill a batch of [point_id, dim_id, n, paired_point_id] rows of a spilled pair
+    writer, ordered like seq_search_pairs_gen within the batch. The batch must hold all
+    the pairs of its points.
+    """
+    pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 4)
+    if pairs.shape[0] == 0:
+        return
+
+    # Group the rows of the batch by slot, keeping their order
+    header = writer['header']
+    slot = seq_pair_index_slot(header['ndir'], header['max_nlag'], pairs[:, 0], pairs[:, 1], pairs[:, 2])
+    order = np.argsort(slot, kind='stable')
+    slot = slot[order]
+
+    # Count the pairs of each slot after the start of the slot, shifted by one to become offsets
+    slots, slot_counts = np.unique(slot, return_counts=True)
+    if np.any(writer['offsets'][slots + 1] != 0):
+        raise ValueError("The pairs of a point must be written in a single batch.")
+    writer['offsets'][slots + 1] = slot_counts
+
+    writer['slot_file'].write(slot.tobytes())
+    writer['pair_file'].write(pairs[order, 3].astype(np.int32).tobytes())
+    writer['batch_sizes'].append(slot.shape[0])
+
+def seq_close_spilled_pair_writer(writer, chunk_size=1 << 20):
+    """
+    Turn the counts of a spilled pair writer into offsets, copy the spilled batches to
+    their slots in the file, write the header and remove the spill files. Returns the
+    number of pairs written.
+    """
+    header, offsets = writer['header'], writer['offsets']
+    try:
+        writer['slot_file'].close()
+        writer['pair_file'].close()
+
+        # Cumulative sum of the counts, chunk by chunk
+        total = 0
+        for start in range(0, offsets.shape[0], chunk_size):
+            chunk = np.cumsum(offsets[start:start + chunk_size]) + total
+            offsets[start:start + chunk_size] = chunk
+            total = int(chunk[-1])
+        header['num_pairs'] = total
+
+        # Copy each spilled batch at the offsets of its slots
+        if total > 0:
+            with open(writer['file_name'], 'r+b') as file:
+                file.truncate(header['pairs_start'] + 4 * total)
+            paired_point_id = np.memmap(writer['file_name'], dtype=np.int32, mode='r+', offset=header['pairs_start'], shape=(total,))
+            spilled_slot = np.memmap(writer['slot_path'], dtype=np.int64, mode='r')
+            spilled_pair = np.memmap(writer['pair_path'], dtype=np.int32, mode='r')
+            start = 0
+            for size in writer['batch_sizes']:
+                slot = np.asarray(spilled_slot[start:start + size])
+                slots, first, slot_counts = np.unique(slot, return_index=True, return_counts=True)
+                rank = np.arange(size) - np.repeat(first, slot_counts)
+                paired_point_id[np.repeat(offsets[slots], slot_counts) + rank] = spilled_pair[start:start + size]
+                start += size
+            paired_point_id.flush()
+            del paired_point_id, spilled_slot, spilled_pair
+        offsets.flush()
+
+        with open(writer['file_name'], 'r+b') as file:
+            seq_write_pair_file_header(file, header)
+    finally:
+        del writer['offsets']
+        for path in (writer['slot_path'], writer['pair_path']):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return header['num_pairs']
+
+def seq_discard_spilled_pair_writer(writer):
+    """
+    Close a spilled pair writer without completing it, removing its file and spill files.
+    """
+    writer['slot_file'].close()
+    writer['pair_file'].close()
+    writer.pop('offsets', None)
+    for path in (writer['file_name'], writer['slot_path'], writer['pair_path']):
+        if os.path.exists(path):
+            os.remove(path)
+
+def seq_read_pair_file_header(file_name):
+    """
+    Read the JSON header of a .pairs file.
+    """
+    with open(file_name, 'rb') as file:
+        if file.read(len(PAIR_FILE_MAGIC)) != PAIR_FILE_MAGIC:
+            raise ValueError(f"{file_name} is not a pair file.")
+        header_length = int(np.frombuffer(file.read(8), dtype=np.uint64)[0])
+        header = json.loads(file.read(header_length))
+
+    if header['version'] != PAIR_FILE_VERSION:
+        raise ValueError(f"Unsupported pair file version: {header['version']}")
+
+    return header
+
+def seq_set_pair_file_input(file_name, input_file):
+    """
+    Record input_file as the input of a .pairs file, for pairs reused for another file
+    with the same coordinates.
+    """
+    header = seq_read_pair_file_header(file_name)
+    header['input_sha256'] = seq_file_sha256(input_file)
+    with open(file_name, 'r+b') as file:
+        seq_write_pair_file_header(file, header)
+
+def seq_load_pair_index(file_name, mmap=True):
+    """
+    Load a pair index saved by seq_save_pair_index. With mmap the offsets and the paired
+    point ids are memory-mapped from the file instead of being read into memory. The
+    header is returned under 'metadata'.
+    """
+    header = seq_read_pair_file_header(file_name)
+    num_slots = header['num_points'] * header['ndir'] * (header['max_nlag'] + 1)
+
+    def read_array(dtype, start, count):
+        # An empty array cannot be memory-mapped
+        if mmap and count > 0:
+            return np.memmap(file_name, dtype=dtype, mode='r', offset=start, shape=(count,))
+        return np.fromfile(file_name, dtype=dtype, count=count, offset=start)
+
+    return {
+        'offsets': read_array(np.int64, header['offsets_start'], num_slots + 1),
+        'paired_point_id': read_array(np.int32, header['pairs_start'], header['num_pairs']),
+        'num_points': header['num_points'],
+        'ndir': header['ndir'],
+        'max_nlag': header['max_nlag'],
+        'metadata': header,
+    }
+
+def seq_convert_json_pairs(json_file, output_file, num_points, ndir, max_nlag, params=None, input_file=None):
+    """
+    One-off conversion of the JSON records of an older pair file into a .pairs file.
+    num_points is the number of rows of the input file, ndir the number of directions
+    and max_nlag the largest number of lags of the search. Returns the pair index.
+    """
+    pairs = pd.read_json(json_file)
+    if pairs.shape[0] == 0:
+        pairs = np.zeros((0, 4), dtype=np.int64)
+    else:
+        pairs = pairs[["point_id", "dim_id", "n", "paired_point_id"]].to_numpy(dtype=np.int64)
+
+    index = seq_build_pair_index(pairs, num_points, ndir, max_nlag)
+    seq_save_pair_index(index, output_file, params=params, input_file=input_file)
+
+    return index
@@ -3,8 +3,17 @@ import numpy as np
 import pandas as pd
 import time
 import os
-from seq_search_pairs import seq_search_pairs_gen
-from seq_cumulants import (center_grades, associate_grade, compute_3rd_order_cumulant, compute_4th_order_cumulant)
+import shutil
+from seq_search_pairs import seq_search_pairs_gen_batches, seq_search_pairs_gen_incremental, seq_new_search_stats, seq_format_search_stats
+from seq_search_pairs_pool import seq_search_pairs_gen_pool_batches
+from seq_lattice import seq_detect_lattice, seq_search_pairs_gen_lattice
+from seq_search_pairs_tiled import seq_search_pairs_gen_tiled
+from seq_search_pairs_sweep import seq_search_pairs_gen_sweep
+from seq_pair_geometry import seq_search_pair_geometry, seq_refilter_pair_geometry, seq_save_pair_geometry, seq_load_pair_geometry
+from seq_pair_index import seq_save_pair_index, seq_set_pair_file_input, seq_open_pair_writer, seq_write_pairs, seq_close_pair_writer, seq_read_pair_file_header, seq_load_pair_index, seq_file_sha256, seq_convert_json_pairs, PAIR_FILE_PARAMS
+from seq_cache import seq_pairs_cache_key, seq_cumulants_cache_key, seq_moments_cache_key, seq_cache_lookup, seq_cache_store
+from seq_cumulants import (center_grades, associate_grade, compute_3rd_order_cumulant, compute_3rd_order_cumulant_matrix, compute_4th_order_cumulant, compute_4th_order_cumulant_matrix,
+                           second_order_moments, save_second_order_moments, load_second_order_moments)
 
 def load_parameters(ndir, file_name):
     # Load JSON file
@@ -12,8 +21,20 @@ def load_parameters(ndir, file_name):
         data = json.load(file)
     
     # Extract parameters from JSON based on ndir
+    return parameters_from_block(ndir, data[f'ndir{ndir}'])
+
+def load_parameter_sets(ndir, file_name, sweep_file_name):
+    # Load the JSON files
+    with open(file_name, 'r') as file:
+        data = json.load(file)
+    with open(sweep_file_name, 'r') as file:
+        sweep = json.load(file)
+
+    # Each variant of the sweep overrides some parameters of the ndir block
     params = data[f'ndir{ndir}']
+    return [parameters_from_block(ndir, {**params, **variant}) for variant in sweep[f'ndir{ndir}']]
 
+def parameters_from_block(ndir, params):
     # Initialize parameters
     dim = [i for i in range(ndir)]
     nlag = [params.get(f'nlag{i+1}', 0) for i in range(ndir)]
@@ -32,6 +53,26 @@ def compute_pairs():
     # Prompt user for the input ndir
     ndir = int(input("Please select the value for ndir: "))
 
+    # Prompt user for the pair search engine
+    engine = input("Please select the pair search engine (1: vectorized, 2: process pool, 3: out-of-core tiles, 4: update the pairs with appended rows, 5: parameter sweep, 6: relaxed search keeping the pair geometry, 7: re-filter the pair geometry): ").strip()
+    if engine not in ('1', '2', '3', '4', '5', '6', '7'):
+        raise ValueError("Invalid engine selection. Please select 1, 2, 3, 4, 5, 6 or 7.")
+
+    # Prompt user for the number of worker processes
+    if engine == '2':
+        num_workers = int(input(f"Please enter the number of worker processes (e.g., {os.cpu_count()}): "))
+
+    # Prompt user for the order of the filter stages
+    if engine == '1':
+        stage_mode = input("Please select the filter stage order (1: default, 2: adaptive, 3: default and report the rejections of each stage): ").strip()
+        if stage_mode not in ('1', '2', '3'):
+            raise ValueError("Invalid stage order selection. Please select 1, 2 or 3.")
+
+        # Prompt user for the order of the points during the search
+        point_order = input("Please select the order of the points during the search (1: file order, 2: Morton curve, 3: Hilbert curve): ").strip()
+        if point_order not in ('1', '2', '3'):
+            raise ValueError("Invalid point order selection. Please select 1, 2 or 3.")
+
     # Define the path to the search_parameters.json file
     script_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = os.path.dirname(script_dir)
@@ -61,6 +102,20 @@ def compute_pairs():
     selected_file_path = os.path.join(input_dir, selected_file_name)
     print(f"Selected file: {selected_file_path}")
 
+    # Create the output directory if it doesn't exist
+    output_dir = os.path.join(parent_dir, 'output')
+    os.makedirs(output_dir, exist_ok=True)
+
+    # Out-of-core search: the CSV file is never fully loaded, the pairs are spilled tile by tile
+    if engine == '3':
+        output_file_path = os.path.join(output_dir, f"seq_pairs_{os.path.splitext(selected_file_name)[0]}.pairs")
+        start_time_seq = time.time()
+        num_pairs = seq_search_pairs_gen_tiled(selected_file_path, output_file_path, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, input_file=selected_file_path)
+        time_seq = time.time() - start_time_seq
+        print(f"Out-of-core search of {num_pairs} pairs completed in {time_seq} seconds.")
+        print(f"Output saved to: {output_file_path}")
+        return
+
     # Load the CSV file into a DataFrame
     df = pd.read_csv(selected_file_path)
 
@@ -70,28 +125,120 @@ def compute_pairs():
     # Convert the DataFrame to a NumPy array
     data_vector = df.to_numpy()
 
+    # Construct the output file name
+    output_file_name = f"seq_pairs_{os.path.splitext(selected_file_name)[0]}.pairs"
+    output_file_path = os.path.join(output_dir, output_file_name)
+    params = (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    # Parameter sweep: the pairs of every variant of sweep_parameters.json are searched in one pass
+    if engine == '5':
+        param_sets = load_parameter_sets(ndir, search_parameters_path, os.path.join(parent_dir, 'sweep_parameters.json'))
+        start_time_seq = time.time()
+        sweep_pairs = seq_search_pairs_gen_sweep(data_vector, param_sets, as_index=True)
+        time_seq = time.time() - start_time_seq
+        print(f"Sweep of {len(param_sets)} parameter sets completed in {time_seq} seconds.")
+
+        # Save the pair index of each variant, with its search parameters
+        for k, (set_params, set_pairs) in enumerate(zip(param_sets, sweep_pairs)):
+            set_output_file_path = os.path.join(output_dir, f"seq_pairs_{os.path.splitext(selected_file_name)[0]}_sweep{k + 1}.pairs")
+            seq_save_pair_index(set_pairs, set_output_file_path, params=set_params, input_file=selected_file_path)
+            seq_cache_store(set_output_file_path, seq_pairs_cache_key(data_vector[:, 1:4], set_params), suffix='.pairs')
+            print(f"Output saved to: {set_output_file_path}")
+        return
+
+    # Relaxed search: the pairs and their geometry are saved, to be re-filtered with tighter parameters
+    geometry_file_path = os.path.join(output_dir, f"seq_geometry_{os.path.splitext(selected_file_name)[0]}.npz")
+    if engine == '6':
+        start_time_seq = time.time()
+        geometry = seq_search_pair_geometry(data_vector, *params)
+        print(f"Relaxed search of {geometry['rows'].shape[0]} pairs completed in {time.time() - start_time_seq} seconds.")
+        seq_save_pair_geometry(geometry, geometry_file_path)
+        print(f"Output saved to: {geometry_file_path}")
+        return
+
+    # Re-filter: the pairs of the parameters are filtered from the geometry of a relaxed search
+    if engine == '7':
+        if not os.path.exists(geometry_file_path):
+            raise ValueError(f"No pair geometry to re-filter: {geometry_file_path}")
+        start_time_seq = time.time()
+        seq_pairs = seq_refilter_pair_geometry(data_vector, seq_load_pair_geometry(geometry_file_path), *params, as_index=True)
+        print(f"Re-filter completed in {time.time() - start_time_seq} seconds.")
+        seq_save_pair_index(seq_pairs, output_file_path, params=params, input_file=selected_file_path)
+        print(f"Output saved to: {output_file_path}")
+        return
+
+    # Reuse the pairs of the same coordinates and search parameters from the cache
+    cache_key = seq_pairs_cache_key(data_vector[:, 1:4], params)
+    cached_file_path = seq_cache_lookup(cache_key)
+    if cached_file_path is not None:
+        shutil.copyfile(cached_file_path, output_file_path)
+        seq_set_pair_file_input(output_file_path, selected_file_path)
+        print("Pairs found in the cache, pair search skipped.")
+        print(f"Output saved to: {output_file_path}")
+        return
+
     # Get the pairs with sequential
     start_time_seq = time.time()
-    seq_pairs = seq_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+    # Points on a regular grid are paired by node offsets, unless the user chose the process pool,
+    # a filter stage order or a point order, which only apply to the general search
+    lattice = seq_detect_lattice(data_vector[:, 1:4]) if engine in ('1', '2') else None
+    if lattice is not None and not (engine == '1' and stage_mode == '1' and point_order == '1'):
+        print("Regular grid detected, but the general search is used for the selected engine options.")
+        lattice = None
+    if engine == '4':
+        # Only the pairs of the rows appended since the existing pair file are searched
+        if not os.path.exists(output_file_path):
+            raise ValueError(f"No pair file to update: {output_file_path}")
+        header = seq_read_pair_file_header(output_file_path)
+        if header['params'] != json.loads(json.dumps(dict(zip(PAIR_FILE_PARAMS, params)))):
+            raise ValueError("The pair file was computed with other search parameters.")
+        print(f"Updating the pairs of {header['num_points']} points with {data_vector.shape[0] - header['num_points']} appended rows.")
+        seq_pairs = seq_search_pairs_gen_incremental(data_vector, seq_load_pair_index(output_file_path, mmap=False), *params)
+
+        # Save the updated pair index to the output directory
+        seq_save_pair_index(seq_pairs, output_file_path, params=params, input_file=selected_file_path)
+    elif lattice is not None:
+        # Points on a regular grid are paired by node offsets
+        print("Regular grid detected, pairing by grid offsets.")
+        seq_pairs = seq_search_pairs_gen_lattice(data_vector, *params, lattice=lattice, as_index=True)
+
+        # Save the pair index to the output directory, with the search parameters and the hash of the input file
+        seq_save_pair_index(seq_pairs, output_file_path, params=params, input_file=selected_file_path)
+    else:
+        if engine == '1':
+            stats = seq_new_search_stats(dim) if stage_mode == '3' else None
+            reorder = {'1': None, '2': 'morton', '3': 'hilbert'}[point_order]
+            batches = seq_search_pairs_gen_batches(data_vector, *params, stage_order='adaptive' if stage_mode == '2' else None, stats=stats, reorder=reorder)
+        else:
+            batches = seq_search_pairs_gen_pool_batches(data_vector, *params, num_workers=num_workers)
+
+        # Stream the pairs of each batch of points to the output directory
+        writer = seq_open_pair_writer(output_file_path, data_vector.shape[0], ndir, max(nlag), params=params, input_file=selected_file_path)
+        for pairs in batches:
+            seq_write_pairs(writer, pairs)
+        seq_close_pair_writer(writer)
+
+        # Rejections and time of each filter stage, per direction
+        if engine == '1' and stats is not None:
+            print(seq_format_search_stats(stats))
     end_time_seq = time.time()
     time_seq = end_time_seq - start_time_seq
     print(f"Sequential function call completed in {time_seq} seconds.")
 
-    # Convert pairs to a DataFrame
-    seq_pairs_df = pd.DataFrame(seq_pairs, columns=["point_id", "dim_id", "n", "paired_point_id"])
+    # Keep the pairs in the cache for the next runs
+    seq_cache_store(output_file_path, cache_key, suffix='.pairs')
 
-    # Create the output directory if it doesn't exist
-    output_dir = os.path.join(parent_dir, 'output')
-    os.makedirs(output_dir, exist_ok=True)
+    print(f"Output saved to: {output_file_path}")
 
-    # Construct the output file name
-    output_file_name = f"seq_pairs_{os.path.splitext(selected_file_name)[0]}.json"
-    output_file_path = os.path.join(output_dir, output_file_name)
+def pair_file_num_directions(pair_file_path):
+    # Number of directions having pairs in a pair file, read from the offsets of a .pairs file
+    if pair_file_path.endswith('.pairs'):
+        index = seq_load_pair_index(pair_file_path)
+        counts = np.diff(index['offsets']).reshape(index['num_points'], index['ndir'], index['max_nlag'] + 1)
+        return int(np.count_nonzero(counts.sum(axis=(0, 2))))
 
-    # Save the output to a JSON file in the output directory
-    seq_pairs_df.to_json(output_file_path, orient='records', indent=4)
-
-    print(f"Output saved to: {output_file_path}")
+    # or from the records of a JSON file
+    return int(pd.read_json(pair_file_path)['dim_id'].nunique())
 
 def compute_cumulants():
     # Define the path to the input and output directories
@@ -118,9 +265,8 @@ def compute_cumulants():
     selected_data_file_path = os.path.join(input_dir, selected_data_file_name)
     print(f"Selected data file: {selected_data_file_path}")
 
-    # List all files in the output directory
-    # List all JSON files in the output directory
-    output_files = [f for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f)) and f.endswith('.json')]
+    # List all the pair files (binary pair index or JSON) in the output directory
+    output_files = [f for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f)) and f.endswith(('.pairs', '.json'))]
     print("Available output files:")
     for i, file_name in enumerate(output_files):
         print(f"{i + 1}: {file_name}")
@@ -137,28 +283,85 @@ def compute_cumulants():
     selected_pair_file_path = os.path.join(output_dir, selected_pair_file_name)
     print(f"Selected pair file: {selected_pair_file_path}")
 
+    # Warn if the pairs were searched on another input file
+    if selected_pair_file_path.endswith('.pairs'):
+        input_sha256 = seq_read_pair_file_header(selected_pair_file_path)['input_sha256']
+        if input_sha256 is not None and input_sha256 != seq_file_sha256(selected_data_file_path):
+            print("Warning: the pair file was not computed from the selected data file.")
+
+    # Prompt user for the cumulant engine
+    cumulant_engine = input("Please select the cumulant engine (1: table merges, 2: lag matrices): ").strip()
+    if cumulant_engine not in ('1', '2'):
+        raise ValueError("Invalid cumulant engine selection. Please select 1 or 2.")
+
+    # Determine the number of dimensions in the pairs file
+    num_dimensions = pair_file_num_directions(selected_pair_file_path)
+
+    # Prompt user for the correction terms of the 4th-order cumulant
+    correction = 'global'
+    if num_dimensions == 3:
+        correction_selection = input("Please select the 4th-order correction terms (1: global means, 2: second-order moments of each lag vector): ").strip()
+        if correction_selection not in ('1', '2'):
+            raise ValueError("Invalid correction selection. Please select 1 or 2.")
+        correction = 'global' if correction_selection == '1' else 'lag'
+
     # Prompt user to enter the number of chunks for the merging operation
-    num_chunks = int(input("Please enter the number of chunks for the merging operation(limit memory usage): "))
+    if cumulant_engine == '1':
+        num_chunks = int(input("Please enter the number of chunks for the merging operation(limit memory usage): "))
+
+        # Prompt user for the number of worker processes processing the chunks
+        num_workers = int(input(f"Please enter the number of worker processes for the chunks (1: sequential, e.g., {os.cpu_count()}): "))
+        num_workers = num_workers if num_workers > 1 else None
 
     # Measure cumulative time for the entire process
     start_time = time.time()
 
+    # Reuse the cumulants of the same pair file and data file from the cache
+    pairs_sha256, data_sha256 = seq_file_sha256(selected_pair_file_path), seq_file_sha256(selected_data_file_path)
+    cache_key = seq_cumulants_cache_key(pairs_sha256, data_sha256, variant='' if correction == 'global' else correction)
+    cached_file_path = seq_cache_lookup(cache_key)
+    if cached_file_path is not None:
+        order = '3rd' if cached_file_path.endswith('_3rd.csv') else '4th'
+        output_cumulant_file_path = os.path.join(output_dir, f"seq_cum_{order}_{os.path.splitext(selected_data_file_name)[0]}.csv")
+        shutil.copyfile(cached_file_path, output_cumulant_file_path)
+        print("Cumulants found in the cache, computation skipped.")
+        print(f"Cumulant results saved to: {output_cumulant_file_path}")
+        return
+
     # Center grades
     df_centered = center_grades(selected_data_file_path)
 
     # Associate grades with pairs
     df_associated = associate_grade(df_centered, selected_pair_file_path)
 
-    # Determine the number of dimensions in the pairs file
-    num_dimensions = df_associated['dim_id'].nunique()
-
     if num_dimensions == 2:
         print("Computing 3rd-order cumulant...")
-        cumulant_result = compute_3rd_order_cumulant(df_associated, num_chunks)
+        if cumulant_engine == '1':
+            cumulant_result = compute_3rd_order_cumulant(df_associated, num_chunks, num_workers=num_workers)
+        else:
+            cumulant_result = compute_3rd_order_cumulant_matrix(df_associated)
         output_cumulant_file_name = f"seq_cum_3rd_{os.path.splitext(selected_data_file_name)[0]}.csv"
     elif num_dimensions == 3:
+        # Reuse the second-order moment table of the same pair file and data file from the cache
+        moments = None
+        if correction == 'lag':
+            moments_key = seq_moments_cache_key(pairs_sha256, data_sha256)
+            cached_moments_path = seq_cache_lookup(moments_key)
+            if cached_moments_path is not None:
+                moments = load_second_order_moments(cached_moments_path)
+                print("Second-order moments found in the cache.")
+            else:
+                moments = second_order_moments(df_associated)
+                moments_file_path = os.path.join(output_dir, f"seq_moments_{os.path.splitext(selected_data_file_name)[0]}.npz")
+                save_second_order_moments(moments, moments_file_path)
+                seq_cache_store(moments_file_path, moments_key, suffix='.npz')
+                print(f"Second-order moments saved to: {moments_file_path}")
+
         print("Computing 4th-order cumulant...")
-        cumulant_result = compute_4th_order_cumulant(df_associated, num_chunks)
+        if cumulant_engine == '1':
+            cumulant_result = compute_4th_order_cumulant(df_associated, num_chunks, correction=correction, moments=moments, num_workers=num_workers)
+        else:
+            cumulant_result = compute_4th_order_cumulant_matrix(df_associated, correction=correction, moments=moments)
         output_cumulant_file_name = f"seq_cum_4th_{os.path.splitext(selected_data_file_name)[0]}.csv"
     else:
         raise ValueError(f"Unsupported number of dimensions: {num_dimensions}")
@@ -167,29 +370,85 @@ def compute_cumulants():
     output_cumulant_file_path = os.path.join(output_dir, output_cumulant_file_name)
     cumulant_result.to_csv(output_cumulant_file_path, index=False)
 
+    # Keep the cumulants in the cache for the next runs
+    seq_cache_store(output_cumulant_file_path, cache_key, suffix='_3rd.csv' if num_dimensions == 2 else '_4th.csv')
+
     # End time for the cumulative process
     end_time = time.time()
     print(f"Total time for computing cumulants: {end_time - start_time:.2f} seconds.")
     print(f"Cumulant results saved to: {output_cumulant_file_path}")
 
+def convert_pairs():
+    # Define the path to the search_parameters.json file and to the input and output directories
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(script_dir)
+    search_parameters_path = os.path.join(parent_dir, 'search_parameters.json')
+    input_dir = os.path.join(parent_dir, 'input')
+    output_dir = os.path.join(parent_dir, 'output')
+
+    # Prompt user for the ndir of the search that produced the JSON pairs
+    ndir = int(input("Please select the value for ndir used to compute the pairs: "))
+    params = load_parameters(ndir, file_name=search_parameters_path)
+
+    # List all the JSON pair files in the output directory
+    json_files = [f for f in os.listdir(output_dir) if os.path.isfile(os.path.join(output_dir, f)) and f.endswith('.json')]
+    print("Available JSON pair files:")
+    for i, file_name in enumerate(json_files):
+        print(f"{i + 1}: {file_name}")
+
+    # Prompt user to select a JSON pair file
+    json_file_index = int(input("Please select a JSON pair file by entering the corresponding number: ")) - 1
+
+    # Ensure the selected index is within range
+    if json_file_index < 0 or json_file_index >= len(json_files):
+        raise ValueError("Invalid file selection. Please select a valid file number.")
+
+    # List all files in the input directory
+    input_files = [f for f in os.listdir(input_dir) if os.path.isfile(os.path.join(input_dir, f))]
+    print("Available input files:")
+    for i, file_name in enumerate(input_files):
+        print(f"{i + 1}: {file_name}")
+
+    # Prompt user to select the input file of the pairs
+    file_index = int(input("Please select the input file of the pairs by entering the corresponding number: ")) - 1
+
+    # Ensure the selected index is within range
+    if file_index < 0 or file_index >= len(input_files):
+        raise ValueError("Invalid file selection. Please select a valid file number.")
+
+    json_file_path = os.path.join(output_dir, json_files[json_file_index])
+    input_file_path = os.path.join(input_dir, input_files[file_index])
+    output_file_path = os.path.splitext(json_file_path)[0] + '.pairs'
+
+    # Number of points of the input file
+    num_points = sum(chunk.shape[0] for chunk in pd.read_csv(input_file_path, usecols=[0], chunksize=1000000))
+
+    start_time = time.time()
+    seq_convert_json_pairs(json_file_path, output_file_path, num_points, ndir, max(params[1]), params=params, input_file=input_file_path)
+    print(f"Conversion completed in {time.time() - start_time} seconds.")
+    print(f"Output saved to: {output_file_path}")
+
 def main():
     while True:
         print("\nMenu:")
         print("1. Compute pairs")
         print("2. Compute cumulants from pairs")
-        print("3. Close")
+        print("3. Convert JSON pairs to a binary pair file")
+        print("4. Close")
 
-        choice = input("Please select an option (1, 2, or 3): ")
+        choice = input("Please select an option (1, 2, 3, or 4): ")
 
         if choice == '1':
             compute_pairs()
         elif choice == '2':
             compute_cumulants()
         elif choice == '3':
+            convert_pairs()
+        elif choice == '4':
             print("Closing the program.")
             break
         else:
-            print("Invalid option. Please choose 1, 2, or 3.")
+            print("Invalid option. Please choose 1, 2, 3, or 4.")
 
 if __name__ == "__main__":
     main()
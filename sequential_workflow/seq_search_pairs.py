@@ -1,11 +1,37 @@
 
+import time
+import numpy as np
 from seq_search_pairs_support import (
     seq_calculate_azimuth_3d,
     seq_calculate_dip_3d,
     seq_distance_along_horizontal_bandwidth,
     seq_distance_along_vertical_bandwidth,
-    seq_point_distance_to_shifted_plane
+    seq_point_distance_to_shifted_plane,
+    seq_direction_vector,
+    seq_calculate_azimuth_3d_block,
+    seq_calculate_dip_3d_block,
+    seq_distance_along_horizontal_bandwidth_block,
+    seq_distance_along_vertical_bandwidth_block,
+    seq_point_distance_to_shifted_plane_block,
+    seq_projection_length_block,
+    seq_projection_length_2d_block,
+    seq_distance_along_horizontal_bandwidth_2d_block,
+    seq_point_distance_to_shifted_plane_2d_block
 )
+from seq_pair_index import seq_build_pair_index, seq_merge_pair_index
+from seq_spatial_index import (
+    seq_search_bounding_boxes,
+    seq_build_grid_index,
+    seq_query_grid_index,
+    seq_projection_windows,
+    seq_build_projection_index,
+    seq_query_projection_index,
+    seq_space_filling_order
+)
+
+# Filter stages of the vectorized pair search, in their default order. The lag checks
+# come last, as they expand each pair into its lag bins.
+SEARCH_STAGES = ('azimuth', 'dip', 'bandwh', 'bandwv')
 
 def seq_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv):
     pairs = []
@@ -66,4 +92,573 @@ def seq_search_pairs_gen(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, ban
                     #Add point to pairs
                     pairs.append([int(point_id), int(dim_id), int(n), int(potential_pair_id)])
 
-    return pairs
\ No newline at end of file
+    return pairs
+
+def seq_lag_range_block(projection, nlag, lag, lag_tol):
+    """
+    Range [n_min, n_max] of the lags whose tolerance window may contain each projection
+    length. The range is widened by one lag on both sides so that the exact shifted
+    plane checks decide the bins on the boundaries.
+    """
+    if lag <= 0:
+        n_min = np.ones(projection.shape[0], dtype=np.int64)
+        n_max = np.full(projection.shape[0], nlag, dtype=np.int64)
+        return n_min, n_max
+
+    n_min = np.maximum(np.ceil((projection - lag_tol) / lag).astype(np.int64) - 1, 1)
+    n_max = np.minimum(np.floor((projection + lag_tol) / lag).astype(np.int64) + 1, nlag)
+
+    return n_min, n_max
+
+def seq_settle_dip_boundaries(cal_dip, x1, y1, z1, x2, y2, z2, dim, dip, dip_tol):
+    """
+    The scalar helper squares with pow(), which can round differently in the last bit
+    than the block helper: the dips lying on a tolerance boundary are evaluated again
+    with it. The coordinates are arrays aligned with cal_dip, or scalars.
+
+    The two dips only differ by the rounding of the squares, sqrt and arctan2, i.e. a
+    few ulps of a value below 90 degrees (under 1e-13 degrees, 7e-15 measured), so a
+    1e-9 window catches every dip that can fall on the other side of a boundary while
+    staying far below any meaningful tolerance. Pinned by tests/test_boundaries.py.
+    """
+    bounds = np.array([dip[dim_id] + sign * dip_tol[dim_id] for dim_id in dim for sign in (-1, 1)])
+    on_boundary = np.flatnonzero(np.any(np.abs(cal_dip[:, None] - bounds) <= 1e-9, axis=1))
+    if on_boundary.size == 0:
+        return cal_dip
+
+    x1, y1, z1, x2, y2, z2 = np.broadcast_arrays(x1, y1, z1, x2, y2, z2)
+    for i in on_boundary:
+        cal_dip[i] = seq_calculate_dip_3d(x1[i], y1[i], z1[i], x2[i], y2[i], z2[i])
+
+    return cal_dip
+
+def seq_azimuth_window_block(cal_azimuth, azm, azm_tol):
+    """
+    Mask of the pairs whose azimuth is within the tolerance of one direction.
+    """
+    min_azimuth = (azm - azm_tol + 360) % 360
+    max_azimuth = (azm + azm_tol + 360) % 360
+    if min_azimuth < max_azimuth:
+        return (min_azimuth <= cal_azimuth) & (cal_azimuth <= max_azimuth)
+
+    return (cal_azimuth >= min_azimuth) | (cal_azimuth <= max_azimuth)
+
+def seq_dip_window_block(cal_dip, dip, dip_tol):
+    """
+    Mask of the pairs whose dip is within the tolerance of one direction.
+    """
+    return (cal_dip <= dip + dip_tol) & (cal_dip >= dip - dip_tol)
+
+def seq_angle_window_block(cal_azimuth, cal_dip, azm, azm_tol, dip, dip_tol):
+    """
+    Mask of the pairs whose azimuth and dip are within the tolerances of one direction.
+    """
+    # Access the azimuth and dip tolerence boundaries
+    return seq_azimuth_window_block(cal_azimuth, azm, azm_tol) & seq_dip_window_block(cal_dip, dip, dip_tol)
+
+def seq_lag_bins_block(x1, y1, z1, x2, y2, z2, projection, nlag, lag, lag_tol, direction_vector):
+    """
+    Expand each pair (x1, y1, z1) -> (x2, y2, z2) into the lags its projection length
+    can fall in, and keep the lags passing the exact shifted plane checks. The
+    coordinates are arrays aligned with projection, or scalars. Returns the arrays
+    (position in projection, n) of the accepted bins.
+    """
+    n_min, n_max = seq_lag_range_block(projection, nlag, lag, lag_tol)
+    counts = np.maximum(n_max - n_min + 1, 0)
+    first = np.cumsum(counts) - counts
+    position = np.repeat(np.arange(projection.shape[0]), counts)
+    n = np.repeat(n_min - first, counts) + np.arange(position.shape[0])
+
+    x1, y1, z1, x2, y2, z2 = (c[position] if np.ndim(c) else c for c in (x1, y1, z1, x2, y2, z2))
+
+    # Access within the lag tolerance
+    distance_max_lag_tol = seq_point_distance_to_shifted_plane_block(x1, y1, z1, x2, y2, z2, (n * lag) + lag_tol, direction_vector)
+    distance_min_lag_tol = seq_point_distance_to_shifted_plane_block(x1, y1, z1, x2, y2, z2, (n * lag) - lag_tol, direction_vector)
+    accepted = (distance_max_lag_tol <= 0) & (distance_min_lag_tol >= 0)
+
+    return position[accepted], n[accepted]
+
+def seq_filter_stage_block(stage, p, x2, y2, z2, cal_azimuth, cal_dip, keep, dim_id, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vector):
+    """
+    Mask of the candidates (x2, y2, z2) at the keep positions passing one filter stage
+    (see SEARCH_STAGES) of direction dim_id for the anchor point p.
+    """
+    if stage == 'azimuth':
+        return seq_azimuth_window_block(cal_azimuth[keep], azm[dim_id], azm_tol[dim_id])
+    if stage == 'dip':
+        return seq_dip_window_block(cal_dip[keep], dip[dim_id], dip_tol[dim_id])
+    if stage == 'bandwh':
+        return np.abs(seq_distance_along_horizontal_bandwidth_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], direction_vector)) <= bandwh[dim_id]
+    if stage == 'bandwv':
+        return np.abs(seq_distance_along_vertical_bandwidth_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], direction_vector)) <= bandwv[dim_id]
+
+    raise ValueError(f"Unknown filter stage: {stage}")
+
+def seq_new_search_stats(dim):
+    """
+    Empty counters of the filter stages of each direction, filled by the pair search:
+    stats[dim_id][stage] holds the number of candidates evaluated and rejected by the
+    stage and the time spent in it, the 'lag' stage being the lag checks.
+    """
+    return {dim_id: {stage: {'evaluated': 0, 'rejected': 0, 'time': 0.0} for stage in SEARCH_STAGES + ('lag',)} for dim_id in dim}
+
+def seq_count_stage(stats, dim_id, stage, evaluated, passed, start):
+    """
+    Add the candidates evaluated and rejected by a stage, and the time since start.
+    """
+    counters = stats[dim_id][stage]
+    counters['evaluated'] += evaluated
+    counters['rejected'] += evaluated - passed
+    counters['time'] += time.perf_counter() - start
+
+def seq_format_search_stats(stats):
+    """
+    Report of the filter stage counters of each direction, one line per stage.
+    """
+    lines = []
+    for dim_id, stages in stats.items():
+        lines.append(f"Direction {dim_id}:")
+        for stage, counters in stages.items():
+            rate = counters['rejected'] / counters['evaluated'] * 100 if counters['evaluated'] else 0.0
+            lines.append(f"  {stage:<8} rejected {counters['rejected']} of {counters['evaluated']} ({rate:.1f}%) in {counters['time']:.3f} s")
+
+    return "\n".join(lines)
+
+def seq_classify_candidates_block(p, candidates, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vectors, stage_order=None, stats=None):
+    """
+    Classify a block of candidate rows against the anchor point p into every
+    (dim_id, n) bin they satisfy. The azimuth and dip of each pair are computed once,
+    the filter stages are applied per direction in the order of stage_order[dim_id]
+    (SEARCH_STAGES by default), each on the candidates left by the previous ones, and
+    the lags are read from the projection instead of testing every lag. With stats
+    (see seq_new_search_stats), the candidates rejected by each stage and the time
+    spent in it are counted. Returns the arrays (dim_id, n, index into candidates) of
+    the accepted pairs.
+    """
+    # Ensure potential pair point is not itself
+    idx = np.flatnonzero(candidates[:, 0] != p[0])
+    x2, y2, z2 = candidates[idx, 1], candidates[idx, 2], candidates[idx, 3]
+
+    # The azimuth and the dip of a pair do not depend on the direction
+    cal_azimuth = seq_calculate_azimuth_3d_block(p[1], p[2], p[3], x2, y2, z2)
+    cal_dip = seq_calculate_dip_3d_block(p[1], p[2], p[3], x2, y2, z2)
+    cal_dip = seq_settle_dip_boundaries(cal_dip, p[1], p[2], p[3], x2, y2, z2, dim, dip, dip_tol)
+
+    found_dim, found_n, found_idx = [], [], []
+    for dim_id in dim:
+        direction_vector = direction_vectors[dim_id]
+
+        # Access the tolerence and bandwidth boundaries, stage by stage
+        keep = np.arange(idx.shape[0])
+        for stage in (stage_order[dim_id] if stage_order is not None else SEARCH_STAGES):
+            start = time.perf_counter() if stats is not None else None
+            accepted = seq_filter_stage_block(stage, p, x2, y2, z2, cal_azimuth, cal_dip, keep, dim_id, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vector)
+            if stats is not None:
+                seq_count_stage(stats, dim_id, stage, keep.shape[0], np.count_nonzero(accepted), start)
+            keep = keep[accepted]
+
+        # Access within the lag tolerance of the lags the projection can fall in
+        start = time.perf_counter() if stats is not None else None
+        projection = seq_projection_length_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], direction_vector)
+        position, n = seq_lag_bins_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], projection, nlag[dim_id], lag[dim_id], lag_tol[dim_id], direction_vector)
+        if stats is not None:
+            seq_count_stage(stats, dim_id, 'lag', keep.shape[0], np.unique(position).shape[0], start)
+
+        found_dim.append(np.full(n.shape[0], dim_id, dtype=np.int64))
+        found_n.append(n)
+        found_idx.append(idx[keep[position]])
+
+    return np.concatenate(found_dim), np.concatenate(found_n), np.concatenate(found_idx)
+
+def seq_plan_stage_order(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, sample_size=256, block_size=4096):
+    """
+    Order of the filter stages of each direction for this dataset and these parameters,
+    from the counters of a search of sample_size anchors spread over data_vector. The
+    stages are ranked by their time per rejected candidate, so the cheapest stage
+    rejecting the most candidates runs first. The pairs found do not depend on the order.
+    """
+    stats = seq_new_search_stats(dim)
+    anchor_rows = np.unique(np.linspace(0, data_vector.shape[0] - 1, min(sample_size, data_vector.shape[0])).astype(np.int64))
+    seq_search_pairs_anchors(data_vector, anchor_rows, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, dict(search, stats=stats, planar_xy=None), block_size=block_size)
+
+    stage_order = {}
+    for dim_id in dim:
+        def rank(stage):
+            counters = stats[dim_id][stage]
+            if counters['evaluated'] == 0:
+                return np.inf
+            # Time per candidate over the fraction of candidates rejected
+            return (counters['time'] / counters['evaluated']) / max(counters['rejected'] / counters['evaluated'], 1e-12)
+        stage_order[dim_id] = tuple(sorted(SEARCH_STAGES, key=rank))
+
+    return stage_order
+
+def seq_lag_bins_2d_block(x1, y1, x2, y2, projection, nlag, lag, lag_tol, direction_vector):
+    """
+    Planar version of seq_lag_bins_block, for points with the same Z and a horizontal
+    direction vector.
+    """
+    n_min, n_max = seq_lag_range_block(projection, nlag, lag, lag_tol)
+    counts = np.maximum(n_max - n_min + 1, 0)
+    first = np.cumsum(counts) - counts
+    position = np.repeat(np.arange(projection.shape[0]), counts)
+    n = np.repeat(n_min - first, counts) + np.arange(position.shape[0])
+
+    x1, y1, x2, y2 = (c[position] if np.ndim(c) else c for c in (x1, y1, x2, y2))
+
+    # Access within the lag tolerance
+    distance_max_lag_tol = seq_point_distance_to_shifted_plane_2d_block(x1, y1, x2, y2, (n * lag) + lag_tol, direction_vector)
+    distance_min_lag_tol = seq_point_distance_to_shifted_plane_2d_block(x1, y1, x2, y2, (n * lag) - lag_tol, direction_vector)
+    accepted = (distance_max_lag_tol <= 0) & (distance_min_lag_tol >= 0)
+
+    return position[accepted], n[accepted]
+
+def seq_classify_candidates_planar_block(p, candidates_xy, candidates_id, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vectors):
+    """
+    Planar version of seq_classify_candidates_block, for points with the same Z and
+    horizontal directions (see seq_prepare_pair_search). The dip of every pair is 0 and
+    its vertical bandwidth distance is 0, so these stages reduce to a check of each
+    direction, and the other stages only use the X and Y of the (M, 2) candidates_xy.
+    Returns the arrays (dim_id, n, index into the candidates) of the accepted pairs.
+    """
+    # Ensure potential pair point is not itself
+    idx = np.flatnonzero(candidates_id != p[0])
+    x2, y2 = candidates_xy[idx, 0], candidates_xy[idx, 1]
+
+    # The azimuth of a pair does not depend on the direction
+    cal_azimuth = seq_calculate_azimuth_3d_block(p[1], p[2], None, x2, y2, None)
+
+    found_dim, found_n, found_idx = [], [], []
+    for dim_id in dim:
+        direction_vector = direction_vectors[dim_id]
+
+        # Access the dip tolerence and vertical bandwidth boundaries, the same for every pair
+        if not (dip[dim_id] - dip_tol[dim_id] <= 0 <= dip[dim_id] + dip_tol[dim_id]) or bandwv[dim_id] < 0:
+            continue
+
+        # Access the azimuth tolerence boundaries
+        keep = np.flatnonzero(seq_angle_window_block(cal_azimuth, 0.0, azm[dim_id], azm_tol[dim_id], 0.0, 0.0))
+
+        # Access the horizontal bandwidth boundaries
+        distance_banwh = seq_distance_along_horizontal_bandwidth_2d_block(p[1], p[2], x2[keep], y2[keep], direction_vector)
+        keep = keep[np.abs(distance_banwh) <= bandwh[dim_id]]
+
+        # Access within the lag tolerance of the lags the projection can fall in
+        projection = seq_projection_length_2d_block(p[1], p[2], x2[keep], y2[keep], direction_vector)
+        position, n = seq_lag_bins_2d_block(p[1], p[2], x2[keep], y2[keep], projection, nlag[dim_id], lag[dim_id], lag_tol[dim_id], direction_vector)
+
+        found_dim.append(np.full(n.shape[0], dim_id, dtype=np.int64))
+        found_n.append(n)
+        found_idx.append(idx[keep[position]])
+
+    if not found_n:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    return np.concatenate(found_dim), np.concatenate(found_n), np.concatenate(found_idx)
+
+def seq_classify_candidates_symmetric_block(p, candidates, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, direction_vectors):
+    """
+    Classify both orientations of the pairs between the anchor point p and a block of
+    candidate rows: p -> candidate and candidate -> p. The reverse vector is the exact
+    opposite of the forward one, so the dip, the bandwidth distances and the projection
+    are computed once for both orientations; only the azimuth and the shifted plane
+    checks are evaluated per orientation. Returns the arrays (dim_id, n, index into
+    candidates) of the pairs anchored at p, then of the pairs anchored at the candidates.
+    """
+    # Ensure potential pair point is not itself
+    idx = np.flatnonzero(candidates[:, 0] != p[0])
+    x2, y2, z2 = candidates[idx, 1], candidates[idx, 2], candidates[idx, 3]
+
+    # The azimuth is evaluated in both orientations, the reverse dip is the opposite one
+    cal_azimuth = seq_calculate_azimuth_3d_block(p[1], p[2], p[3], x2, y2, z2)
+    cal_azimuth_reverse = seq_calculate_azimuth_3d_block(x2, y2, z2, p[1], p[2], p[3])
+    cal_dip = seq_calculate_dip_3d_block(p[1], p[2], p[3], x2, y2, z2)
+    cal_dip_reverse = seq_settle_dip_boundaries(-cal_dip, x2, y2, z2, p[1], p[2], p[3], dim, dip, dip_tol)
+    cal_dip = seq_settle_dip_boundaries(cal_dip, p[1], p[2], p[3], x2, y2, z2, dim, dip, dip_tol)
+
+    found = ([], [], []), ([], [], [])
+    for dim_id in dim:
+        direction_vector = direction_vectors[dim_id]
+
+        # Access the azimuth and dip tolerence boundaries in both orientations
+        forward = seq_angle_window_block(cal_azimuth, cal_dip, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id])
+        reverse = seq_angle_window_block(cal_azimuth_reverse, cal_dip_reverse, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id])
+        keep = np.flatnonzero(forward | reverse)
+
+        # Access the bandwidth boundaries, the perpendicular vector only changes sign
+        distance_banwh = seq_distance_along_horizontal_bandwidth_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], direction_vector)
+        distance_banwv = seq_distance_along_vertical_bandwidth_block(p[1], p[2], p[3], x2[keep], y2[keep], z2[keep], direction_vector)
+        keep = keep[(np.abs(distance_banwh) <= bandwh[dim_id]) & (np.abs(distance_banwv) <= bandwv[dim_id])]
+
+        # Both orientations go through the lag checks together, the reverse projection
+        # length being the opposite one
+        oriented = np.concatenate((keep[forward[keep]], keep[reverse[keep]]))
+        is_reverse = np.arange(oriented.shape[0]) >= np.count_nonzero(forward[keep])
+        projection = seq_projection_length_block(p[1], p[2], p[3], x2[oriented], y2[oriented], z2[oriented], direction_vector)
+        projection[is_reverse] *= -1
+        x1_oriented, x2_oriented = np.where(is_reverse, x2[oriented], p[1]), np.where(is_reverse, p[1], x2[oriented])
+        y1_oriented, y2_oriented = np.where(is_reverse, y2[oriented], p[2]), np.where(is_reverse, p[2], y2[oriented])
+        z1_oriented, z2_oriented = np.where(is_reverse, z2[oriented], p[3]), np.where(is_reverse, p[3], z2[oriented])
+        position, n = seq_lag_bins_block(x1_oriented, y1_oriented, z1_oriented, x2_oriented, y2_oriented, z2_oriented, projection, nlag[dim_id], lag[dim_id], lag_tol[dim_id], direction_vector)
+
+        for orientation in (0, 1):
+            selected = is_reverse[position] == orientation
+            found[orientation][0].append(np.full(np.count_nonzero(selected), dim_id, dtype=np.int64))
+            found[orientation][1].append(n[selected])
+            found[orientation][2].append(idx[oriented[position[selected]]])
+
+    return tuple(np.concatenate(values) for orientation in found for values in orientation)
+
+def seq_prepare_pair_search(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, use_index=True, index_type='grid', stage_order=None, stats=None):
+    """
+    Precompute what the pair search needs once per dataset: the direction vectors and,
+    with use_index, the index of the points. The index_type is 'grid' for a grid index
+    over the search boxes, or 'projection' for the points sorted by their projection
+    onto each direction, searched by lag windows. When every point has the same Z, the
+    X and Y of the points are kept for the planar path. The stage_order of the filter
+    stages of each direction and the stats counters are passed to
+    seq_classify_candidates_block; with stage_order='adaptive' the order is planned from
+    a sample of the anchors (see seq_plan_stage_order).
+    """
+    search = {
+        # The direction vectors only depend on the direction, compute them once
+        'direction_vectors': [seq_direction_vector(azm[dim_id], dip[dim_id]) for dim_id in dim],
+        'boxes': None,
+        'index': None,
+        'projection_index': None,
+        'windows': None,
+        'planar_xy': None,
+        'stage_order': None if stage_order == 'adaptive' else stage_order,
+        'stats': stats,
+    }
+
+    # Points with the same Z, and directions either horizontal or whose dip window excludes
+    # the dip 0 of every pair: planar path, on the X and Y only
+    coords = data_vector[:, 1:4]
+    planar = all(search['direction_vectors'][dim_id][2] == 0 or not (dip[dim_id] - dip_tol[dim_id] <= 0 <= dip[dim_id] + dip_tol[dim_id]) for dim_id in dim)
+    # The planar path keeps its own stage order, without counters
+    if planar and stage_order is None and stats is None and coords.shape[0] > 0 and np.all(coords[:, 2] == coords[0, 2]):
+        search['planar_xy'] = np.ascontiguousarray(coords[:, :2])
+
+    # Build the spatial index once for the dataset
+    if use_index and index_type == 'grid':
+        search['boxes'] = seq_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+        search['index'] = seq_build_grid_index(data_vector[:, 1:4], search['boxes'])
+    elif use_index and index_type == 'projection':
+        search['projection_index'] = seq_build_projection_index(data_vector[:, 1:4], search['direction_vectors'])
+        margin = search['projection_index']['margin']
+        search['windows'] = [seq_projection_windows(nlag[dim_id], lag[dim_id], lag_tol[dim_id], margin + 1e-9 * (abs(nlag[dim_id] * lag[dim_id]) + lag_tol[dim_id])) for dim_id in dim]
+    elif use_index:
+        raise ValueError(f"Unknown index type: {index_type}")
+
+    # Order the filter stages for this dataset
+    if stage_order == 'adaptive':
+        search['stage_order'] = seq_plan_stage_order(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search)
+
+    return search
+
+def seq_search_pairs_anchors(data_vector, anchor_rows, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=4096, symmetric=False):
+    """
+    Search the pairs of the points at the anchor_rows of data_vector, using the search
+    prepared by seq_prepare_pair_search. Returns an (M, 4) array of
+    [point_row, dim_id, n, paired_point_row] rows, ordered like seq_search_pairs_gen.
+    With symmetric, each anchor is only paired with the rows after it, in both
+    orientations, and the rows are not ordered (see seq_sort_pairs). This is used by
+    seq_search_pairs_gen_incremental to pair the appended rows with every other row
+    without searching the other rows as anchors; for a full search it is slower than
+    searching every anchor in one orientation.
+    """
+    all_rows = np.arange(data_vector.shape[0])
+    index, boxes = search['index'], search['boxes']
+    projection_index, windows = search['projection_index'], search['windows']
+
+    pairs = [np.zeros((0, 4), dtype=np.int64)]
+    # for each points
+    for anchor_row in anchor_rows:
+        p = data_vector[anchor_row]
+
+        # Potential pairs of the directions to check: restricted to the reachable boxes
+        # of all the directions, extended to the reverse orientation with symmetric, or
+        # to the lag windows of each direction
+        if index is not None:
+            query_boxes = [boxes[dim_id] for dim_id in dim]
+            if symmetric:
+                query_boxes = [np.array([np.minimum(box[0], -box[1]), np.maximum(box[1], -box[0])]) for box in query_boxes]
+            queries = [(dim, np.unique(np.concatenate([seq_query_grid_index(index, p[1:4], box) for box in query_boxes])))]
+        elif projection_index is not None:
+            queries = []
+            for dim_id in dim:
+                rows = seq_query_projection_index(projection_index, anchor_row, dim_id, windows[dim_id])
+                if symmetric:
+                    reverse_rows = seq_query_projection_index(projection_index, anchor_row, dim_id, -windows[dim_id][::-1, ::-1])
+                    rows = np.unique(np.concatenate((rows, reverse_rows)))
+                queries.append(([dim_id], rows))
+        else:
+            queries = [(dim, all_rows)]
+
+        for query_dim, rows in queries:
+            # Each unordered pair is evaluated once, from its first row
+            if symmetric:
+                rows = rows[rows > anchor_row]
+
+            # for each block of potential pairs
+            for start in range(0, rows.shape[0], block_size):
+                block_rows = rows[start:start + block_size]
+
+                if symmetric:
+                    candidates = data_vector[block_rows]
+                    found_dim, found_n, found_idx, reverse_dim, reverse_n, reverse_idx = seq_classify_candidates_symmetric_block(p, candidates, query_dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search['direction_vectors'])
+                    pairs.append(np.column_stack((block_rows[reverse_idx], reverse_dim, reverse_n, np.full(reverse_idx.shape[0], anchor_row))))
+                elif search['planar_xy'] is not None:
+                    found_dim, found_n, found_idx = seq_classify_candidates_planar_block(p, search['planar_xy'][block_rows], data_vector[block_rows, 0], query_dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search['direction_vectors'])
+                else:
+                    candidates = data_vector[block_rows]
+                    found_dim, found_n, found_idx = seq_classify_candidates_block(p, candidates, query_dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search['direction_vectors'], stage_order=search['stage_order'], stats=search['stats'])
+
+                #Add points to pairs
+                pairs.append(np.column_stack((np.full(found_idx.shape[0], anchor_row), found_dim, found_n, block_rows[found_idx])))
+
+    pairs = np.concatenate(pairs).astype(np.int64)
+
+    # Same order as the nested loops: by dimension, then lag, then potential pair
+    if not symmetric:
+        pairs = seq_sort_pairs(pairs)
+
+    return pairs
+
+def seq_sort_pairs(pairs):
+    """
+    Sort [point_row, dim_id, n, paired_point_row] rows in the order of seq_search_pairs_gen.
+    The columns are combined into a single key when it fits in 64 bits, which sorts
+    much faster than a lexsort.
+    """
+    if pairs.shape[0] == 0:
+        return pairs
+
+    # Range of each column
+    bounds = pairs.max(axis=0) + 1
+    if float(np.prod(bounds.astype(np.float64))) < 2**62:
+        key = ((pairs[:, 0] * bounds[1] + pairs[:, 1]) * bounds[2] + pairs[:, 2]) * bounds[3] + pairs[:, 3]
+        order = np.argsort(key)
+    else:
+        order = np.lexsort((pairs[:, 3], pairs[:, 2], pairs[:, 1], pairs[:, 0]))
+
+    return pairs[order]
+
+def seq_pairs_rows_to_ids(data_vector, pairs):
+    """
+    Replace the point rows of [point_row, dim_id, n, paired_point_row] rows by the point ids.
+    """
+    point_ids = data_vector[:, 0].astype(np.int64)
+    pairs = pairs.copy()
+    pairs[:, 0] = point_ids[pairs[:, 0]]
+    pairs[:, 3] = point_ids[pairs[:, 3]]
+
+    return pairs
+
+def seq_reordered_pairs_to_rows(pairs, order):
+    """
+    Map the [point_row, dim_id, n, paired_point_row] rows of a search on the points
+    reordered by order (see seq_space_filling_order) back to the original rows, sorted
+    in the order of seq_search_pairs_gen.
+    """
+    pairs = pairs.copy()
+    pairs[:, 0] = order[pairs[:, 0]]
+    pairs[:, 3] = order[pairs[:, 3]]
+
+    return seq_sort_pairs(pairs)
+
+def seq_search_pairs_gen_vectorized(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, block_size=4096, use_index=True, index_type='grid', as_index=False, stage_order=None, stats=None, reorder=None):
+    """
+    Vectorized equivalent of seq_search_pairs_gen. Each point is tested against blocks of
+    block_size candidates at once with array operations, and each pair is classified in
+    a single pass into all the (dim_id, n) bins it satisfies, overlapping lag windows
+    included. With use_index, a grid index built once for the dataset restricts the
+    candidates of each point to the boxes reachable within nlag lags and the bandwidths,
+    or with index_type='projection' to the lag windows of each direction, found by
+    binary search in the points sorted by projection (see seq_prepare_pair_search).
+    The filter stages run in stage_order ('adaptive' to plan it from a sample), and
+    with stats (see seq_new_search_stats) their rejections and time are counted.
+    With reorder ('morton' or 'hilbert'), the points are searched in the order of that
+    space-filling curve (see seq_space_filling_order), so that the candidates of
+    neighbouring anchors are read from nearby memory; the pairs are mapped back to the
+    original rows. Returns the same [point_id, dim_id, n, paired_point_id] list, in the same order, or
+    with as_index the CSR pair index of these rows (see seq_build_pair_index).
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+
+    # Points in the order of the space-filling curve
+    order = seq_space_filling_order(data_vector[:, 1:4], curve=reorder) if reorder is not None else None
+    search_data_vector = data_vector[order] if order is not None else data_vector
+
+    search = seq_prepare_pair_search(search_data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, use_index=use_index, index_type=index_type, stage_order=stage_order, stats=stats)
+    pairs = seq_search_pairs_anchors(search_data_vector, range(data_vector.shape[0]), dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=block_size)
+    if order is not None:
+        pairs = seq_reordered_pairs_to_rows(pairs, order)
+
+    pairs = seq_pairs_rows_to_ids(data_vector, pairs)
+    if as_index:
+        return seq_build_pair_index(pairs, data_vector.shape[0], len(dim), max(nlag))
+
+    return pairs.tolist()
+
+def seq_search_pairs_gen_batches(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, anchors_per_batch=1024, block_size=4096, use_index=True, index_type='grid', stage_order=None, stats=None, reorder=None):
+    """
+    Generator version of seq_search_pairs_gen_vectorized: the points are searched by
+    batches of anchors_per_batch and the pairs of each batch are yielded as soon as they
+    are found, as an (M, 4) array of [point_id, dim_id, n, paired_point_id] rows. The
+    batches follow each other in the order of seq_search_pairs_gen, so they can be
+    streamed to a pair file (see seq_open_pair_writer) without holding all the pairs
+    in memory. The stage_order, stats and reorder are those of
+    seq_search_pairs_gen_vectorized; with reorder, the candidates are read from the
+    reordered points while the batches keep the original row order.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+
+    # Points in the order of the space-filling curve, and the reordered row of each point
+    order = seq_space_filling_order(data_vector[:, 1:4], curve=reorder) if reorder is not None else None
+    search_data_vector = data_vector[order] if order is not None else data_vector
+    if order is not None:
+        reordered_rows = np.empty_like(order)
+        reordered_rows[order] = np.arange(order.shape[0])
+
+    search = seq_prepare_pair_search(search_data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, use_index=use_index, index_type=index_type, stage_order=stage_order, stats=stats)
+    for start in range(0, data_vector.shape[0], anchors_per_batch):
+        anchor_rows = range(start, min(start + anchors_per_batch, data_vector.shape[0]))
+        if order is not None:
+            pairs = seq_search_pairs_anchors(search_data_vector, reordered_rows[start:anchor_rows.stop], dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=block_size)
+            pairs = seq_reordered_pairs_to_rows(pairs, order)
+        else:
+            pairs = seq_search_pairs_anchors(data_vector, anchor_rows, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=block_size)
+
+        yield seq_pairs_rows_to_ids(data_vector, pairs)
+
+def seq_search_pairs_gen_incremental(data_vector, index, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, block_size=4096, use_index=True, index_type='grid'):
+    """
+    Update the pair index of the first index['num_points'] rows of data_vector with the
+    rows appended after them. Only the pairs involving an appended point are searched:
+    the appended rows are moved before the others and searched as anchors in symmetric
+    mode, so each pair of an appended point with any other point is evaluated once for
+    both orientations, for O(appended * N) work. Returns the pair index of the whole
+    data_vector, the same as a full search (see seq_merge_pair_index).
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+    num_points, num_old = data_vector.shape[0], index['num_points']
+    if num_old > num_points:
+        raise ValueError(f"The pair index has {num_old} points, more than the {num_points} rows of the data.")
+    if index['ndir'] != len(dim) or index['max_nlag'] != max(nlag):
+        raise ValueError("The pair index was not computed with the same directions and lags.")
+
+    # Appended rows first, then the rows of the index
+    permutation = np.concatenate((np.arange(num_old, num_points), np.arange(num_old)))
+    permuted = data_vector[permutation]
+
+    search = seq_prepare_pair_search(permuted, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, use_index=use_index, index_type=index_type)
+    pairs = seq_search_pairs_anchors(permuted, range(num_points - num_old), dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=block_size, symmetric=True)
+
+    # Back to the rows of data_vector, in the order of seq_search_pairs_gen
+    pairs[:, 0] = permutation[pairs[:, 0]]
+    pairs[:, 3] = permutation[pairs[:, 3]]
+    pairs = seq_pairs_rows_to_ids(data_vector, seq_sort_pairs(pairs))
+
+    return seq_merge_pair_index(index, pairs, num_points)
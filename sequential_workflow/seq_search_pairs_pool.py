@@ -0,0 +1,88 @@
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from seq_search_pairs import seq_prepare_pair_search, seq_search_pairs_anchors, seq_pairs_rows_to_ids
+from seq_pair_index import seq_build_pair_index
+
+# State of each worker process, set once by seq_init_pairs_worker
+worker_state = {}
+
+def seq_init_pairs_worker(shm_name, shape, params, use_index, index_type, block_size):
+    """
+    Attach the worker process to the shared data_vector and prepare the pair search once.
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    data_vector = np.ndarray(shape, dtype=np.float64, buffer=shm.buf)
+
+    worker_state['shm'] = shm
+    worker_state['data_vector'] = data_vector
+    worker_state['params'] = params
+    worker_state['block_size'] = block_size
+    worker_state['search'] = seq_prepare_pair_search(data_vector, *params, use_index=use_index, index_type=index_type)
+
+def seq_search_pairs_worker(start, end):
+    """
+    Search the pairs of the anchor rows [start, end) in a worker process.
+    """
+    return seq_search_pairs_anchors(worker_state['data_vector'], range(start, end), *worker_state['params'], worker_state['search'], block_size=worker_state['block_size'])
+
+def seq_search_pairs_pool_batches(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_workers=None, anchors_per_task=1024, block_size=4096, use_index=True, index_type='grid'):
+    """
+    Search the blocks of anchors_per_task rows with a pool of num_workers processes and
+    yield the [point_row, dim_id, n, paired_point_row] rows of each block, in block order,
+    as soon as it is done. The data_vector is shared with the workers through shared
+    memory, released when the generator ends.
+    """
+    params = (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    # Copy the data_vector once into shared memory
+    shm = shared_memory.SharedMemory(create=True, size=max(data_vector.nbytes, 1))
+    try:
+        shared_data_vector = np.ndarray(data_vector.shape, dtype=np.float64, buffer=shm.buf)
+        shared_data_vector[:] = data_vector
+
+        starts = list(range(0, data_vector.shape[0], anchors_per_task))
+        ends = [min(start + anchors_per_task, data_vector.shape[0]) for start in starts]
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=seq_init_pairs_worker, initargs=(shm.name, data_vector.shape, params, use_index, index_type, block_size)) as executor:
+            # map returns the results in the order of the blocks
+            yield from executor.map(seq_search_pairs_worker, starts, ends)
+
+        del shared_data_vector
+    finally:
+        shm.close()
+        shm.unlink()
+
+def seq_search_pairs_gen_pool(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_workers=None, anchors_per_task=1024, block_size=4096, use_index=True, index_type='grid', as_index=False):
+    """
+    Multi-process version of seq_search_pairs_gen_vectorized. The anchor points are split
+    into blocks of anchors_per_task rows, searched by a pool of num_workers processes
+    (all the CPUs by default). The data_vector is shared with the workers through shared
+    memory instead of being pickled, and the blocks are merged in anchor order, so the
+    output is the same as seq_search_pairs_gen_vectorized, a list or with as_index a CSR
+    pair index.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+    num_workers = num_workers or os.cpu_count()
+
+    results = list(seq_search_pairs_pool_batches(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_workers=num_workers, anchors_per_task=anchors_per_task, block_size=block_size, use_index=use_index, index_type=index_type))
+
+    pairs = np.concatenate([np.zeros((0, 4), dtype=np.int64)] + results)
+    pairs = seq_pairs_rows_to_ids(data_vector, pairs)
+    if as_index:
+        return seq_build_pair_index(pairs, data_vector.shape[0], len(dim), max(nlag))
+
+    return pairs.tolist()
+
+def seq_search_pairs_gen_pool_batches(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_workers=None, anchors_per_task=1024, block_size=4096, use_index=True, index_type='grid'):
+    """
+    Generator version of seq_search_pairs_gen_pool, yielding the [point_id, dim_id, n,
+    paired_point_id] rows of each block of anchors in the order of seq_search_pairs_gen,
+    to be streamed to a pair file (see seq_open_pair_writer).
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+    num_workers = num_workers or os.cpu_count()
+
+    for pairs in seq_search_pairs_pool_batches(data_vector, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, num_workers=num_workers, anchors_per_task=anchors_per_task, block_size=block_size, use_index=use_index, index_type=index_type):
+        yield seq_pairs_rows_to_ids(data_vector, pairs)
@@ -124,4 +124,162 @@ def seq_point_distance_to_shifted_plane(x1, y1, z1, x2, y2, z2, lag, azimuth, di
     # Calculate the distance from the point to the shifted plane using the dot product
     distance = np.dot(vector_to_point, normal_vector) / np.linalg.norm(normal_vector)
 
-    return distance
\ No newline at end of file
+    return distance
+
+def seq_direction_vector(azimuth, dip):
+    """
+    Calculate the unit direction vector defined by azimuth and dip (in degrees).
+    """
+    # Convert azimuth and dip from degrees to radians
+    azimuth_rad = np.radians(azimuth)
+    dip_rad = np.radians(dip)
+
+    # Calculate the direction vector based on azimuth and dip
+    dx = np.cos(dip_rad) * np.cos(azimuth_rad)
+    dy = np.cos(dip_rad) * np.sin(azimuth_rad)
+    dz = np.sin(dip_rad)
+
+    return np.array([dx, dy, dz])
+
+def seq_calculate_azimuth_3d_block(x1, y1, z1, x2, y2, z2):
+    """
+    Calculate the azimuth between the point (x1, y1, z1) and every point of the
+    coordinate arrays (x2, y2, z2).
+    """
+    # Calculate the differences in coordinates
+    dx = x2 - x1
+    dy = y2 - y1
+
+    # Calculate the azimuth and convert from radians to degrees
+    azimuth_degrees = np.degrees(np.arctan2(dy, dx))
+
+    # Normalize the azimuth to be between 0 and 360 degrees
+    azimuth_degrees[azimuth_degrees < 0] += 360
+
+    return azimuth_degrees
+
+def seq_calculate_dip_3d_block(x1, y1, z1, x2, y2, z2):
+    """
+    Calculate the dip (elevation angle) between the point (x1, y1, z1) and every point
+    of the coordinate arrays (x2, y2, z2).
+    """
+    # Calculate the differences in coordinates
+    dx = x2 - x1
+    dy = y2 - y1
+    dz = z2 - z1
+
+    # Calculate the horizontal distance between the points
+    horizontal_distance = np.sqrt(dx**2 + dy**2)
+
+    # Calculate the dip and convert from radians to degrees
+    dip = np.degrees(np.arctan2(dz, horizontal_distance))
+
+    return dip
+
+def seq_dot_block(vectors, direction_vector):
+    """
+    Row-wise dot product of the (M, 3) vectors with the direction vector, or with the
+    rows of another (M, 3) array (or (M, 2) for the planar helpers). Evaluated as a
+    batched matmul, which uses the same kernel as np.dot, so the results match the
+    scalar helpers bit for bit (pinned by tests/test_boundaries.py).
+    """
+    return np.matmul(vectors[:, None, :], np.reshape(direction_vector, (-1, vectors.shape[1], 1)))[:, 0, 0]
+
+def seq_projection_length_block(x1, y1, z1, x2, y2, z2, direction_vector):
+    """
+    Calculate the length of the projection onto the direction vector of the vectors
+    from the point (x1, y1, z1) to every point of the coordinate arrays (x2, y2, z2).
+    """
+    vector_to_point = np.column_stack((x2 - x1, y2 - y1, z2 - z1))
+
+    return seq_dot_block(vector_to_point, direction_vector)
+
+def seq_perpendicular_vector_block(x1, y1, z1, x2, y2, z2, direction_vector):
+    """
+    Calculate the (M, 3) vectors from the point (x1, y1, z1) to every point of the
+    coordinate arrays (x2, y2, z2) perpendicular to the direction vector.
+    """
+    # Vectors from the initial point to the second points
+    vector_to_point = np.column_stack((x2 - x1, y2 - y1, z2 - z1))
+
+    # Project the vectors onto the direction_vector
+    projection_length = seq_dot_block(vector_to_point, direction_vector)
+    projection_vector = projection_length[:, None] * direction_vector
+
+    # Remove the projection to keep the perpendicular components
+    return vector_to_point - projection_vector
+
+def seq_distance_along_horizontal_bandwidth_block(x1, y1, z1, x2, y2, z2, direction_vector):
+    """
+    Block version of seq_distance_along_horizontal_bandwidth, taking the precomputed
+    direction vector (see seq_direction_vector).
+    """
+    perpendicular_vector = seq_perpendicular_vector_block(x1, y1, z1, x2, y2, z2, direction_vector)
+
+    return np.sqrt(seq_dot_block(perpendicular_vector, perpendicular_vector))
+
+def seq_distance_along_vertical_bandwidth_block(x1, y1, z1, x2, y2, z2, direction_vector):
+    """
+    Block version of seq_distance_along_vertical_bandwidth, taking the precomputed
+    direction vector (see seq_direction_vector).
+    """
+    perpendicular_vector = seq_perpendicular_vector_block(x1, y1, z1, x2, y2, z2, direction_vector)
+
+    return np.abs(perpendicular_vector[:, 2])
+
+def seq_point_distance_to_shifted_plane_block(x1, y1, z1, x2, y2, z2, lag, direction_vector):
+    """
+    Block version of seq_point_distance_to_shifted_plane, taking the precomputed
+    direction vector (see seq_direction_vector). The lag can be a scalar or an array.
+    """
+    nx, ny, nz = direction_vector
+
+    # Shift the initial point along the azimuth and dip vector by the lag length
+    x_shifted = x1 + lag * nx
+    y_shifted = y1 + lag * ny
+    z_shifted = z1 + lag * nz
+
+    # Distance from the points to the shifted plane using the dot product
+    vector_to_point = np.column_stack((x2 - x_shifted, y2 - y_shifted, z2 - z_shifted))
+    distance = seq_dot_block(vector_to_point, direction_vector) / np.linalg.norm(direction_vector)
+
+    return distance
+
+def seq_projection_length_2d_block(x1, y1, x2, y2, direction_vector):
+    """
+    Planar version of seq_projection_length_block, for points with the same Z and a
+    horizontal direction vector: only the X and Y components are evaluated.
+    """
+    vector_to_point = np.column_stack((x2 - x1, y2 - y1))
+
+    return seq_dot_block(vector_to_point, direction_vector[:2])
+
+def seq_distance_along_horizontal_bandwidth_2d_block(x1, y1, x2, y2, direction_vector):
+    """
+    Planar version of seq_distance_along_horizontal_bandwidth_block. The vertical
+    bandwidth distance of planar points and a horizontal direction is always 0.
+    """
+    vector_to_point = np.column_stack((x2 - x1, y2 - y1))
+
+    # Remove the projection to keep the perpendicular components
+    projection_length = seq_dot_block(vector_to_point, direction_vector[:2])
+    perpendicular_vector = vector_to_point - projection_length[:, None] * direction_vector[:2]
+
+    return np.sqrt(seq_dot_block(perpendicular_vector, perpendicular_vector))
+
+def seq_point_distance_to_shifted_plane_2d_block(x1, y1, x2, y2, lag, direction_vector):
+    """
+    Planar version of seq_point_distance_to_shifted_plane_block. The lag can be a
+    scalar or an array.
+    """
+    nx, ny = direction_vector[0], direction_vector[1]
+
+    # Shift the initial point along the direction vector by the lag length
+    x_shifted = x1 + lag * nx
+    y_shifted = y1 + lag * ny
+
+    # Distance from the points to the shifted plane using the dot product
+    vector_to_point = np.column_stack((x2 - x_shifted, y2 - y_shifted))
+    distance = seq_dot_block(vector_to_point, direction_vector[:2]) / np.linalg.norm(direction_vector)
+
+    return distance
@@ -0,0 +1,148 @@
+import numpy as np
+from seq_search_pairs_support import (
+    seq_calculate_azimuth_3d_block,
+    seq_calculate_dip_3d_block,
+    seq_distance_along_horizontal_bandwidth_block,
+    seq_distance_along_vertical_bandwidth_block,
+    seq_projection_length_block,
+    seq_direction_vector
+)
+from seq_search_pairs import seq_settle_dip_boundaries, seq_angle_window_block, seq_lag_bins_block, seq_sort_pairs, seq_pairs_rows_to_ids
+from seq_spatial_index import seq_search_bounding_boxes, seq_build_grid_index, seq_query_grid_index
+from seq_pair_index import seq_build_pair_index
+
+def seq_sweep_union_boxes(param_sets):
+    """
+    Box of each direction id containing the search boxes of that direction in every
+    parameter set. Returns an array of shape (max ndir, 2, 3).
+    """
+    ndir = max(len(params[0]) for params in param_sets)
+    union = np.zeros((ndir, 2, 3))
+    union[:, 0] = np.inf
+    union[:, 1] = -np.inf
+    for params in param_sets:
+        boxes = seq_search_bounding_boxes(params[0], params[1], params[2], params[3], params[4], params[6], params[7], params[9])
+        union[:len(boxes), 0] = np.minimum(union[:len(boxes), 0], boxes[:, 0])
+        union[:len(boxes), 1] = np.maximum(union[:len(boxes), 1], boxes[:, 1])
+
+    return union
+
+def seq_classify_pairs_sweep_block(x1, y1, z1, x2, y2, z2, param_sets, direction_vectors):
+    """
+    Classify a block of pairs (x1, y1, z1) -> (x2, y2, z2), given as aligned coordinate
+    arrays, for every parameter set at once. The azimuth and the dip of each pair are
+    computed once for all the sets, the bandwidth distances and the projection once per
+    direction orientation (azimuth, dip) shared by the sets; only the tolerance windows
+    and the lag checks are evaluated per set. Returns, for each set, the arrays
+    (dim_id, n, position in the block) of the accepted pairs.
+    """
+    # The azimuth and the dip of a pair do not depend on the direction nor on the set
+    cal_azimuth = seq_calculate_azimuth_3d_block(x1, y1, z1, x2, y2, z2)
+    cal_dip = seq_calculate_dip_3d_block(x1, y1, z1, x2, y2, z2)
+    dip_bounds = [(params[7][dim_id], params[8][dim_id]) for params in param_sets for dim_id in params[0]]
+    cal_dip = seq_settle_dip_boundaries(cal_dip, x1, y1, z1, x2, y2, z2, range(len(dip_bounds)), [bound[0] for bound in dip_bounds], [bound[1] for bound in dip_bounds])
+
+    # Bandwidth distances and projection of each orientation, computed on first use
+    geometry = {}
+
+    found = []
+    for params, set_direction_vectors in zip(param_sets, direction_vectors):
+        dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv = params
+        found_dim, found_n, found_position = [], [], []
+        for dim_id in dim:
+            direction_vector = set_direction_vectors[dim_id]
+            if (azm[dim_id], dip[dim_id]) not in geometry:
+                geometry[(azm[dim_id], dip[dim_id])] = (
+                    seq_distance_along_horizontal_bandwidth_block(x1, y1, z1, x2, y2, z2, direction_vector),
+                    seq_distance_along_vertical_bandwidth_block(x1, y1, z1, x2, y2, z2, direction_vector),
+                    seq_projection_length_block(x1, y1, z1, x2, y2, z2, direction_vector),
+                )
+            distance_banwh, distance_banwv, projection = geometry[(azm[dim_id], dip[dim_id])]
+
+            # Access the azimuth and dip tolerence boundaries
+            keep = seq_angle_window_block(cal_azimuth, cal_dip, azm[dim_id], azm_tol[dim_id], dip[dim_id], dip_tol[dim_id])
+
+            # Access the horizontal and vertical bandwidth boundaries
+            keep = np.flatnonzero(keep & (np.abs(distance_banwh) <= bandwh[dim_id]) & (np.abs(distance_banwv) <= bandwv[dim_id]))
+
+            # Access within the lag tolerance of the lags the projection can fall in
+            position, n = seq_lag_bins_block(x1[keep], y1[keep], z1[keep], x2[keep], y2[keep], z2[keep], projection[keep], nlag[dim_id], lag[dim_id], lag_tol[dim_id], direction_vector)
+
+            found_dim.append(np.full(n.shape[0], dim_id, dtype=np.int64))
+            found_n.append(n)
+            found_position.append(keep[position])
+
+        found.append((np.concatenate(found_dim), np.concatenate(found_n), np.concatenate(found_position)))
+
+    return found
+
+def seq_gather_candidate_pairs(data_vector, boxes, block_size=65536, use_index=True):
+    """
+    Yield the (point row, candidate row) pairs of consecutive points of data_vector by
+    blocks of about block_size pairs, as two aligned arrays. With use_index, the
+    candidates of each point are read from a grid index over the boxes (relative to
+    the point), otherwise every other point is a candidate.
+    """
+    all_rows = np.arange(data_vector.shape[0])
+    if use_index:
+        index = seq_build_grid_index(data_vector[:, 1:4], boxes)
+
+    first_rows, second_rows, num_gathered = [], [], 0
+    # for each points
+    for anchor_row, p in enumerate(data_vector):
+        # Potential pairs: restricted to the reachable boxes
+        if use_index:
+            rows = np.unique(np.concatenate([seq_query_grid_index(index, p[1:4], box) for box in boxes]))
+        else:
+            rows = all_rows
+
+        # Ensure potential pair point is not itself
+        rows = rows[data_vector[rows, 0] != p[0]]
+
+        # for each block of potential pairs
+        for start in range(0, rows.shape[0], block_size):
+            block_rows = rows[start:start + block_size]
+            first_rows.append(np.full(block_rows.shape[0], anchor_row))
+            second_rows.append(block_rows)
+            num_gathered += block_rows.shape[0]
+            if num_gathered >= block_size:
+                yield np.concatenate(first_rows), np.concatenate(second_rows)
+                first_rows, second_rows, num_gathered = [], [], 0
+
+    if num_gathered > 0:
+        yield np.concatenate(first_rows), np.concatenate(second_rows)
+
+def seq_search_pairs_gen_sweep(data_vector, param_sets, block_size=65536, use_index=True, as_index=False):
+    """
+    Search the pairs of data_vector for a list of parameter sets, each a tuple
+    (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv), in a single
+    pass. With use_index, the candidates of each point are read once from a grid index
+    over the union of the search boxes of all the sets. The (point, candidate) pairs of
+    consecutive points are gathered into blocks of about block_size pairs, each
+    classified against every set at once (see seq_classify_pairs_sweep_block). Returns
+    one output per set, the same as seq_search_pairs_gen_vectorized with that set: a
+    list, or with as_index a CSR pair index.
+    """
+    data_vector = np.asarray(data_vector, dtype=np.float64)
+
+    # The direction vectors only depend on the direction, compute them once
+    direction_vectors = [[seq_direction_vector(params[4][dim_id], params[7][dim_id]) for dim_id in params[0]] for params in param_sets]
+
+    pairs = [[np.zeros((0, 4), dtype=np.int64)] for _ in param_sets]
+    for first_rows, second_rows in seq_gather_candidate_pairs(data_vector, seq_sweep_union_boxes(param_sets), block_size=block_size, use_index=use_index):
+        # Classify the gathered pairs and add them to the pairs of each set
+        first, second = data_vector[first_rows], data_vector[second_rows]
+        found = seq_classify_pairs_sweep_block(first[:, 1], first[:, 2], first[:, 3], second[:, 1], second[:, 2], second[:, 3], param_sets, direction_vectors)
+        for set_pairs, (found_dim, found_n, found_position) in zip(pairs, found):
+            set_pairs.append(np.column_stack((first_rows[found_position], found_dim, found_n, second_rows[found_position])))
+
+    outputs = []
+    for params, set_pairs in zip(param_sets, pairs):
+        # Same order as the nested loops of seq_search_pairs_gen
+        set_pairs = seq_pairs_rows_to_ids(data_vector, seq_sort_pairs(np.concatenate(set_pairs).astype(np.int64)))
+        if as_index:
+            outputs.append(seq_build_pair_index(set_pairs, data_vector.shape[0], len(params[0]), max(params[1])))
+        else:
+            outputs.append(set_pairs.tolist())
+
+    return outputs
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+import pandas as pd
+from seq_search_pairs import seq_prepare_pair_search, seq_search_pairs_anchors, seq_sort_pairs, seq_pairs_rows_to_ids
+from seq_spatial_index import seq_search_bounding_boxes
+from seq_pair_index import seq_open_spilled_pair_writer, seq_write_spilled_pairs, seq_close_spilled_pair_writer, seq_discard_spilled_pair_writer
+
+def seq_write_coordinate_store(csv_path, store_path, chunksize=1000000):
+    """
+    Copy the coordinates of a CSV file into a (N, 4) .npy coordinate store of
+    [point_id, X, Y, Z] rows, reading the CSV in chunks of chunksize rows. The point
+    ids are the row numbers from 1, as in compute_pairs.
+    """
+    # First pass: number of rows
+    num_rows = sum(chunk.shape[0] for chunk in pd.read_csv(csv_path, usecols=['X'], chunksize=chunksize))
+
+    # Second pass: copy the coordinates
+    store = np.lib.format.open_memmap(store_path, mode='w+', dtype=np.float64, shape=(num_rows, 4))
+    start = 0
+    for chunk in pd.read_csv(csv_path, usecols=['X', 'Y', 'Z'], chunksize=chunksize):
+        end = start + chunk.shape[0]
+        store[start:end, 0] = np.arange(start + 1, end + 1)
+        store[start:end, 1:4] = chunk[['X', 'Y', 'Z']].to_numpy(dtype=np.float64)
+        start = end
+    store.flush()
+
+    return np.load(store_path, mmap_mode='r')
+
+def seq_tile_ids(coords, origin, tile_size, shape):
+    """
+    Linear id of the tile of each point, with X varying fastest so that a row of tiles
+    along X is contiguous once the points are sorted by tile.
+    """
+    tile = np.minimum(np.floor((coords - origin) / tile_size).astype(np.int64), shape - 1)
+
+    return tile[:, 0] + shape[0] * (tile[:, 1] + shape[1] * tile[:, 2])
+
+def seq_sort_store_into_tiles(store, tile_size, tiles_path, chunksize=1000000):
+    """
+    Counting sort of the rows of the coordinate store into tiles of tile_size, written
+    to a new .npy store at tiles_path. The store is read in chunks of chunksize rows, so
+    the memory used does not depend on the number of points. Returns a dictionary with
+    the origin, the tile size and the shape of the tiles, the sorted store and the start
+    of each tile in it.
+    """
+    num_rows = store.shape[0]
+
+    # First pass: bounds of the coordinates
+    origin = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for start in range(0, num_rows, chunksize):
+        coords = store[start:start + chunksize, 1:4]
+        origin = np.minimum(origin, coords.min(axis=0))
+        upper = np.maximum(upper, coords.max(axis=0))
+    shape = (np.floor((upper - origin) / tile_size) + 1).astype(np.int64)
+
+    # Second pass: number of points per tile
+    counts = np.zeros(np.prod(shape), dtype=np.int64)
+    for start in range(0, num_rows, chunksize):
+        counts += np.bincount(seq_tile_ids(store[start:start + chunksize, 1:4], origin, tile_size, shape), minlength=counts.shape[0])
+    tile_start = np.zeros(counts.shape[0] + 1, dtype=np.int64)
+    np.cumsum(counts, out=tile_start[1:])
+
+    # Third pass: write each chunk at the next free rows of its tiles, keeping the row order
+    sorted_store = np.lib.format.open_memmap(tiles_path, mode='w+', dtype=np.float64, shape=store.shape)
+    next_row = tile_start[:-1].copy()
+    for start in range(0, num_rows, chunksize):
+        chunk = np.asarray(store[start:start + chunksize])
+        tile_id = seq_tile_ids(chunk[:, 1:4], origin, tile_size, shape)
+        order = np.argsort(tile_id, kind='stable')
+        tiles, first, tile_counts = np.unique(tile_id[order], return_index=True, return_counts=True)
+        rank = np.arange(order.shape[0]) - np.repeat(first, tile_counts)
+        sorted_store[np.repeat(next_row[tiles], tile_counts) + rank] = chunk[order]
+        next_row[tiles] += tile_counts
+    sorted_store.flush()
+
+    return {
+        'origin': origin,
+        'tile_size': tile_size,
+        'shape': shape,
+        'store': np.load(tiles_path, mmap_mode='r'),
+        'tile_start': tile_start,
+    }
+
+def seq_load_tile_neighbourhood(tiles, tile):
+    """
+    Read the points of a tile and of its neighbour tiles from the sorted store. Returns
+    the (M, 4) neighbourhood and the rows of the points of the tile itself in it.
+    """
+    nx, ny, nz = tiles['shape']
+    ix, iy, iz = tile % nx, (tile // nx) % ny, tile // (nx * ny)
+    ix0, ix1 = max(ix - 1, 0), min(ix + 1, nx - 1)
+
+    # Each row of tiles along X is a contiguous slice of the sorted store
+    slices = []
+    for jz in range(max(iz - 1, 0), min(iz + 1, nz - 1) + 1):
+        for jy in range(max(iy - 1, 0), min(iy + 1, ny - 1) + 1):
+            row = nx * (jy + ny * jz)
+            slices.append((tiles['tile_start'][row + ix0], tiles['tile_start'][row + ix1 + 1]))
+
+    neighbourhood = np.concatenate([tiles['store'][start:end] for start, end in slices])
+
+    # Position of the tile itself in the neighbourhood
+    tile_start, tile_end = tiles['tile_start'][tile], tiles['tile_start'][tile + 1]
+    offset = 0
+    for start, end in slices:
+        if start <= tile_start and tile_end <= end:
+            offset += tile_start - start
+            break
+        offset += end - start
+
+    return neighbourhood, np.arange(offset, offset + tile_end - tile_start)
+
+def seq_search_pairs_gen_tiled(csv_path, output_path, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, work_dir=None, min_tile_size=0.0, chunksize=1000000, anchors_per_batch=1024, block_size=4096, input_file=None):
+    """
+    Out-of-core pair search for datasets larger than the memory. The coordinates of the
+    CSV file are copied into a memory-mapped store and sorted into tiles at least as
+    large as the search boxes, so that the pairs of the points of a tile are all in the
+    tile and its neighbour tiles. The points of each tile are searched by batches of
+    anchors_per_batch with seq_search_pairs_anchors against the neighbourhood only, and
+    the pairs of each batch are spilled to disk before the next batch. The tiles do not
+    follow the point id order, so the batches are written to the .pairs file at
+    output_path through a spilled pair writer (see seq_open_spilled_pair_writer) instead
+    of the streaming one. The file is the same as the one of seq_search_pairs_gen. The
+    temporary files are written to work_dir (the directory of output_path by default)
+    and removed at the end. Returns the number of pairs written.
+    """
+    work_dir = work_dir or os.path.dirname(os.path.abspath(output_path))
+    store_path = os.path.join(work_dir, 'seq_pairs_coordinates.npy')
+    tiles_path = os.path.join(work_dir, 'seq_pairs_tiles.npy')
+    params = (dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+    # Tiles at least as large as the reach of every direction
+    boxes = seq_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv)
+    tile_size = np.maximum(np.abs(boxes).max(axis=(0, 1)), min_tile_size)
+
+    try:
+        store = seq_write_coordinate_store(csv_path, store_path, chunksize=chunksize)
+        tiles = seq_sort_store_into_tiles(store, tile_size, tiles_path, chunksize=chunksize)
+        writer = seq_open_spilled_pair_writer(output_path, store.shape[0], len(dim), max(nlag), work_dir, params=params, input_file=input_file)
+        del store
+
+        num_pairs = None
+        try:
+            # for each tile holding points
+            for tile in np.flatnonzero(np.diff(tiles['tile_start'])):
+                neighbourhood, tile_rows = seq_load_tile_neighbourhood(tiles, tile)
+                search = seq_prepare_pair_search(neighbourhood, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv)
+
+                # for each batch of points of the tile, in point id order
+                for start in range(0, tile_rows.shape[0], anchors_per_batch):
+                    anchor_rows = tile_rows[start:start + anchors_per_batch]
+                    pairs = seq_search_pairs_anchors(neighbourhood, anchor_rows, dim, nlag, lag, lag_tol, azm, azm_tol, bandwh, dip, dip_tol, bandwv, search, block_size=block_size)
+
+                    # Order the pairs of the batch like seq_search_pairs_gen, then spill them
+                    seq_write_spilled_pairs(writer, seq_sort_pairs(seq_pairs_rows_to_ids(neighbourhood, pairs)))
+
+            num_pairs = seq_close_spilled_pair_writer(writer)
+        finally:
+            if num_pairs is None:
+                seq_discard_spilled_pair_writer(writer)
+
+        del tiles
+    finally:
+        for path in (store_path, tiles_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    return num_pairs
@@ -0,0 +1,228 @@
+import numpy as np
+from seq_search_pairs_support import seq_direction_vector
+
+# Maximum number of grid cells per point, limits the memory used by the cell table
+MAX_CELLS_PER_POINT = 8
+
+def seq_search_bounding_boxes(dim, nlag, lag, lag_tol, azm, bandwh, dip, bandwv):
+    """
+    Calculate, for each direction, the axis-aligned box (relative to the anchor point)
+    that contains every point which can be paired in that direction.
+    Returns an array of shape (ndir, 2, 3) holding the lower and upper corners.
+    """
+    boxes = np.zeros((len(dim), 2, 3))
+    for dim_id in dim:
+        direction_vector = seq_direction_vector(azm[dim_id], dip[dim_id])
+
+        # The projection onto the direction lies between the first and the last lag window
+        lag_ends = np.array([lag[dim_id], nlag[dim_id] * lag[dim_id]])
+        min_projection = lag_ends.min() - lag_tol[dim_id]
+        max_projection = lag_ends.max() + lag_tol[dim_id]
+
+        # The bandwidths bound the distance perpendicular to the direction
+        radius = np.sqrt(bandwh[dim_id]**2 + bandwv[dim_id]**2)
+
+        # Small margin so the floating point rounding of the exact checks is never pruned
+        margin = radius + 1e-6 * (abs(min_projection) + abs(max_projection) + radius + 1.0)
+
+        ends = np.array([min_projection * direction_vector, max_projection * direction_vector])
+        boxes[dim_id, 0] = ends.min(axis=0) - margin
+        boxes[dim_id, 1] = ends.max(axis=0) + margin
+
+    return boxes
+
+def seq_build_grid_index(coords, boxes):
+    """
+    Bucket the points into a regular grid of cells. The cell size follows the smallest
+    extent of the search boxes, and is enlarged when needed to keep at most
+    MAX_CELLS_PER_POINT cells per point.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    origin = coords.min(axis=0)
+    extent = coords.max(axis=0) - origin
+
+    # Half the thinnest side of the search boxes
+    box_sides = (boxes[:, 1] - boxes[:, 0]).ravel()
+    cell_size = max(box_sides[box_sides > 0].min() / 2, 1e-9)
+
+    max_cells = MAX_CELLS_PER_POINT * coords.shape[0]
+    while np.prod(np.floor(extent / cell_size) + 1) > max_cells:
+        cell_size *= 2
+
+    # Linear cell id with X varying fastest, so that a row of cells along X is contiguous
+    shape = (np.floor(extent / cell_size) + 1).astype(np.int64)
+    cell = np.minimum(np.floor((coords - origin) / cell_size).astype(np.int64), shape - 1)
+    cell_id = cell[:, 0] + shape[0] * (cell[:, 1] + shape[1] * cell[:, 2])
+
+    # Sort the points by cell, keeping the row order inside each cell
+    order = np.argsort(cell_id, kind='stable')
+    cell_start = np.zeros(np.prod(shape) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cell_id, minlength=np.prod(shape)), out=cell_start[1:])
+
+    return {
+        'coords': coords,
+        'origin': origin,
+        'cell_size': cell_size,
+        'shape': shape,
+        'order': order,
+        'cell_start': cell_start,
+    }
+
+def seq_query_grid_index(index, point, box):
+    """
+    Return the sorted row indices of the points inside the box (relative to point).
+    """
+    lo = point + box[0]
+    hi = point + box[1]
+
+    # Range of cells overlapped by the box
+    cell_lo = np.maximum(np.floor((lo - index['origin']) / index['cell_size']).astype(np.int64), 0)
+    cell_hi = np.minimum(np.floor((hi - index['origin']) / index['cell_size']).astype(np.int64), index['shape'] - 1)
+    if np.any(cell_lo > cell_hi):
+        return np.zeros(0, dtype=np.int64)
+
+    # Each row of cells along X is a contiguous slice of the sorted points
+    nx, ny = index['shape'][0], index['shape'][1]
+    slices = []
+    for iz in range(cell_lo[2], cell_hi[2] + 1):
+        for iy in range(cell_lo[1], cell_hi[1] + 1):
+            row = nx * (iy + ny * iz)
+            start = index['cell_start'][row + cell_lo[0]]
+            end = index['cell_start'][row + cell_hi[0] + 1]
+            slices.append(index['order'][start:end])
+    rows = np.concatenate(slices)
+
+    # Drop the points of the cells that are outside the box itself
+    inside = np.all((index['coords'][rows] >= lo) & (index['coords'][rows] <= hi), axis=1)
+
+    return np.sort(rows[inside])
+
+def seq_projection_windows(nlag, lag, lag_tol, margin):
+    """
+    Windows [n*lag - lag_tol, n*lag + lag_tol] of the projection length for n in
+    1..nlag, widened by margin and merged where they overlap. Returns an (K, 2) array.
+    """
+    if nlag < 1:
+        return np.zeros((0, 2))
+
+    centers = np.arange(1, nlag + 1) * lag
+    windows = np.column_stack((centers - lag_tol - margin, centers + lag_tol + margin))
+    windows = windows[np.argsort(windows[:, 0])]
+
+    # Merge the overlapping windows
+    merged = [windows[0]]
+    for window in windows[1:]:
+        if window[0] <= merged[-1][1]:
+            merged[-1] = np.array([merged[-1][0], max(merged[-1][1], window[1])])
+        else:
+            merged.append(window)
+
+    return np.array(merged)
+
+def seq_build_projection_index(coords, direction_vectors):
+    """
+    Sort the points by their projection length onto each direction vector. A lag
+    window of a direction is then a contiguous slice of the sorted points, found by
+    binary search. The projection lengths are computed from the origin, the margin
+    bounds their rounding difference with the projection of the vector between two points.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    projection = coords @ np.array(direction_vectors).T
+    order = np.argsort(projection, axis=0, kind='stable')
+
+    return {
+        'projection': projection,
+        'order': order,
+        'sorted_projection': np.take_along_axis(projection, order, axis=0),
+        'margin': 1e-9 * (np.abs(coords).max() + 1.0),
+    }
+
+def seq_query_projection_index(index, row, dim_id, windows):
+    """
+    Return the sorted row indices of the points whose projection length onto the
+    direction dim_id, relative to the point at row, falls in one of the windows.
+    """
+    sorted_projection = index['sorted_projection'][:, dim_id]
+    start = np.searchsorted(sorted_projection, index['projection'][row, dim_id] + windows[:, 0], side='left')
+    end = np.searchsorted(sorted_projection, index['projection'][row, dim_id] + windows[:, 1], side='right')
+
+    # The merged windows are disjoint, so are the slices
+    rows = np.concatenate([np.zeros(0, dtype=np.int64)] + [index['order'][s:e, dim_id] for s, e in zip(start, end)])
+
+    return np.sort(rows)
+
+def seq_spread_bits(values):
+    """
+    Spread the 21 lower bits of each value so that two zero bits separate them, to
+    interleave three coordinates into a 63-bit code.
+    """
+    values = values.astype(np.uint64) & np.uint64(0x1fffff)
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f), (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+
+    return values
+
+def seq_morton_codes(cells):
+    """
+    Morton (Z-order) code of each (N, 3) integer cell, the X bits being the most
+    significant of each group of three.
+    """
+    return (seq_spread_bits(cells[:, 0]) << np.uint64(2)) | (seq_spread_bits(cells[:, 1]) << np.uint64(1)) | seq_spread_bits(cells[:, 2])
+
+def seq_hilbert_codes(cells, bits):
+    """
+    Hilbert code of each (N, 3) integer cell of a grid of 2**bits cells per axis, with
+    Skilling's transform of the coordinates into the transposed Hilbert index, whose
+    bits are then interleaved like a Morton code.
+    """
+    x = [cells[:, axis].astype(np.uint64) for axis in range(3)]
+
+    # Inverse undo of the excess work
+    q = 1 << (bits - 1)
+    while q > 1:
+        p = np.uint64(q - 1)
+        for axis in range(3):
+            high = (x[axis] & np.uint64(q)) != 0
+            x[0] = np.where(high, x[0] ^ p, x[0])
+            t = np.where(high, np.uint64(0), (x[0] ^ x[axis]) & p)
+            x[0] ^= t
+            x[axis] ^= t
+        q >>= 1
+
+    # Gray encode
+    x[1] ^= x[0]
+    x[2] ^= x[1]
+    t = np.zeros_like(x[0])
+    q = 1 << (bits - 1)
+    while q > 1:
+        t = np.where((x[2] & np.uint64(q)) != 0, t ^ np.uint64(q - 1), t)
+        q >>= 1
+    x = [values ^ t for values in x]
+
+    return seq_morton_codes(np.column_stack(x))
+
+def seq_space_filling_order(coords, curve='morton', bits=10):
+    """
+    Permutation of the points sorting them along a Morton ('morton') or Hilbert
+    ('hilbert') curve over a grid of 2**bits cells per axis spanning their bounding
+    box, so that points close in space are close in memory. Points of the same cell
+    keep their row order.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if coords.shape[0] == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    # Cell of each point, with the same cell size along every axis
+    origin = coords.min(axis=0)
+    extent = (coords.max(axis=0) - origin).max()
+    cell_size = extent / ((1 << bits) - 1) if extent > 0 else 1.0
+    cells = np.minimum(np.floor((coords - origin) / cell_size).astype(np.int64), (1 << bits) - 1)
+
+    if curve == 'morton':
+        codes = seq_morton_codes(cells)
+    elif curve == 'hilbert':
+        codes = seq_hilbert_codes(cells, bits)
+    else:
+        raise ValueError(f"Unknown space-filling curve: {curve}")
+
+    return np.argsort(codes, kind='stable')
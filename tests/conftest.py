@@ -0,0 +1,47 @@
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+
+# The workflows are flat script directories
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(REPO_DIR, 'sequential_workflow'))
+sys.path.insert(0, os.path.join(REPO_DIR, 'parallel_workflow'))
+
+from seq_run import load_parameters
+
+INPUT_DIR = os.path.join(REPO_DIR, 'input')
+OUTPUT_DIR = os.path.join(REPO_DIR, 'output')
+SEARCH_PARAMETERS = os.path.join(REPO_DIR, 'search_parameters.json')
+
+# Datasets with the pairs of seq_search_pairs_gen tracked in the output folder
+TRACKED_DATASETS = [('2d_grid_test_data', 2), ('2d_walker_lake', 2), ('3d_grid_test_data', 3)]
+
+
+def load_data_vector(name):
+    # [point_id, X, Y, Z, GRADE] rows, as in compute_pairs
+    df = pd.read_csv(os.path.join(INPUT_DIR, f"{name}.csv"))
+    df.insert(0, 'point_id', range(1, len(df) + 1))
+
+    return df.to_numpy()
+
+
+def load_tracked_pairs(name):
+    # [point_id, dim_id, n, paired_point_id] rows of the tracked output of seq_search_pairs_gen
+    df = pd.read_json(os.path.join(OUTPUT_DIR, f"seq_pairs_{name}.json"))
+
+    return df[['point_id', 'dim_id', 'n', 'paired_point_id']].to_numpy(dtype=np.int64)
+
+
+@pytest.fixture(params=TRACKED_DATASETS, ids=[name for name, _ in TRACKED_DATASETS])
+def tracked_dataset(request):
+    # Data vector, search parameters and reference pairs of a tracked dataset
+    name, ndir = request.param
+    return {
+        'name': name,
+        'data_vector': load_data_vector(name),
+        'params': load_parameters(ndir, SEARCH_PARAMETERS),
+        'pairs': load_tracked_pairs(name),
+        'ndir': ndir,
+    }
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+from seq_search_pairs import seq_search_pairs_gen, seq_search_pairs_gen_vectorized, seq_settle_dip_boundaries
+from seq_search_pairs_support import (
+    seq_calculate_azimuth_3d,
+    seq_calculate_dip_3d,
+    seq_calculate_dip_3d_block,
+    seq_dot_block,
+    seq_direction_vector,
+)
+
+
+def rounding_pairs(num_pairs=20000, seed=0):
+    # Pairs of points whose block dip differs in the last bit from the scalar one
+    rng = np.random.default_rng(seed)
+    first = rng.normal(size=(num_pairs, 3)) * 1e3
+    second = first + rng.normal(size=(num_pairs, 3))
+    block_dip = seq_calculate_dip_3d_block(first[:, 0], first[:, 1], first[:, 2], second[:, 0], second[:, 1], second[:, 2])
+    scalar_dip = np.array([seq_calculate_dip_3d(*first[i], *second[i]) for i in range(num_pairs)])
+    differ = np.flatnonzero((block_dip != scalar_dip) & (scalar_dip > 1.0) & (scalar_dip < 89.0))
+
+    return first[differ], second[differ], block_dip[differ], scalar_dip[differ]
+
+
+def test_rounding_pairs_exist():
+    # The block and scalar dips do differ, by far less than the 1e-9 window of seq_settle_dip_boundaries
+    first, second, block_dip, scalar_dip = rounding_pairs()
+    assert first.shape[0] > 0
+    assert np.abs(block_dip - scalar_dip).max() < 1e-12
+
+
+def test_settle_dip_boundaries():
+    first, second, block_dip, scalar_dip = rounding_pairs()
+
+    # Every dip is on the upper tolerance boundary of a direction
+    dim = range(first.shape[0])
+    dip, dip_tol = list(scalar_dip - 0.5), [0.5] * first.shape[0]
+    settled = seq_settle_dip_boundaries(block_dip.copy(), first[:, 0], first[:, 1], first[:, 2], second[:, 0], second[:, 1], second[:, 2], dim, dip, dip_tol)
+
+    np.testing.assert_array_equal(settled, scalar_dip)
+
+
+@pytest.mark.parametrize('side', [-1, 1])
+def test_dips_on_the_tolerance_boundaries(side):
+    # Each pair is searched with a direction whose dip window ends exactly at the scalar dip of the pair
+    first, second, _, scalar_dip = rounding_pairs()
+    for i in range(first.shape[0]):
+        data_vector = np.array([[1, *first[i], 0.0], [2, *second[i], 0.0]])
+        distance = float(np.linalg.norm(second[i] - first[i]))
+        azimuth = seq_calculate_azimuth_3d(*first[i], *second[i])
+        params = ([0], [1], [distance], [distance], [azimuth], [1.0], [1.0], [scalar_dip[i] + side * 0.5], [0.5], [1.0])
+        assert params[7][0] - side * params[8][0] == scalar_dip[i]
+
+        expected = seq_search_pairs_gen(data_vector, *params)
+        assert expected == [[1, 0, 1, 2]]
+        assert seq_search_pairs_gen_vectorized(data_vector, *params) == expected
+        assert seq_search_pairs_gen_vectorized(data_vector, *params, use_index=False) == expected
+
+
+@pytest.mark.parametrize('width', [2, 3])
+def test_dot_block_matches_np_dot(width):
+    # The block helpers rely on the batched matmul giving the np.dot of the scalar helpers bit for bit
+    rng = np.random.default_rng(width)
+    vectors = rng.normal(size=(5000, width)) * 10.0 ** rng.integers(-3, 4, size=(5000, 1))
+    direction_vector = seq_direction_vector(37.0, -12.0)[:width]
+    others = rng.normal(size=(5000, width))
+
+    np.testing.assert_array_equal(seq_dot_block(vectors, direction_vector), np.array([np.dot(vector, direction_vector) for vector in vectors]))
+    np.testing.assert_array_equal(seq_dot_block(vectors, others), np.array([np.dot(vector, other) for vector, other in zip(vectors, others)]))
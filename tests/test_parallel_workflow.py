@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+numba = pytest.importorskip('numba')
+
+# The process pools of the sequential workflow fork the test process, which TBB does not survive
+numba.config.THREADING_LAYER = 'forksafe'
+
+from par_search_pairs_cpu import par_search_pairs_gen_cpu
+from par_pair_index import par_pair_index_to_pairs
+
+
+def test_cpu_backend(tracked_dataset):
+    pairs = par_pair_index_to_pairs(par_search_pairs_gen_cpu(tracked_dataset['data_vector'], *tracked_dataset['params']))
+
+    # Within a (point_id, dim_id, n) slot the pairs follow the grid order of the kernel
+
+    expected = tracked_dataset['pairs']
+    np.testing.assert_array_equal(pairs[np.lexsort(pairs.T[::-1])], expected[np.lexsort(expected.T[::-1])])
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from conftest import SEARCH_PARAMETERS, load_data_vector
+from seq_run import load_parameters
+from seq_search_pairs import seq_search_pairs_gen, seq_search_pairs_gen_vectorized
+from seq_search_pairs_pool import seq_search_pairs_gen_pool
+
+
+def assert_same_pairs(pairs, expected):
+    # Same rows in the same order
+    np.testing.assert_array_equal(np.asarray(pairs, dtype=np.int64).reshape(-1, 4), expected)
+
+
+def test_vectorized_matches_scalar_search_in_2d():
+    data_vector = load_data_vector('2d_grid_test_data')[:40]
+    params = load_parameters(2, SEARCH_PARAMETERS)
+    expected = seq_search_pairs_gen_vectorized(data_vector, *params)
+
+    assert_same_pairs(seq_search_pairs_gen(data_vector, *params), np.asarray(expected, dtype=np.int64).reshape(-1, 4))
+
+
+def test_vectorized_matches_scalar_search_in_3d():
+    data_vector = load_data_vector('3d_walker_lake')[:80]
+    params = load_parameters(3, SEARCH_PARAMETERS)
+    expected = np.asarray(seq_search_pairs_gen(data_vector, *params), dtype=np.int64).reshape(-1, 4)
+
+    assert_same_pairs(seq_search_pairs_gen_vectorized(data_vector, *params), expected)
+    assert_same_pairs(seq_search_pairs_gen_vectorized(data_vector, *params, use_index=False), expected)
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'use_index': False},
+], ids=['grid', 'no-index'])
+def test_vectorized(tracked_dataset, options):
+    assert_same_pairs(seq_search_pairs_gen_vectorized(tracked_dataset['data_vector'], *tracked_dataset['params'], **options), tracked_dataset['pairs'])
+
+
+def test_pool(tracked_dataset):
+    pairs = seq_search_pairs_gen_pool(tracked_dataset['data_vector'], *tracked_dataset['params'], num_workers=2, anchors_per_task=50)
+
+    assert_same_pairs(pairs, tracked_dataset['pairs'])
@@ -1,5 +1,6 @@
 import os
 import json
+import numpy as np
 import pandas as pd
 
 def list_output_files(file_type):
@@ -12,7 +13,7 @@ def list_output_files(file_type):
     
     # Filter files based on file type
     if file_type == 'json':
-        files = [f for f in os.listdir(output_folder) if f.endswith('.json')]
+        files = [f for f in os.listdir(output_folder) if f.endswith(('.json', '.pairs'))]
     elif file_type == 'csv':
         files = [f for f in os.listdir(output_folder) if f.endswith('.csv')]
     else:
@@ -25,14 +26,29 @@ def display_files(files):
     for i, file in enumerate(files, 1):
         print(f"{i}. {file}")
 
-def compare_json_files(file1, file2):
-    with open(file1, 'r') as f1, open(file2, 'r') as f2:
-        data1 = json.load(f1)
-        data2 = json.load(f2)
+def load_pairs(file):
+    # Binary pair file: JSON header, then the offsets of each (point_id, dim_id, n) slot and the paired point ids
+    if file.endswith('.pairs'):
+        with open(file, 'rb') as f:
+            f.read(8)
+            header = json.loads(f.read(int(np.frombuffer(f.read(8), dtype=np.uint64)[0])))
+        shape = (header['num_points'], header['ndir'], header['max_nlag'] + 1)
+        offsets = np.fromfile(file, dtype=np.int64, count=np.prod(shape) + 1, offset=header['offsets_start'])
+        paired_point_id = np.memmap(file, dtype=np.int32, mode='r', offset=header['pairs_start'], shape=(header['num_pairs'],)) if header['num_pairs'] > 0 else np.zeros(0, dtype=np.int32)
 
-    # Convert JSON data to DataFrame
-    df1 = pd.DataFrame(data1)
-    df2 = pd.DataFrame(data2)
+        # Expand the slots into rows
+        counts = np.diff(offsets)
+        point_row, dim_id, n = np.unravel_index(np.repeat(np.arange(counts.shape[0]), counts), shape)
+        return pd.DataFrame({'point_id': point_row + 1, 'dim_id': dim_id, 'n': n, 'paired_point_id': paired_point_id.astype(np.int64)})
+
+    # JSON records
+    with open(file, 'r') as f:
+        return pd.DataFrame(json.load(f))
+
+def compare_pair_files(file1, file2):
+    # Load both pair files as DataFrames
+    df1 = load_pairs(file1)
+    df2 = load_pairs(file2)
 
     # Merge DataFrames on specific columns
     merged_df = pd.merge(df1, df2, on=["point_id", "dim_id", "n", "paired_point_id"], how="inner")
@@ -72,7 +88,7 @@ def compare_csv_files(file1, file2):
 
 def main():
     while True:
-        choice = input("Do you want to check:\n1. pairs (JSON) files\n2. cumulants (CSV) files\n3. Exit\nEnter 1, 2, or 3: ").strip()
+        choice = input("Do you want to check:\n1. pairs (JSON or binary .pairs) files\n2. cumulants (CSV) files\n3. Exit\nEnter 1, 2, or 3: ").strip()
         
         if choice == '3':
             print("Exiting the program.")
@@ -98,12 +114,12 @@ def main():
         file2_path = os.path.join(output_folder, files[file2_index])
 
         if choice == '1':
-            compliance_percentage = compare_json_files(file1_path, file2_path)
+            compliance_percentage = compare_pair_files(file1_path, file2_path)
             print(f"Compliance percentage: {compliance_percentage:.2f}%")
             if compliance_percentage == 100:
-                print("The JSON files are fully compliant (100% match).")
+                print("The pair files are fully compliant (100% match).")
             else:
-                print("The JSON files are not fully compliant.") 
+                print("The pair files are not fully compliant.") 
         elif choice == '2':
             compliance_percentage = compare_csv_files(file1_path, file2_path)
             print(f"Compliance percentage: {compliance_percentage:.2f}%")